@@ -35,6 +35,10 @@ def lambda_handler(event, context):
 
         device_name = body['device_name']
         version = body['new_version']
+        digest = body.get('digest')
+        priority = body.get('priority')
+        if priority is not None:
+            priority = int(priority)
     
     except Exception as e:
         return {
@@ -63,6 +67,12 @@ def lambda_handler(event, context):
         },
         "version": version
     }
+    if digest:
+        # Pin the exact image so devices can skip the pull when they already have it
+        job_document["digest"] = digest
+    if priority is not None:
+        # Devices run the highest priority pending job first
+        job_document["priority"] = priority
     
     try:
         # Create a job to update the firmware
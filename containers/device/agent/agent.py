@@ -3,9 +3,23 @@
 
 from job_handler import JobHandler
 from discover_gg_connection import get_mqtt_connection
+from state_store import load_state, save_state, state_dir
+from metrics import metrics
+from image_cache import ImageCache
+from image_pull import MultiPullProgress, pull_image
+from image_load import ChecksumMismatch, load_archive
+from container_index import ContainerIndex
+from health import HeartbeatMonitor, wait_until_healthy
+from job_journal import JobJournal
+from job_control import JobCanceled
+from shadow_reconciler import ShadowReconciler
+from governor import UpdateGovernor
+from pull_proxy import PullProxy
+from concurrent.futures import ThreadPoolExecutor
 import time
 import os
 import docker
+import requests
 
 
 registry = "registry:5000"
@@ -14,6 +28,47 @@ agent_thing_name = f"{device_name}-agent"
 firmware_thing_name = f"{device_name}-firmware"
 firmware_cert_mount_path = f"/certs/{firmware_thing_name}"
 network = "host"
+# How the last known-good firmware is kept as a warm standby: "paused" keeps its processes in
+# memory for the fastest resume, "stopped" frees memory at the cost of a cold process start.
+standby_mode = os.environ.get("STANDBY_MODE", "paused")
+# Maximum number of bundle images pulled at once
+pull_workers = int(os.environ.get("PULL_WORKERS", "3"))
+# "jobs" runs IoT Jobs, "shadow" reconciles the firmware to the desired state of the agent
+# thing's "firmware" named shadow instead
+update_mode = os.environ.get("UPDATE_MODE", "jobs")
+# Registry downloads budget in bytes per second, 0 for unlimited. When set at all, dockerd pulls
+# through the agent's pull proxy (see entrypoint.sh) and jobs can set their own budget.
+pull_rate_limit = os.environ.get("PULL_RATE_LIMIT")
+pull_proxy_port = int(os.environ.get("PULL_PROXY_PORT", "3128"))
+# Pull-through cache to pull the registry's images from first, e.g. "registry-cache:5000". Pulls
+# fall back to the registry itself if the mirror is down.
+registry_mirror = os.environ.get("REGISTRY_MIRROR")
+# Seconds a docker API call may go without a response, so a hung daemon or registry fails the
+# call instead of holding up the job
+docker_timeout = int(os.environ.get("DOCKER_TIMEOUT", "60"))
+# A docker API call fails with an APIError from the daemon, or a requests error when it times out
+# or the connection to the daemon drops
+docker_errors = (docker.errors.APIError, requests.exceptions.RequestException)
+
+image_cache = ImageCache(
+    registry,
+    keep_versions=int(os.environ.get("IMAGE_CACHE_KEEP_VERSIONS", "3")),
+    disk_budget_bytes=int(os.environ.get("IMAGE_CACHE_DISK_BUDGET_MB", "4096")) * 1024 * 1024,
+)
+
+# New firmware must pass a health check within this many seconds or it is rolled back. Containers
+# without a HEALTHCHECK must stay running for health_min_uptime seconds, and the first heartbeat
+# from the firmware can be required too. Jobs can override these with healthCheck.
+health_timeout = float(os.environ.get("HEALTH_TIMEOUT", "60"))
+health_min_uptime = float(os.environ.get("HEALTH_MIN_UPTIME", "5"))
+health_heartbeat = os.environ.get("HEALTH_WAIT_FOR_HEARTBEAT", "false").lower() == "true"
+
+# One docker client and container index for the life of the agent, see connect_docker()
+docker_client = None
+container_index = None
+heartbeat_monitor = None
+journal = None
+governor = None
 
 key = f"/certs/{agent_thing_name}/private.pem.key"
 cert = f"/certs/{agent_thing_name}/device.pem.crt"
@@ -21,12 +76,66 @@ root_ca = f"/certs/AmazonRootCA1.pem"
 region = "us-east-1"
 
 
-def start_container(version, fallback_container):
-    image = "firmware"
-    docker_client = docker.from_env()
+def get_components(job_document):
+    """Return the images to install for a Deploy-ROS-Firmware job, in the order to start them.
+
+    A job either deploys a single firmware image given by version (and optionally digest), or a
+    bundle of images listed under bundle.images. Each bundle image has a name and may give an
+    image repository, version, digest, environment and the names of the images it dependsOn.
+    """
+    version = job_document.get("version")
+    if "bundle" not in job_document:
+        return [
+            {
+                "name": "firmware",
+                "image": "firmware",
+                "version": version,
+                "digest": job_document.get("digest"),
+                "dependsOn": [],
+                "environment": {},
+            }
+        ]
+
+    components = []
+    for entry in job_document["bundle"]["images"]:
+        if entry.get("version", version) is None:
+            raise ValueError(f"Bundle image {entry['name']} has no version")
+        components.append(
+            {
+                "name": entry["name"],
+                "image": entry.get("image", entry["name"]),
+                "version": entry.get("version", version),
+                "digest": entry.get("digest"),
+                "dependsOn": entry.get("dependsOn", []),
+                "environment": entry.get("environment", {}),
+            }
+        )
+    return order_components(components)
+
+
+def order_components(components):
+    ordered = []
+    started = set()
+    remaining = list(components)
+    while remaining:
+        ready = [c for c in remaining if all(d in started for d in c["dependsOn"])]
+        if not ready:
+            names = [c["name"] for c in remaining]
+            raise ValueError(f"Bundle images {names} have unknown or circular dependencies")
+        for component in ready:
+            ordered.append(component)
+            started.add(component["name"])
+            remaining.remove(component)
+    return ordered
+
 
-    container_name = f"{device_name}-firmware-{version}"
-    labels = {"device": device_name}
+def get_container_config(component):
+    container_name = f"{device_name}-{component['name']}-{component['version']}"
+    labels = {
+        "device": device_name,
+        "component": component["name"],
+        "version": str(component["version"]),
+    }
     volumes = {}
     volumes[firmware_cert_mount_path] = {"bind": "/certs", "mode": "ro"}
 
@@ -35,6 +144,101 @@ def start_container(version, fallback_container):
         "TOPIC": f"clients/{firmware_thing_name}/hello/world",
         "TIMER_PERIOD": "5",
     }
+    environment.update(component["environment"])
+    return container_name, labels, volumes, environment
+
+
+def image_matches_digest(image, digest):
+    return any(
+        repo_digest.endswith(f"@{digest}") for repo_digest in image.attrs.get("RepoDigests") or []
+    )
+
+
+def get_image(component, progress_callback):
+    """Return the component's image, only pulling it when it is not already present locally.
+
+    A digest uniquely identifies the image, so a local copy can be used as is. A tag is mutable
+    and is always pulled to pick up any change in the registry. progress_callback is called with
+    the PullProgress of the pull.
+    """
+    if component.get("imageId"):
+        # Loaded from a firmware archive
+        image = docker_client.images.get(component["imageId"])
+        image_cache.touch(image.id)
+        return image
+
+    repository = f"{registry}/{component['image']}"
+    digest = component["digest"]
+    if digest:
+        image_ref = f"{repository}@{digest}"
+        try:
+            image = docker_client.images.get(image_ref)
+            print(f"Image {image_ref} already present, skipping pull")
+            metrics.increment("image_pull_skipped")
+            image_cache.touch(image.id)
+            return image
+        except docker.errors.ImageNotFound:
+            pass
+        tag = digest
+    else:
+        tag = component["version"]
+
+    print(f"Pulling image {repository} {tag}")
+    image, progress = pull_image(docker_client, repository, tag, progress_callback)
+    metrics.increment("image_pulled")
+    metrics.observe("image_pull_seconds", progress.elapsed)
+    metrics.observe("image_pull_mbps", progress.throughput / 1e6)
+    if digest and not image_matches_digest(image, digest):
+        raise RuntimeError(f"Pulled image {image.id} does not match digest {digest}")
+    image_cache.touch(image.id)
+    return image
+
+
+def load_components(components, archive, status_details, report_progress, control):
+    """Load the components' images from a docker save archive instead of pulling them.
+
+    archive gives the url of the archive, a path, file:// or http(s):// URL, and its sha256.
+    Images are matched to components by their {registry}/{image}:{version} tag, an archive with
+    a single image is tagged for a single component. Returns True if every image was loaded.
+    """
+    if not archive.get("url") or not archive.get("sha256"):
+        status_details["error"] = "archive needs a url and a sha256"
+        return False
+    try:
+        images, progress = load_archive(
+            docker_client,
+            archive["url"],
+            archive["sha256"],
+            lambda load_progress: report_progress(load_progress.status_details()),
+            control.check,
+        )
+    except (OSError, ChecksumMismatch, docker.errors.DockerException) as e:
+        print(f"Unable to load firmware archive {archive['url']}: {e}")
+        metrics.increment("archive_load_failed")
+        status_details["error"] = str(e)
+        return False
+    metrics.observe("archive_load_seconds", progress.elapsed)
+    status_details["loadBytes"] = str(progress.downloaded_bytes)
+    status_details["loadMBps"] = f"{progress.throughput / 1e6:.2f}"
+
+    for component in components:
+        tag = f"{registry}/{component['image']}:{component['version']}"
+        image = next((image for image in images if tag in image.tags), None)
+        if not image and len(images) == 1 and len(components) == 1:
+            image = images[0]
+            image.tag(f"{registry}/{component['image']}", str(component["version"]))
+        if not image:
+            print(f"Firmware archive has no image {tag}")
+            status_details["error"] = f"archive has no image {tag}"
+            return False
+        component["imageId"] = image.id
+    return True
+
+
+def stage_container(component, progress_callback, limits):
+    """Get the component's image and create its container while the current firmware keeps
+    running. limits are the container's warm-up resource limits."""
+    container_name, labels, volumes, environment = get_container_config(component)
 
     print("Environment", environment)
     print("Labels", labels)
@@ -42,85 +246,601 @@ def start_container(version, fallback_container):
     print("Network", network)
 
     try:
-        container = docker_client.containers.get(container_name)
-        print(f"Container {container_name} already exists, restarting")
-        container.restart()
-        return True
+        image = get_image(component, progress_callback)
 
-    except docker.errors.NotFound:
-        print(f"Contain {container_name} does not exist. Creating.")
-
-    print(f"Starting {container_name}...")
-    try:
-        print(f"Pulling image {registry}/{image}:{version}")
-        docker_client.images.pull(f"{registry}/{image}:{version}")
-        print(f"Starting container with image {registry}/{image}:{version}")
+        container = container_index.find(component["name"], component["version"])
+        if not container:
+            print(f"Container {container_name} does not exist. Creating.")
+        elif container.attrs["Image"] == image.id:
+            print(f"Container {container.name} already exists, reusing it")
+            return container
+        elif container.name != container_name:
+            # Renamed out of the way by an earlier update, so the name is already free
+            print(f"Container {container.name} was created from a different image, leaving it")
+        else:
+            print(f"Container {container_name} was created from a different image, replacing it")
+            if container.status in ("running", "paused"):
+                # Keep the running firmware in service until the swap, just out of the way.
+                container.rename(f"{container_name}-{container.short_id}")
+            else:
+                container.remove()
 
-        container = docker_client.containers.run(
-            f"{registry}/{image}:{version}",
-            detach=True,
+        print(f"Creating container with image {image.id}")
+        container = docker_client.containers.create(
+            image.id,
             name=container_name,
             labels=labels,
             volumes=volumes,
             environment=environment,
             network=network,
+            **limits,
         )
-        print(f"Container {container_name} started with id {container.id}")
-        return True
-    except docker.errors.APIError:
-        print(f"Image {image}:{version} not found")
-        if fallback_container:
-            print(f"Falling back to {fallback_container.name}")
-            fallback_container.restart()
-        else:
-            print(f"Image {image}:{version} not found and no fallback container available")
-        return False
+        print(f"Container {container_name} created with id {container.id}")
+        return container
+    except JobCanceled:
+        raise
+    except docker.errors.APIError as e:
+        print(f"Unable to stage {component['name']} version {component['version']}: {e}")
+        return None
     except Exception as e:
-        print(f"Error starting container: {e}")
-        return False
+        print(f"Error staging container: {e}")
+        return None
+
+
+def record_pull_sources(before, after, status_details):
+    """Report how much of a job's pulls the registry mirror served, from pull proxy stats taken
+    before and after staging."""
+    if not registry_mirror:
+        return
+    delta = {key: value - before.get(key, 0) for key, value in after.items()}
+    mirror_requests = delta.get("mirrorRequests", 0)
+    fallbacks = delta.get("fallbackRequests", 0)
+    if not mirror_requests and not fallbacks:
+        return
+    mirror_bytes = delta.get("mirrorBytes", 0)
+    origin_bytes = delta.get("originBytes", 0)
+    # Share of requests the mirror answered rather than falling back to the registry. Whether
+    # the mirror had the layer cached or fetched it upstream is in its own metrics.
+    served_ratio = mirror_requests / (mirror_requests + fallbacks)
+    status_details["pullMirrorBytes"] = str(mirror_bytes)
+    status_details["pullOriginBytes"] = str(origin_bytes)
+    status_details["mirrorServedRatio"] = f"{served_ratio:.3f}"
+    metrics.increment("mirror_requests", mirror_requests)
+    metrics.increment("mirror_fallbacks", fallbacks)
+    metrics.increment("mirror_bytes_served", mirror_bytes)
+    metrics.observe("mirror_served_ratio", served_ratio)
+
+
+def stage_containers(components, status_details, report_progress, control, limits):
+    """Stage every component concurrently, with at most pull_workers pulls at once.
+
+    Returns the containers in the same order as components, or None if any could not be staged.
+    Raises JobCanceled if the job is canceled, pulls in flight stop at their next progress event.
+    """
+    progress = MultiPullProgress()
+
+    def stage(component):
+        control.check()
+        stage_start = time.monotonic()
+
+        def on_progress(pull_progress):
+            control.check()
+            progress.track(component["name"], pull_progress)
+            report_progress(progress.status_details())
 
+        container = stage_container(component, on_progress, limits)
+        stage_seconds = time.monotonic() - stage_start
+        metrics.observe("image_stage_seconds", stage_seconds)
+        if len(components) > 1:
+            status_details[f"stageSeconds:{component['name']}"] = f"{stage_seconds:.3f}"
+        return container
 
-def stop_container():
-    docker_client = docker.from_env()
-    containers = docker_client.containers.list(filters={"label": [f"device={device_name}"]})
-    if not containers:
-        print("No containers found for this device")
+    with ThreadPoolExecutor(max_workers=min(pull_workers, len(components))) as executor:
+        futures = [executor.submit(stage, component) for component in components]
+        try:
+            containers = [future.result() for future in futures]
+        except JobCanceled:
+            for future in futures:
+                future.cancel()
+            raise
+
+    if progress.pulls:
+        status_details["pullBytes"] = str(progress.downloaded_bytes)
+        status_details["pullMBps"] = f"{progress.throughput / 1e6:.2f}"
+    if not all(containers):
         return None
-    # Really we should only have one container running per device. If ever we have more than one,
-    # stop all of them and (arbitrarily) pick the first one as the fallback.
+    return containers
+
+
+def all_digests_running(components):
+    if not all(component["digest"] for component in components):
+        return False
+    running_image_ids = {container.attrs["Image"] for container in get_running_containers()}
+    for component in components:
+        try:
+            image = docker_client.images.get(
+                f"{registry}/{component['image']}@{component['digest']}"
+            )
+        except docker.errors.ImageNotFound:
+            return False
+        if image.id not in running_image_ids:
+            return False
+    return True
+
+
+def load_firmware_state():
+    state = load_state("firmware.json", {})
+    firmware_state = state.get(device_name, {})
+    # Normalise state written when only single image firmware was supported
+    for role in ("active", "standby"):
+        names = firmware_state.get(role)
+        if names is None:
+            firmware_state[role] = []
+        elif isinstance(names, str):
+            firmware_state[role] = [names]
+    return firmware_state
+
+
+def save_firmware_state(active, standby):
+    state = load_state("firmware.json", {})
+    state[device_name] = {"active": active, "standby": standby}
+    save_state("firmware.json", state)
+
+
+def get_containers(container_names):
+    containers = []
+    for container_name in container_names:
+        container = container_index.get(container_name)
+        if container:
+            containers.append(container)
+        else:
+            print(f"Container {container_name} no longer exists")
+    return containers
+
+
+def get_running_containers():
+    return container_index.list(status="running")
+
+
+def demote_container(container):
+    """Take a container out of service, leaving it ready to be resumed as the warm standby."""
+    if standby_mode == "paused":
+        print(f"Pausing {container.name} as warm standby")
+        container.pause()
+    else:
+        print(f"Stopping {container.name} as warm standby")
+        container.stop()
+
+
+def resume_container(container):
+    """Bring a created, stopped or paused container into service. Returns the latency in seconds."""
+    resume_start = time.monotonic()
+    container.reload()
+    if container.status == "paused":
+        print(f"Unpausing {container.name}")
+        container.unpause()
+    elif container.status != "running":
+        print(f"Starting {container.name}")
+        container.start()
+    return time.monotonic() - resume_start
+
+
+def resume_containers(containers):
+    resume_start = time.monotonic()
     for container in containers:
+        resume_container(container)
+    return time.monotonic() - resume_start
+
+
+def retire_container(container):
+    container.reload()
+    if container.status == "paused":
+        container.unpause()
+    if container.status in ("running", "paused"):
         print(f"Stopping {container.name}")
         container.stop()
-    return containers[0]
 
 
-def job_handler_callback_start_firmware_update(job_id, job_document):
+def verify_health(containers, status_details, health_check, heartbeat_since, control):
+    """Wait until the newly started firmware is healthy, or the health check deadline passes."""
+    health_start = time.monotonic()
+    control.start_phase("health")
+    timeout = control.remaining(float(health_check.get("timeoutSeconds", health_timeout)))
+    min_uptime = float(health_check.get("minUptimeSeconds", health_min_uptime))
+    healthy, reason = wait_until_healthy(
+        container_index, containers, timeout, min_uptime, control.canceled
+    )
+    if healthy and heartbeat_since is not None:
+        # Single image firmware reports its version in the heartbeat, so wait for that version
+        version = containers[0].labels.get("version") if len(containers) == 1 else None
+        remaining = max(timeout - (time.monotonic() - health_start), 0)
+        if not heartbeat_monitor.wait(heartbeat_since, version, remaining, control.canceled):
+            healthy, reason = False, f"no heartbeat within {timeout}s"
+    if not healthy:
+        print(f"Firmware failed health check: {reason}")
+        status_details["healthCheck"] = reason
+        metrics.increment("health_check_failed")
+        return False
+
+    time_to_healthy = time.monotonic() - health_start
+    status_details["timeToHealthySeconds"] = f"{time_to_healthy:.3f}"
+    print(f"Firmware healthy after {time_to_healthy:.3f}s")
+    for container in containers:
+        labels = container.labels
+        metrics.observe(
+            f"time_to_healthy_seconds:{labels.get('component')}:{labels.get('version')}",
+            time_to_healthy,
+        )
+    return True
+
+
+def back_out_containers(containers, started_containers, active_containers, status_details):
+    """Stop and remove the new firmware containers and resume the previous firmware."""
+    for started_container in reversed(started_containers):
+        try:
+            started_container.stop()
+        except docker_errors as e:
+            print(f"Error stopping {started_container.name}: {e}")
+    for container in containers:
+        if container in started_containers or container.status == "created":
+            try:
+                container.remove(force=True)
+            except docker_errors:
+                pass
+    if active_containers:
+        print(f"Rolling back to {[c.name for c in active_containers]}")
+        rollback_latency = resume_containers(active_containers)
+        status_details["rollbackLatencyMs"] = f"{rollback_latency * 1000:.1f}"
+        print(f"Rolled back in {rollback_latency * 1000:.1f}ms")
+    else:
+        print("No fallback container available")
+
+
+def swap_containers(job_id, containers, status_details, health_check, control, resume_data=None):
+    """Swap the running firmware for the staged containers, started in the order given.
+
+    The running firmware becomes the warm standby, replacing the previous one, once the new
+    firmware has passed its health check. If a docker call fails or times out while the old
+    firmware is taken out of service, the staged containers are started or the warm-up limits
+    are lifted, or the new firmware is not healthy, the whole bundle is backed out and the old
+    firmware is resumed immediately. The downtime window runs from the moment the old firmware
+    is taken out of service until either the new or the old firmware is running.
+
+    resume_data is the journal data of a swap interrupted by a restart. The old firmware it
+    records is used as the standby, and new containers which are already running are left as is.
+    """
+    control.start_phase("swap")
+    firmware_state = load_firmware_state()
+    new_ids = {container.id for container in containers}
+    heartbeat_since = None
+    if health_check.get("heartbeat", health_heartbeat) and heartbeat_monitor:
+        heartbeat_since = heartbeat_monitor.arm()
+    downtime_start = time.monotonic()
+
+    if resume_data:
+        active_containers = get_containers(resume_data["active"])
+        shared_names = set(resume_data["shared"])
+    else:
+        # Containers shared with the running firmware, e.g. an unchanged bundle image, keep
+        # running.
+        running_containers = [c for c in get_running_containers() if c.id not in new_ids]
+        shared_names = {c.name for c in containers if c.status == "running"}
+        active_containers = [
+            c for name in firmware_state["active"] for c in running_containers if c.name == name
+        ] or running_containers
+        # Prefer the containers we know to be active as the standby, and stop any others.
+        for other_container in running_containers:
+            if other_container not in active_containers:
+                print(f"Stopping {other_container.name}")
+                other_container.stop()
+        journal.record(
+            job_id,
+            control.execution_number,
+            "swapping",
+            {
+                "containers": [c.name for c in containers],
+                "active": [c.name for c in active_containers],
+                "shared": sorted(shared_names),
+                "statusDetails": status_details,
+            },
+        )
+
+    # Every new container not shared with the old firmware is backed out on failure, including
+    # any started before a restart.
+    started_containers = [c for c in containers if c.name not in shared_names]
+    try:
+        for active_container in active_containers:
+            active_container.reload()
+            if active_container.status == "running":
+                demote_container(active_container)
+        for container in containers:
+            control.check()
+            resume_container(container)
+        downtime = time.monotonic() - downtime_start
+        print(f"Containers {[c.name for c in containers]} started")
+    except docker_errors as e:
+        print(f"Error swapping containers: {e}")
+        back_out_containers(containers, started_containers, active_containers, status_details)
+        status_details["downtimeSeconds"] = f"{time.monotonic() - downtime_start:.3f}"
+        return False
+    except JobCanceled:
+        back_out_containers(containers, started_containers, active_containers, status_details)
+        raise
+
+    if not resume_data:
+        status_details["downtimeSeconds"] = f"{downtime:.3f}"
+        print(f"Firmware downtime window {downtime:.3f}s")
+        journal.record(
+            job_id,
+            control.execution_number,
+            "started",
+            {
+                "containers": [c.name for c in containers],
+                "active": [c.name for c in active_containers],
+                "shared": sorted(shared_names),
+                "statusDetails": status_details,
+            },
+        )
+
+    if not verify_health(containers, status_details, health_check, heartbeat_since, control):
+        back_out_containers(containers, started_containers, active_containers, status_details)
+        control.check()
+        return False
+    try:
+        governor.lift_limits(docker_client, containers)
+    except docker_errors as e:
+        print(f"Unable to lift warm-up limits: {e}")
+        back_out_containers(containers, started_containers, active_containers, status_details)
+        return False
+
+    standby_names = firmware_state["standby"]
+    if active_containers:
+        keep_ids = new_ids | {c.id for c in active_containers}
+        for previous_standby in get_containers(standby_names):
+            if previous_standby.id not in keep_ids:
+                retire_container(previous_standby)
+        standby_names = [c.name for c in active_containers]
+    save_firmware_state([c.name for c in containers], standby_names)
+    return True
+
+
+def evict_unused_firmware():
+    firmware_state = load_firmware_state()
+    try:
+        image_cache.evict(
+            docker_client,
+            container_index.list(),
+            protected_names=set(firmware_state["active"] + firmware_state["standby"]),
+        )
+    except docker.errors.APIError as e:
+        print(f"Error evicting unused firmware: {e}")
+
+
+def job_handler_callback_start_firmware_update(
+    job_id, job_document, report_progress, control, phase, journal_data
+):
     print("job_handler_callback_start_firmware_update job_id: " + str(job_id))
     print("job_handler_callback_start_firmware_update job_document: " + str(job_document))
     success_status = False
-    if "version" in job_document:
-        version = job_document["version"]
-        fallback_container = stop_container()
-        success_status = start_container(version, fallback_container)
-    else:
+    status_details = journal_data.get("statusDetails", {})
+    if "version" not in job_document and "bundle" not in job_document:
         print("job_handler_callback_start_firmware_update missing version")
+        return success_status, status_details
+
+    try:
+        components = get_components(job_document)
+    except (KeyError, ValueError) as e:
+        print(f"job_handler_callback_start_firmware_update invalid job document: {e}")
+        return success_status, status_details
+
+    # A job interrupted by a restart carries on with the containers it had already staged
+    install_start = time.monotonic()
+    containers = None
+    resume_data = journal_data if phase in ("swapping", "started") else None
+    if phase:
+        containers = get_containers(journal_data["containers"])
+        if len(containers) == len(journal_data["containers"]):
+            print(f"Resuming job {job_id} from phase {phase}")
+            metrics.increment("job_resumed")
+        else:
+            containers = resume_data = None
+
+    if containers is None:
+        if "digest" in job_document:
+            status_details["imageDigest"] = job_document["digest"]
+        if all_digests_running(components):
+            print("Requested digests already running, nothing to do")
+            metrics.increment("update_noop")
+            status_details["noop"] = "true"
+            return True, status_details
+
+        resources = job_document.get("resources", {})
+        control.start_phase("defer")
+        defer_seconds = governor.defer_until_idle(resources, control)
+        if defer_seconds:
+            status_details["deferSeconds"] = f"{defer_seconds:.1f}"
+            metrics.observe("update_defer_seconds", defer_seconds)
+        pull_rate = governor.set_pull_rate(resources)
+        if pull_rate:
+            status_details["pullRateLimitBps"] = str(pull_rate)
+
+        archive = job_document.get("archive")
+        if archive:
+            control.start_phase("load")
+            if not load_components(components, archive, status_details, report_progress, control):
+                return success_status, status_details
+
+        control.start_phase("stage")
+        stage_start = time.monotonic()
+        pull_stats = governor.pull_stats()
+        containers = stage_containers(
+            components,
+            status_details,
+            report_progress,
+            control,
+            governor.warmup_limits(resources),
+        )
+        status_details["stageSeconds"] = f"{time.monotonic() - stage_start:.3f}"
+        record_pull_sources(pull_stats, governor.pull_stats(), status_details)
+        if not containers:
+            return success_status, status_details
+        if all(container.status == "running" for container in containers):
+            print("Requested images already running, nothing to do")
+            metrics.increment("update_noop")
+            status_details["noop"] = "true"
+            return True, status_details
+        journal.record(
+            job_id,
+            control.execution_number,
+            "staged",
+            {"containers": [c.name for c in containers], "statusDetails": status_details},
+        )
+
+    success_status = swap_containers(
+        job_id,
+        containers,
+        status_details,
+        job_document.get("healthCheck", {}),
+        control,
+        resume_data,
+    )
+    evict_unused_firmware()
+
+    install_seconds = time.monotonic() - install_start
+    if len(components) > 1:
+        status_details["bundleInstallSeconds"] = f"{install_seconds:.3f}"
+        metrics.observe("bundle_install_seconds", install_seconds)
     print(f"job_handler_callback_start_firmware_update complete with status {success_status}")
-    return success_status
+    return success_status, status_details
+
+
+def firmware_version(containers):
+    """Return the version the containers' images share, which is the firmware version they were
+    deployed as, or None if they have different versions."""
+    versions = {container.labels.get("version") for container in containers}
+    return versions.pop() if len(versions) == 1 else None
+
+
+def job_handler_callback_rollback_firmware(job_id, job_document, control, phase, journal_data):
+    print("job_handler_callback_rollback_firmware job_id: " + str(job_id))
+    firmware_state = load_firmware_state()
+    status_details = {}
+
+    # Rolling back twice would roll forward again, so check whether an interrupted rollback
+    # already got as far as saving the new firmware state.
+    if phase == "rolling_back" and firmware_state["active"] == journal_data["target"]:
+        print(f"Rollback for job {job_id} completed before restart")
+        status_details["activeContainers"] = ",".join(firmware_state["active"])
+        version = firmware_version(get_containers(firmware_state["active"]))
+        if version:
+            status_details["firmwareVersion"] = version
+        return True, status_details
+
+    standby_containers = get_containers(firmware_state["standby"])
+    if not standby_containers or len(standby_containers) != len(firmware_state["standby"]):
+        print("job_handler_callback_rollback_firmware no complete standby firmware available")
+        return False, status_details
+
+    control.start_phase("swap")
+    control.check()
+    journal.record(
+        job_id, control.execution_number, "rolling_back", {"target": firmware_state["standby"]}
+    )
+    # The active firmware swaps roles with the standby, so a roll forward is just as fast.
+    rollback_start = time.monotonic()
+    standby_ids = {c.id for c in standby_containers}
+    active_containers = [
+        c for c in get_containers(firmware_state["active"]) if c.id not in standby_ids
+    ]
+    for active_container in active_containers:
+        if active_container.status == "running":
+            demote_container(active_container)
+    try:
+        resume_containers(standby_containers)
+    except docker.errors.APIError as e:
+        print(f"Error resuming standby firmware: {e}")
+        resume_containers(active_containers)
+        return False, status_details
+    rollback_latency = time.monotonic() - rollback_start
+
+    save_firmware_state(
+        [c.name for c in standby_containers], [c.name for c in active_containers]
+    )
+    status_details["rollbackLatencyMs"] = f"{rollback_latency * 1000:.1f}"
+    status_details["activeContainers"] = ",".join(c.name for c in standby_containers)
+    # Reported so the cloud records the version rolled back to
+    version = firmware_version(standby_containers)
+    if version:
+        status_details["firmwareVersion"] = version
+    print(f"Rolled back to {firmware_state['standby']} in {rollback_latency * 1000:.1f}ms")
+    return True, status_details
 
 
-def job_handler_callback(job_id, job_document):
+def job_handler_callback(job_id, job_document, report_progress, control):
     print("job_handler_callback job_id: " + str(job_id))
     print("job_handler_callback job_document: " + str(job_document))
     success_status = False
-    if "operation" in job_document:
-        operation = job_document["operation"]
-        if operation == "Deploy-ROS-Firmware":
-            success_status = job_handler_callback_start_firmware_update(job_id, job_document)
-        else:
+    status_details = {}
+
+    phase, journal_data = journal.last_phase(job_id, control.execution_number)
+    if phase == "completed":
+        print(f"Job {job_id} completed before restart, reporting its recorded status")
+        return journal_data["success"], journal_data["statusDetails"]
+
+    try:
+        operation = job_document.get("operation")
+        # An archive install is a deployment whose images are loaded rather than pulled
+        if operation in ("Deploy-ROS-Firmware", "Install-ROS-Firmware-Archive"):
+            success_status, status_details = job_handler_callback_start_firmware_update(
+                job_id, job_document, report_progress, control, phase, journal_data
+            )
+        elif operation == "Rollback-ROS-Firmware":
+            success_status, status_details = job_handler_callback_rollback_firmware(
+                job_id, job_document, control, phase, journal_data
+            )
+        elif operation:
             print("job_handler_callback unknown operation: " + operation)
+    except JobCanceled as e:
+        print(f"Job {job_id} stopped: {e}")
+        metrics.increment("job_canceled")
+        status_details = {"error": str(e)}
+        # Free the space taken by any partly pulled images
+        evict_unused_firmware()
 
+    journal.record(
+        job_id,
+        control.execution_number,
+        "completed",
+        {"success": success_status, "statusDetails": status_details},
+    )
+    journal.prune()
     print(f"job_handler_callback complete with status {success_status}")
-    return success_status
+    metrics.dump()
+    return success_status, status_details
+
+
+def shadow_reconcile_callback(update_id, desired, report_progress, control):
+    """Install the firmware desired in the shadow, as if it came from a Deploy-ROS-Firmware job."""
+    job_document = {"operation": "Deploy-ROS-Firmware", "version": str(desired["firmwareVersion"])}
+    if desired.get("firmwareDigest"):
+        job_document["digest"] = desired["firmwareDigest"]
+    for key in ("healthCheck", "timeouts", "resources"):
+        if key in desired:
+            job_document[key] = desired[key]
+    return job_handler_callback(update_id, job_document, report_progress, control)
+
+
+def connect_docker():
+    global docker_client, container_index
+    while True:
+        try:
+            docker_client = docker.from_env(timeout=docker_timeout)
+            break
+        except docker.errors.DockerException as e:
+            print(f"Docker not available yet: {e}. Retrying in 1 second...")
+            time.sleep(1)
+    container_index = ContainerIndex(docker_client, device_name)
+    container_index.start()
 
 
 def get_mqtt_connection_with_retry(thing_name, key, cert, region):
@@ -140,7 +860,35 @@ if __name__ == "__main__":
     print(f"DEVICE_NAME {device_name}")
     print(f"thing_name {agent_thing_name}")
 
+    connect_docker()
+    journal = JobJournal(os.path.join(state_dir, "journal.db"))
+
+    pull_proxy = None
+    if pull_rate_limit is not None or registry_mirror:
+        pull_proxy = PullProxy(
+            ("127.0.0.1", pull_proxy_port),
+            int(pull_rate_limit or 0),
+            mirrors={registry: registry_mirror} if registry_mirror else None,
+        )
+        pull_proxy.start()
+    governor = UpdateGovernor(
+        pull_proxy,
+        warmup_cpus=float(os.environ.get("WARMUP_CPUS", "0")),
+        warmup_memory_mb=int(os.environ.get("WARMUP_MEMORY_MB", "0")),
+        idle_flag_file=os.environ.get("IDLE_FLAG_FILE"),
+        idle_topic=os.environ.get("IDLE_TOPIC"),
+        wait_for_idle=os.environ.get("WAIT_FOR_IDLE", "false").lower() == "true",
+    )
+
     mqtt_connection = get_mqtt_connection_with_retry(agent_thing_name, key, cert, region)
+    heartbeat_monitor = HeartbeatMonitor(
+        mqtt_connection, f"clients/{firmware_thing_name}/hello/world"
+    )
+    governor.subscribe(mqtt_connection)
 
-    job_handler = JobHandler(agent_thing_name, mqtt_connection, job_handler_callback)
-    job_handler.run()
+    if update_mode == "shadow":
+        reconciler = ShadowReconciler(agent_thing_name, mqtt_connection, shadow_reconcile_callback)
+        reconciler.run()
+    else:
+        job_handler = JobHandler(agent_thing_name, mqtt_connection, job_handler_callback)
+        job_handler.run()
@@ -0,0 +1,176 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+import docker
+
+# Container state for each docker event action which changes it
+EVENT_STATUS = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+}
+
+
+class ContainerIndex:
+    """In-memory index of the device's containers, kept up to date from the docker events stream.
+
+    Job handling reads container state from here instead of querying the daemon, which can be
+    slow to answer while it is busy pulling. Containers are keyed by id, by name, and by the
+    component and version labels set when they are created. A container renamed out of the way
+    by an update keeps its labels, so the newest container with a component and version is the
+    one indexed under them.
+    """
+
+    def __init__(self, docker_client, device_name):
+        self.docker_client = docker_client
+        self.device_name = device_name
+        self.lock = threading.Condition()
+        self.containers = {}
+        self.by_name = {}
+        self.by_component = {}
+        self.events_thread = None
+
+    def start(self):
+        since = self.sync()
+        self.events_thread = threading.Thread(
+            target=self.watch_events, args=(since,), name="container_events", daemon=True
+        )
+        self.events_thread.start()
+
+    def sync(self):
+        # Events are requested from just before the listing, so nothing is missed between the two
+        since = int(time.time())
+        containers = self.docker_client.containers.list(
+            all=True, filters={"label": [f"device={self.device_name}"]}
+        )
+        with self.lock:
+            self.containers, self.by_name, self.by_component = {}, {}, {}
+            for container in containers:
+                self.add(container)
+            self.lock.notify_all()
+        print(f"Indexed {len(containers)} containers for {self.device_name}")
+        return since
+
+    def watch_events(self, since):
+        while True:
+            try:
+                for event in self.docker_client.events(
+                    since=since,
+                    filters={"type": "container", "label": f"device={self.device_name}"},
+                    decode=True,
+                ):
+                    self.on_event(event)
+            except Exception as e:
+                print(f"Docker events stream failed with exception {e}. Resyncing...")
+            time.sleep(1)
+            try:
+                since = self.sync()
+            except Exception as e:
+                print(f"Container resync failed with exception {e}")
+
+    def on_event(self, event):
+        container_id = event["Actor"]["ID"]
+        action = event.get("Action", "")
+        if action == "destroy":
+            with self.lock:
+                self.discard(container_id)
+                self.lock.notify_all()
+        elif action in ("create", "rename") or container_id not in self.containers:
+            self.refresh(container_id)
+        elif action in EVENT_STATUS:
+            with self.lock:
+                state = self.containers[container_id].attrs["State"]
+                state["Status"] = EVENT_STATUS[action]
+                if action in ("start", "restart"):
+                    state.pop("Health", None)
+                self.lock.notify_all()
+        elif action.startswith("health_status:"):
+            with self.lock:
+                state = self.containers[container_id].attrs["State"]
+                state.setdefault("Health", {})["Status"] = action.split(":", 1)[1].strip()
+                self.lock.notify_all()
+
+    def refresh(self, container_id):
+        try:
+            container = self.docker_client.containers.get(container_id)
+        except docker.errors.NotFound:
+            return
+        with self.lock:
+            self.add(container)
+            self.lock.notify_all()
+
+    @staticmethod
+    def component_key(container):
+        labels = container.labels
+        if "component" not in labels:
+            return None
+        return (labels["component"], labels.get("version"))
+
+    @staticmethod
+    def created(container):
+        # RFC 3339 timestamps in UTC, which sort as strings
+        return container.attrs.get("Created", "")
+
+    def add(self, container):
+        # Called with the lock held. Replaces any earlier copy, which may have another name.
+        self.discard(container.id)
+        self.containers[container.id] = container
+        self.by_name[container.name] = container.id
+        key = self.component_key(container)
+        if key:
+            current = self.containers.get(self.by_component.get(key))
+            if not current or self.created(container) >= self.created(current):
+                self.by_component[key] = container.id
+
+    def discard(self, container_id):
+        # Called with the lock held
+        container = self.containers.pop(container_id, None)
+        if not container:
+            return
+        if self.by_name.get(container.name) == container_id:
+            del self.by_name[container.name]
+        key = self.component_key(container)
+        if key and self.by_component.get(key) == container_id:
+            del self.by_component[key]
+            # e.g. the previous firmware's container, renamed out of the way, takes over
+            others = [c for c in self.containers.values() if self.component_key(c) == key]
+            if others:
+                self.by_component[key] = max(others, key=self.created).id
+
+    def wait_for(self, predicate, timeout):
+        """Wait until predicate() returns something other than None, re-evaluating it whenever a
+        container changes and at least every poll interval. Returns that result, or None if the
+        timeout expires first."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                result = predicate()
+                remaining = deadline - time.monotonic()
+                if result is not None or remaining <= 0:
+                    return result
+                self.lock.wait(min(remaining, 0.5))
+
+    def get_by_id(self, container_id):
+        with self.lock:
+            return self.containers.get(container_id)
+
+    def get(self, name):
+        with self.lock:
+            return self.containers.get(self.by_name.get(name))
+
+    def find(self, component, version):
+        with self.lock:
+            return self.containers.get(self.by_component.get((component, str(version))))
+
+    def list(self, status=None):
+        with self.lock:
+            containers = list(self.containers.values())
+        if status:
+            containers = [container for container in containers if container.status == status]
+        return containers
@@ -1,12 +1,92 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import os
+import socket
+import threading
+import time
 from awscrt import io
-from awsiot.greengrass_discovery import DiscoveryClient
+from awsiot.greengrass_discovery import DiscoveryClient, DiscoverResponse
 from awsiot import mqtt_connection_builder
+from metrics import metrics
+from state_store import load_state, save_state
+
+# Delay between starting connection attempts to successive Greengrass core endpoints
+CONNECT_STAGGER_SECONDS = 0.25
+# How long a TCP connection to a Greengrass core endpoint is waited for
+PROBE_TIMEOUT_SECONDS = 5
+# How long cached discovery results are used without waiting for a fresh discovery
+DISCOVERY_CACHE_TTL_SECONDS = float(os.environ.get("DISCOVERY_CACHE_TTL", "86400"))
+
+
+def discover_response_to_payload(discover_response):
+    return {
+        "GGGroups": [
+            {
+                "GGGroupId": gg_group.gg_group_id,
+                "Cores": [
+                    {
+                        "thingArn": gg_core.thing_arn,
+                        "Connectivity": [
+                            {
+                                "Id": connectivity_info.id,
+                                "HostAddress": connectivity_info.host_address,
+                                "PortNumber": connectivity_info.port,
+                                "Metadata": connectivity_info.metadata,
+                            }
+                            for connectivity_info in gg_core.connectivity
+                        ],
+                    }
+                    for gg_core in gg_group.cores
+                ],
+                "CAs": gg_group.certificate_authorities,
+            }
+            for gg_group in discover_response.gg_groups
+        ]
+    }
+
+
+def load_cached_discovery(thing_name):
+    """Return the cached discovery response for thing_name and its age in seconds, or (None, None)."""
+    cached = load_state(f"discovery-{thing_name}.json", None)
+    if not cached:
+        return None, None
+    try:
+        discover_response = DiscoverResponse.from_payload(cached["payload"])
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Ignoring unreadable discovery cache: {e}")
+        return None, None
+    return discover_response, time.time() - cached["fetched_at"]
+
+
+def discover(discovery_client, thing_name):
+    print("Performing greengrass discovery...")
+    discover_response = discovery_client.discover(thing_name).result()
+    save_state(
+        f"discovery-{thing_name}.json",
+        {"fetched_at": time.time(), "payload": discover_response_to_payload(discover_response)},
+    )
+    return discover_response
+
+
+def refresh_discovery_in_background(discovery_client, thing_name):
+    def refresh():
+        try:
+            discover(discovery_client, thing_name)
+            print("Refreshed greengrass discovery cache")
+        except Exception as e:
+            print(f"Background discovery failed with exception {e}")
+
+    threading.Thread(target=refresh, name="discovery_refresh", daemon=True).start()
 
 
 def get_mqtt_connection(thing_name, key, cert, region):
+    """Connect to a Greengrass core, using cached discovery results when they are fresh enough.
+
+    A fresh cache lets the agent connect without waiting on the cloud, and discovery is then
+    refreshed in the background. Live discovery is only waited for on a cache miss or when no
+    cached endpoint is reachable, and a stale cache is still tried if live discovery fails.
+    """
     tls_options = io.TlsContextOptions.create_client_with_mtls_from_path(cert, key)
     tls_context = io.ClientTlsContext(tls_options)
 
@@ -14,7 +94,6 @@ def get_mqtt_connection(thing_name, key, cert, region):
 
     proxy_options = None
 
-    print("Performing greengrass discovery...")
     discovery_client = DiscoveryClient(
         io.ClientBootstrap.get_or_create_static_default(),
         socket_options,
@@ -23,9 +102,30 @@ def get_mqtt_connection(thing_name, key, cert, region):
         None,
         proxy_options,
     )
-    resp_future = discovery_client.discover(thing_name)
-    discover_response = resp_future.result()
 
+    cached_response, cache_age = load_cached_discovery(thing_name)
+    if cached_response and cache_age < DISCOVERY_CACHE_TTL_SECONDS:
+        print(f"Using greengrass discovery cached {cache_age:.0f}s ago")
+        metrics.increment("discovery_cache_hit")
+        try:
+            mqtt_connection = connect_to_cores(thing_name, key, cert, cached_response)
+            refresh_discovery_in_background(discovery_client, thing_name)
+            return mqtt_connection
+        except RuntimeError as e:
+            print(f"Connecting from discovery cache failed: {e}")
+    metrics.increment("discovery_cache_miss")
+
+    try:
+        discover_response = discover(discovery_client, thing_name)
+    except Exception as e:
+        if not cached_response:
+            raise
+        print(f"Greengrass discovery failed with exception {e}, trying stale cache")
+        discover_response = cached_response
+    return connect_to_cores(thing_name, key, cert, discover_response)
+
+
+def connect_to_cores(thing_name, key, cert, discover_response):
     def on_connection_interupted(connection, error, **kwargs):
         print("connection interrupted with error {}".format(error))
 
@@ -36,33 +136,105 @@ def get_mqtt_connection(thing_name, key, cert, region):
             )
         )
 
-    for gg_group in discover_response.gg_groups:
-        for gg_core in gg_group.cores:
-            for connectivity_info in gg_core.connectivity:
-                try:
-                    print(
-                        f"Trying core {gg_core.thing_arn} at host {connectivity_info.host_address} port {connectivity_info.port}"
-                    )
-                    mqtt_connection = mqtt_connection_builder.mtls_from_path(
-                        endpoint=connectivity_info.host_address,
-                        port=connectivity_info.port,
-                        cert_filepath=cert,
-                        pri_key_filepath=key,
-                        ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
-                        on_connection_interrupted=on_connection_interupted,
-                        on_connection_resumed=on_connection_resumed,
-                        client_id=thing_name,
-                        clean_session=False,
-                        keep_alive_secs=30,
-                    )
-
-                    connect_future = mqtt_connection.connect()
-                    connect_future.result()
-                    print("Connected!")
-                    return mqtt_connection
-
-                except Exception as e:
-                    print("Connection failed with exception {}".format(e))
-                    continue
+    candidates = [
+        (gg_group, gg_core, connectivity_info)
+        for gg_group in discover_response.gg_groups
+        for gg_core in gg_group.cores
+        for connectivity_info in gg_core.connectivity
+    ]
+
+    def build_connection(gg_group, gg_core, connectivity_info):
+        print(
+            f"Trying core {gg_core.thing_arn} at host {connectivity_info.host_address} port {connectivity_info.port}"
+        )
+        return mqtt_connection_builder.mtls_from_path(
+            endpoint=connectivity_info.host_address,
+            port=connectivity_info.port,
+            cert_filepath=cert,
+            pri_key_filepath=key,
+            ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
+            on_connection_interrupted=on_connection_interupted,
+            on_connection_resumed=on_connection_resumed,
+            client_id=thing_name,
+            clean_session=False,
+            keep_alive_secs=30,
+        )
 
+    race_start = time.monotonic()
+    while candidates:
+        candidate = race_connections(candidates, probe_core)
+        try:
+            mqtt_connection = build_connection(*candidate)
+            mqtt_connection.connect().result()
+        except Exception as e:
+            print(f"Connection failed with exception {e}")
+            candidates = [other for other in candidates if other is not candidate]
+            continue
+        gg_group, gg_core, connectivity_info = candidate
+        time_to_connected = time.monotonic() - race_start
+        metrics.observe("mqtt_time_to_connected_seconds", time_to_connected)
+        print(
+            f"Connected to core {gg_core.thing_arn} at {connectivity_info.host_address}:{connectivity_info.port} "
+            f"in {time_to_connected:.3f}s"
+        )
+        return mqtt_connection
     raise RuntimeError("All connection attempts failed")
+
+
+def probe_core(gg_group, gg_core, connectivity_info, timeout=PROBE_TIMEOUT_SECONDS):
+    """Open and close a TCP connection to a core endpoint, raising OSError if it is unreachable."""
+    address = (connectivity_info.host_address, connectivity_info.port)
+    with socket.create_connection(address, timeout=timeout):
+        pass
+
+
+def race_connections(candidates, probe, stagger=CONNECT_STAGGER_SECONDS):
+    """Probe every candidate endpoint concurrently and return the first one that answers.
+
+    In the style of "happy eyeballs", probes start stagger seconds apart in discovery order, or
+    straight away when an earlier probe fails, so one unreachable address can't stall startup
+    until its TCP timeout.
+
+    Only a plain TCP connection is raced, and the caller sends an MQTT CONNECT to the winner
+    alone. Every endpoint would connect with the thing's client id and persistent session, and a
+    broker hands the session to the latest client to connect with it. Disconnecting an awscrt
+    connection whose CONNACK is still pending doesn't abort its CONNECT, so racing MQTT
+    connections would let a loser take the session over.
+    """
+    condition = threading.Condition()
+    state = {"winner": None, "failed": 0}
+
+    def run_probe(candidate):
+        try:
+            probe(*candidate)
+        except Exception as e:
+            print(f"Probe failed with exception {e}")
+            with condition:
+                state["failed"] += 1
+                condition.notify_all()
+            return
+        with condition:
+            if state["winner"] is None:
+                state["winner"] = candidate
+            condition.notify_all()
+
+    next_index = 0
+    next_start = time.monotonic()
+    with condition:
+        while state["winner"] is None:
+            if state["failed"] == len(candidates):
+                raise RuntimeError("All connection attempts failed")
+            # Start the next probe once its stagger delay has passed, or as soon as every probe
+            # in flight has failed.
+            in_flight = next_index - state["failed"]
+            if next_index < len(candidates) and (time.monotonic() >= next_start or in_flight == 0):
+                candidate = candidates[next_index]
+                next_index += 1
+                next_start = time.monotonic() + stagger
+                threading.Thread(target=run_probe, args=(candidate,), daemon=True).start()
+                continue
+            if next_index < len(candidates):
+                condition.wait(max(next_start - time.monotonic(), 0))
+            else:
+                condition.wait()
+    return state["winner"]
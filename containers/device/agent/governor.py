@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+import threading
+import time
+from awscrt import mqtt
+
+
+class UpdateGovernor:
+    """Keeps an update from starving the robot's own workload.
+
+    - Registry pulls go through the PullProxy, limited to pull_rate bytes per second.
+    - New containers are created with warm-up CPU and memory limits, which are lifted once the
+      firmware has passed its health check.
+    - Jobs can be deferred until the robot is idle, signalled by idle_flag_file existing or by
+      the latest message on idle_topic, e.g. {"idle": true} from a ROS node.
+
+    A job can override any of these in its document:
+
+        "resources": {"pullBytesPerSecond": 2000000, "warmupCpus": 0.5, "warmupMemoryMB": 512,
+                      "waitForIdle": true, "maxDeferSeconds": 600}
+    """
+
+    def __init__(
+        self,
+        pull_proxy=None,
+        warmup_cpus=0,
+        warmup_memory_mb=0,
+        idle_flag_file=None,
+        idle_topic=None,
+        wait_for_idle=False,
+    ):
+        self.pull_proxy = pull_proxy
+        self.pull_rate = pull_proxy.limiter.rate if pull_proxy else 0
+        self.warmup_cpus = warmup_cpus
+        self.warmup_memory_mb = warmup_memory_mb
+        self.idle_flag_file = idle_flag_file
+        self.idle_topic = idle_topic
+        self.wait_for_idle = wait_for_idle
+        self.condition = threading.Condition()
+        self.idle = False
+
+    def subscribe(self, mqtt_connection):
+        if not self.idle_topic:
+            return
+        subscribe_future, _ = mqtt_connection.subscribe(
+            topic=self.idle_topic, qos=mqtt.QoS.AT_LEAST_ONCE, callback=self.on_idle_message
+        )
+        subscribe_future.result()
+        print(f"Subscribed to robot idle state on {self.idle_topic}")
+
+    def on_idle_message(self, topic, payload, **kwargs):
+        try:
+            message = json.loads(payload)
+            idle = bool(message.get("idle")) if isinstance(message, dict) else bool(message)
+        except ValueError:
+            idle = payload.strip().lower() in (b"true", b"1", b"idle")
+        with self.condition:
+            self.idle = idle
+            self.condition.notify_all()
+
+    def is_idle(self):
+        if self.idle_flag_file and os.path.exists(self.idle_flag_file):
+            return True
+        return self.idle_topic is not None and self.idle
+
+    def defer_until_idle(self, resources, control):
+        """Wait until the robot is idle, if the job asks to. Returns the seconds waited.
+
+        Gives up waiting after maxDeferSeconds and goes ahead anyway. Raises JobCanceled if the
+        job is canceled meanwhile.
+        """
+        if not resources.get("waitForIdle", self.wait_for_idle):
+            return 0
+        if not self.idle_flag_file and not self.idle_topic:
+            print("Job asks to wait for idle, but no idle signal is configured")
+            return 0
+        defer_start = time.monotonic()
+        max_defer = float(resources.get("maxDeferSeconds", float("inf")))
+        with self.condition:
+            while not self.is_idle() and time.monotonic() - defer_start < max_defer:
+                control.check()
+                # The flag file is polled, the topic wakes the wait straight away
+                self.condition.wait(1)
+        deferred = time.monotonic() - defer_start
+        if deferred > 1:
+            print(f"Deferred update for {deferred:.1f}s until the robot was idle")
+        return deferred
+
+    def set_pull_rate(self, resources):
+        """Apply the job's pull budget, or the default. Returns the budget in bytes per second."""
+        if not self.pull_proxy:
+            return 0
+        rate = int(resources.get("pullBytesPerSecond", self.pull_rate))
+        self.pull_proxy.limiter.set_rate(rate)
+        return rate
+
+    def pull_stats(self):
+        """Pull proxy request and byte counts by source, see PullProxy.stats."""
+        return self.pull_proxy.stats() if self.pull_proxy else {}
+
+    def warmup_limits(self, resources):
+        """Return the docker create arguments limiting a new container while it warms up."""
+        limits = {}
+        cpus = float(resources.get("warmupCpus", self.warmup_cpus))
+        memory_mb = int(resources.get("warmupMemoryMB", self.warmup_memory_mb))
+        if cpus:
+            limits["cpu_period"] = 100000
+            limits["cpu_quota"] = int(cpus * 100000)
+        if memory_mb:
+            limits["mem_limit"] = memory_mb * 1024 * 1024
+            limits["memswap_limit"] = -1
+        return limits
+
+    def lift_limits(self, docker_client, containers):
+        """Give containers which passed their health check the whole device again."""
+        memory = None
+        for container in containers:
+            host_config = container.attrs.get("HostConfig", {})
+            if not host_config.get("CpuQuota") and not host_config.get("Memory"):
+                continue
+            if memory is None:
+                memory = docker_client.info()["MemTotal"]
+            print(f"Lifting warm-up limits of {container.name}")
+            container.update(cpu_quota=-1, mem_limit=memory, memswap_limit=-1)
@@ -0,0 +1,108 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import threading
+import time
+from awscrt import mqtt
+
+
+def wait_until_healthy(container_index, containers, timeout, min_uptime, canceled=None):
+    """Wait for newly started containers to become healthy, driven by docker events.
+
+    Containers with a HEALTHCHECK must report healthy. Containers without one must still be
+    running min_uptime seconds after the wait began. The wait ends early once the canceled
+    event is set. Returns (healthy, reason).
+
+    The index may not have caught up with the containers just started, and still list one as
+    created, exited when it is reused, or not at all. A container only fails the check by not
+    running once it has been seen running.
+    """
+    start_time = time.monotonic()
+    started = set()
+
+    def check():
+        if canceled is not None and canceled.is_set():
+            return False, "canceled"
+        pending = False
+        for container in containers:
+            current = container_index.get_by_id(container.id)
+            if current and current.status == "running":
+                started.add(container.id)
+            if container.id not in started:
+                pending = True
+                continue
+            if not current:
+                return False, f"{container.name} was removed"
+            if current.status != "running":
+                return False, f"{container.name} is {current.status}"
+            if current.attrs["Config"].get("Healthcheck"):
+                health = current.attrs["State"].get("Health", {}).get("Status")
+                if health == "unhealthy":
+                    return False, f"{container.name} is unhealthy"
+                if health != "healthy":
+                    pending = True
+            elif time.monotonic() - start_time < min_uptime:
+                pending = True
+        return None if pending else (True, "healthy")
+
+    result = container_index.wait_for(check, timeout)
+    if result is None:
+        return False, f"not healthy after {timeout}s"
+    return result
+
+
+class HeartbeatMonitor:
+    """Watches the heartbeat topic the firmware publishes to, so an update can wait for the new
+    firmware's first heartbeat."""
+
+    def __init__(self, mqtt_connection, topic):
+        self.mqtt_connection = mqtt_connection
+        self.topic = topic
+        self.condition = threading.Condition()
+        self.subscribed = False
+        self.heartbeats = []
+
+    def subscribe(self):
+        if self.subscribed:
+            return
+        subscribe_future, _ = self.mqtt_connection.subscribe(
+            topic=self.topic, qos=mqtt.QoS.AT_MOST_ONCE, callback=self.on_heartbeat
+        )
+        subscribe_future.result()
+        self.subscribed = True
+        print(f"Subscribed to heartbeats on {self.topic}")
+
+    def on_heartbeat(self, topic, payload, **kwargs):
+        try:
+            version = json.loads(payload).get("version")
+        except ValueError:
+            version = None
+        with self.condition:
+            self.heartbeats.append((time.monotonic(), version))
+            del self.heartbeats[:-10]
+            self.condition.notify_all()
+
+    def arm(self):
+        """Subscribe if needed and return a marker; only heartbeats after it are waited for."""
+        self.subscribe()
+        return time.monotonic()
+
+    def wait(self, since, version, timeout, canceled=None):
+        """Wait for a heartbeat received after since, from the given version if it is not None.
+        Gives up early once the canceled event is set."""
+
+        def received():
+            return any(
+                received_at > since and (version is None or str(heartbeat_version) == str(version))
+                for received_at, heartbeat_version in self.heartbeats
+            )
+
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not received():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (canceled is not None and canceled.is_set()):
+                    return False
+                self.condition.wait(min(remaining, 0.5))
+            return True
@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+import docker
+from state_store import load_state, save_state
+from metrics import metrics
+
+
+class ImageCache:
+    """Keeps the firmware image store on the device within bounds.
+
+    The images of the most recently used firmware versions are kept, up to keep_versions of them,
+    along with the images of the active and standby containers. A bundle version has several
+    images, grouped by their {registry}/{image}:{version} tags. Older images are evicted, least recently used
+    first, and further images are evicted while the image store is over disk_budget_bytes. Images
+    in use by the active or standby container are never evicted.
+    """
+
+    def __init__(self, registry, keep_versions, disk_budget_bytes):
+        self.registry = registry
+        self.keep_versions = keep_versions
+        self.disk_budget_bytes = disk_budget_bytes
+        self.lock = threading.Lock()
+        self.last_used = load_state("image_cache.json", {})
+
+    def touch(self, image_id):
+        with self.lock:
+            self.last_used[image_id] = time.time()
+            save_state("image_cache.json", self.last_used)
+
+    def is_firmware_image(self, image):
+        # Both are null for an image whose tags and digests were all removed
+        refs = (image.attrs.get("RepoTags") or []) + (image.attrs.get("RepoDigests") or [])
+        return any(ref.startswith(f"{self.registry}/") for ref in refs)
+
+    def image_versions(self, image):
+        """Return the firmware versions an image is tagged with. An image pulled by digest alone is
+        a version of its own."""
+        versions = {
+            tag.rsplit(":", 1)[1]
+            for tag in image.attrs.get("RepoTags") or []
+            if tag.startswith(f"{self.registry}/")
+        }
+        return versions or {image.id}
+
+    def remove_unused_containers(self, containers, protected_names):
+        remaining = []
+        for container in containers:
+            if container.name in protected_names or container.status in ("running", "paused"):
+                remaining.append(container)
+                continue
+            print(f"Removing unused container {container.name}")
+            try:
+                container.remove()
+                metrics.increment("containers_removed")
+            except docker.errors.APIError as e:
+                print(f"Unable to remove container {container.name}: {e}")
+                remaining.append(container)
+        return remaining
+
+    def remove_image(self, docker_client, image):
+        print(f"Evicting image {image.id} {image.tags}")
+        try:
+            docker_client.images.remove(image.id, force=True)
+        except docker.errors.APIError as e:
+            print(f"Unable to evict image {image.id}: {e}")
+            return False
+        metrics.increment("images_evicted")
+        with self.lock:
+            self.last_used.pop(image.id, None)
+        return True
+
+    def get_disk_usage(self, docker_client):
+        return docker_client.df().get("LayersSize", 0)
+
+    def evict(self, docker_client, containers, protected_names):
+        """Evict unused firmware given the device's containers, and the names of the active and
+        standby containers."""
+        containers = self.remove_unused_containers(containers, protected_names)
+        protected_images = {container.attrs["Image"] for container in containers}
+
+        images = [image for image in docker_client.images.list() if self.is_firmware_image(image)]
+        with self.lock:
+            images.sort(key=lambda image: self.last_used.get(image.id, 0), reverse=True)
+
+        # Protected images don't count towards keep_versions, so the rollback version is always
+        # kept in addition to the most recently used ones.
+        candidates = [image for image in images if image.id not in protected_images]
+        kept_versions = []
+        for image in candidates:
+            for version in sorted(self.image_versions(image) - set(kept_versions)):
+                if len(kept_versions) < self.keep_versions:
+                    kept_versions.append(version)
+        kept = []
+        for image in candidates:
+            if self.image_versions(image) & set(kept_versions):
+                kept.append(image)
+            else:
+                self.remove_image(docker_client, image)
+        candidates = kept
+
+        if self.disk_budget_bytes:
+            usage = self.get_disk_usage(docker_client)
+            while usage > self.disk_budget_bytes and candidates:
+                print(f"Image store uses {usage} bytes, over budget of {self.disk_budget_bytes}")
+                self.remove_image(docker_client, candidates.pop())
+                usage = self.get_disk_usage(docker_client)
+            metrics.observe("image_store_bytes", usage)
+
+        pruned = docker_client.images.prune(filters={"dangling": True})
+        reclaimed = pruned.get("SpaceReclaimed") or 0
+        if reclaimed:
+            print(f"Pruned dangling images, reclaimed {reclaimed} bytes")
+        metrics.increment("dangling_bytes_reclaimed", reclaimed)
+
+        with self.lock:
+            save_state("image_cache.json", self.last_used)
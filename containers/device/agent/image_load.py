@@ -0,0 +1,103 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import hashlib
+import os
+import time
+import urllib.request
+from urllib.parse import urlsplit
+from image_pull import ProgressSummary
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class LoadProgress(ProgressSummary):
+    """Progress of an archive being streamed into docker load, in archive bytes read."""
+
+    phase = "loading"
+
+    def __init__(self, total_bytes):
+        self.start_time = time.monotonic()
+        self.downloaded_bytes = 0
+        self.total_bytes = total_bytes
+
+
+def open_archive(url, timeout=60):
+    """Open a file path, file:// or http(s):// URL for streaming. Returns (stream, size)."""
+    parts = urlsplit(url)
+    if parts.scheme in ("http", "https"):
+        response = urllib.request.urlopen(url, timeout=timeout)
+        return response, int(response.headers.get("Content-Length") or 0)
+    path = parts.path if parts.scheme == "file" else url
+    return open(path, "rb"), os.path.getsize(path)
+
+
+def archive_chunks(stream, sha256, progress, progress_callback=None, check=None):
+    """Yield the archive from stream in chunks, decompressing zstd, for docker load.
+
+    The sha256 of the archive as stored is computed while streaming. The last chunk is held back
+    until it has been verified, so on a mismatch docker load only ever sees a truncated archive
+    and loads nothing. check is called before every chunk and may raise to abort the load.
+    """
+    digest = hashlib.sha256()
+    decompressor = None
+    held = None
+    first = True
+    while True:
+        if check:
+            check()
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        progress.downloaded_bytes += len(chunk)
+        if progress_callback:
+            progress_callback(progress)
+        if first:
+            first = False
+            # The daemon can load gzip, bzip2 and xz archives itself, older daemons can't load zstd
+            if chunk.startswith(ZSTD_MAGIC) and zstandard:
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+        data = decompressor.decompress(chunk) if decompressor else chunk
+        if not data:
+            continue
+        if held:
+            yield held
+        held = data
+
+    if digest.hexdigest() != sha256.lower().removeprefix("sha256:"):
+        raise ChecksumMismatch(f"archive sha256 is {digest.hexdigest()}, expected {sha256}")
+    if held:
+        yield held
+    if decompressor:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+def load_archive(docker_client, url, sha256, progress_callback=None, check=None):
+    """Stream a docker save archive into docker load without holding it in memory.
+
+    Returns the loaded images and the final LoadProgress.
+    """
+    stream, size = open_archive(url)
+    progress = LoadProgress(size)
+    with stream:
+        images = docker_client.images.load(
+            archive_chunks(stream, sha256, progress, progress_callback, check)
+        )
+    print(
+        f"Loaded {[tag for image in images for tag in image.tags]} from {url}, "
+        f"{progress.downloaded_bytes} bytes in {progress.elapsed:.1f}s"
+    )
+    return images, progress
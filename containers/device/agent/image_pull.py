@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+import docker
+
+
+class ProgressSummary:
+    """Job status details derived from downloaded_bytes, total_bytes and start_time."""
+
+    phase = "pulling"
+
+    def status_details(self):
+        downloaded = self.downloaded_bytes
+        total = self.total_bytes
+        throughput = self.throughput
+        details = {
+            "phase": self.phase,
+            "bytes": str(downloaded),
+            "totalBytes": str(total),
+            "MBps": f"{throughput / 1e6:.2f}",
+        }
+        # Totals are only known for layers the daemon has started downloading, so the percentage
+        # is an estimate until every layer has reported in.
+        if total:
+            details["percent"] = f"{100.0 * downloaded / total:.1f}"
+        if throughput > 0 and total > downloaded:
+            details["etaSeconds"] = f"{(total - downloaded) / throughput:.0f}"
+        return details
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        return self.downloaded_bytes / elapsed if elapsed > 0 else 0.0
+
+
+class PullProgress(ProgressSummary):
+    """Tracks download progress of an image pull from the docker pull progress stream.
+
+    Byte counts are compressed layer bytes as reported by the daemon while downloading, layers
+    which already exist locally are counted separately and don't contribute to throughput.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.layers = {}
+        self.cached_layers = set()
+
+    def update(self, event):
+        layer_id = event.get("id")
+        status = event.get("status", "")
+        if not layer_id:
+            return
+        if status == "Already exists":
+            self.cached_layers.add(layer_id)
+        elif status == "Downloading":
+            detail = event.get("progressDetail") or {}
+            layer = self.layers.setdefault(layer_id, {"current": 0, "total": 0})
+            layer["current"] = detail.get("current", layer["current"])
+            layer["total"] = detail.get("total", layer["total"])
+        elif status == "Download complete" and layer_id in self.layers:
+            layer = self.layers[layer_id]
+            layer["current"] = max(layer["current"], layer["total"])
+
+    @property
+    def downloaded_bytes(self):
+        # Copy the layers, progress may be summarised from another pull's thread
+        return sum(layer["current"] for layer in list(self.layers.values()))
+
+    @property
+    def total_bytes(self):
+        return sum(layer["total"] for layer in list(self.layers.values()))
+
+    def print_summary(self, image_ref):
+        for layer_id, layer in self.layers.items():
+            print(f"  Layer {layer_id}: {layer['current']} bytes")
+        for layer_id in self.cached_layers:
+            print(f"  Layer {layer_id}: already present")
+        print(
+            f"Pulled {image_ref}: {self.downloaded_bytes} bytes in {self.elapsed:.1f}s "
+            f"({self.throughput / 1e6:.2f} MB/s)"
+        )
+
+
+class MultiPullProgress(ProgressSummary):
+    """Combined progress of several concurrent pulls, e.g. the images of a firmware bundle."""
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.pulls = {}
+
+    def track(self, name, progress):
+        with self.lock:
+            self.pulls[name] = progress
+
+    @property
+    def downloaded_bytes(self):
+        with self.lock:
+            return sum(progress.downloaded_bytes for progress in self.pulls.values())
+
+    @property
+    def total_bytes(self):
+        with self.lock:
+            return sum(progress.total_bytes for progress in self.pulls.values())
+
+
+def pull_image(docker_client, repository, tag, progress_callback=None):
+    """Pull an image using the streaming API, calling progress_callback with a PullProgress
+    after every progress event. tag may be a tag or a sha256 digest. Returns the image and the
+    final PullProgress."""
+    separator = "@" if tag.startswith("sha256:") else ":"
+    image_ref = f"{repository}{separator}{tag}"
+    progress = PullProgress()
+    for event in docker_client.api.pull(repository, tag=tag, stream=True, decode=True):
+        if "error" in event:
+            raise docker.errors.APIError(f"Pull of {image_ref} failed: {event['error']}")
+        progress.update(event)
+        if progress_callback:
+            progress_callback(progress)
+    progress.print_summary(image_ref)
+    return docker_client.images.get(image_ref), progress
@@ -0,0 +1,75 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+
+
+class JobCanceled(Exception):
+    """Raised in the job callback once its job has been canceled or has run out of time."""
+
+
+class JobControl:
+    """Shared between JobHandler and the job callback running in the worker thread.
+
+    The job document may limit how long the whole job and each of its phases take, in seconds:
+
+        "timeouts": {"jobSeconds": 1800, "stageSeconds": 900, "swapSeconds": 60,
+                     "healthSeconds": 120}
+
+    The callback calls start_phase as it moves through the job and check wherever it can safely
+    stop. JobHandler cancels the job when it is canceled in the cloud or a deadline passes.
+    """
+
+    def __init__(self, job_id, job_document, default_job_timeout, execution_number=None):
+        self.job_id = job_id
+        # Set for IoT Jobs executions, a retried job has a higher one
+        self.execution_number = execution_number
+        timeouts = job_document.get("timeouts") or {}
+        self.phase_timeouts = {
+            name[: -len("Seconds")]: float(seconds)
+            for name, seconds in timeouts.items()
+            if name.endswith("Seconds") and name != "jobSeconds"
+        }
+        self.job_timeout = float(timeouts.get("jobSeconds", default_job_timeout))
+        self.job_deadline = time.monotonic() + self.job_timeout
+        self.phase = None
+        self.phase_deadline = None
+        self.canceled = threading.Event()
+        self.reason = None
+        # Whether the job's final status should still be published once it has stopped
+        self.report_status = True
+
+    def start_phase(self, phase):
+        self.phase = phase
+        timeout = self.phase_timeouts.get(phase)
+        self.phase_deadline = time.monotonic() + timeout if timeout is not None else None
+        print(f"Job {self.job_id} phase {phase}" + (f", timeout {timeout}s" if timeout else ""))
+
+    def remaining(self, timeout):
+        """Return timeout cut short to the time left before the current deadline."""
+        deadline = self.job_deadline
+        if self.phase_deadline is not None:
+            deadline = min(deadline, self.phase_deadline)
+        return max(min(timeout, deadline - time.monotonic()), 0)
+
+    def expired(self):
+        """Return why the job is out of time, or None."""
+        now = time.monotonic()
+        if now > self.job_deadline:
+            return f"job timed out after {self.job_timeout}s"
+        if self.phase_deadline is not None and now > self.phase_deadline:
+            return f"{self.phase} timed out after {self.phase_timeouts[self.phase]}s"
+        return None
+
+    def cancel(self, reason, report_status=True):
+        if self.canceled.is_set():
+            return
+        print(f"Canceling job {self.job_id}: {reason}")
+        self.reason = reason
+        self.report_status = report_status
+        self.canceled.set()
+
+    def check(self):
+        if self.canceled.is_set():
+            raise JobCanceled(self.reason)
@@ -1,371 +1,736 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0.
 
-import time
-import json
+import asyncio
+import enum
 import sys
+import time
 import traceback
-import threading
-from awscrt import io, http, mqtt
-from awscrt.mqtt import QoS
-from awsiot.greengrass_discovery import DiscoveryClient
-from awsiot import iotjobs, mqtt_connection_builder
-from concurrent.futures import Future
-
-
-class LockedData:
-    def __init__(self):
-        self.lock = threading.Lock()
-        self.disconnect_called = False
-        self.is_working_on_job = False
-        self.is_next_job_waiting = False
-        self.got_job_response = False
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from awscrt import mqtt
+from awsiot import iotjobs
+from job_control import JobCanceled, JobControl
+from job_queue import JobQueue
+from metrics import metrics
+from state_store import load_state, save_state
+
+
+# Client token used for IN_PROGRESS updates, so their responses can be told apart from the
+# response to the final status update which completes the job.
+PROGRESS_CLIENT_TOKEN = "progress"
+# Client token prefixes, followed by the job id, for the updates which start a job picked from
+# the queue and which mark a job as superseded.
+START_CLIENT_TOKEN_PREFIX = "start:"
+SUPERSEDED_CLIENT_TOKEN_PREFIX = "superseded:"
+
+
+class JobState(enum.Enum):
+    IDLE = "idle"
+    # Listing and describing the pending jobs, and starting the one picked to run next
+    REQUESTING = "requesting"
+    # The job callback is running in the executor
+    WORKING = "working"
+    # The final job status has been published, waiting for the response
+    REPORTING = "reporting"
+    DISCONNECTING = "disconnecting"
+
+
+class SeenExecutions:
+    """Bounded LRU of the job executions this device has already started.
+
+    Jobs messages are published with QoS 1 on a persistent session, so NextJobExecutionChanged
+    events and StartNextPendingJobExecution responses can be delivered again after a reconnect.
+    Executions are keyed on (job_id, executionNumber, versionNumber), which a redelivered
+    message repeats exactly. Completed executions are saved under state_name so duplicates are
+    also caught after a restart. Executions which were started but never completed are not
+    loaded again, so an interrupted job is picked up and resumed from the job journal.
+    """
+
+    def __init__(self, max_entries=256, state_name="seen_executions.json"):
+        self.max_entries = max_entries
+        self.state_name = state_name
+        self.entries = OrderedDict()
+        if state_name:
+            for job_id, execution_number, version_number in load_state(state_name, []):
+                self.entries[(job_id, execution_number, version_number)] = "completed"
+
+    @staticmethod
+    def key(execution):
+        return (execution.job_id, execution.execution_number, execution.version_number)
+
+    def is_duplicate(self, execution):
+        key = self.key(execution)
+        if key not in self.entries:
+            return False
+        self.entries.move_to_end(key)
+        return True
+
+    def mark(self, execution, status):
+        key = self.key(execution)
+        self.entries[key] = status
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if self.state_name and status == "completed":
+            try:
+                save_state(
+                    self.state_name,
+                    [list(key) for key, status in self.entries.items() if status == "completed"],
+                )
+            except OSError as e:
+                print(f"Unable to save seen job executions: {e}")
 
 
 class JobHandler:
-    def __init__(self, thing_name, mqtt_connection, job_handler_callback):
+    """Runs IoT jobs one at a time on an asyncio event loop.
+
+    MQTT callbacks arrive on awscrt threads and are posted to the loop as events, so all job
+    state is owned by the loop and changes only through handle_event. The job callback itself
+    blocks on docker, so it runs in a single worker thread. awscrt futures are bridged into the
+    loop with asyncio.wrap_future, see wait_for_publish. Redelivered job executions are dropped
+    before the callback is run, see SeenExecutions.
+
+    Before starting a job the pending jobs are listed. When more than one is pending the next
+    job is picked from a local JobQueue by priority, and queued firmware updates made redundant
+    by a later one are marked as superseded, before anything is started, so a device coming
+    online with a backlog only installs the latest firmware. With a single pending job
+    StartNextPendingJobExecution is used, which costs one round-trip more than starting it
+    without listing, and saves describing it.
+
+    The running job is canceled when it is canceled in the cloud or passes a deadline from its
+    job document, see JobControl. The callback then gets cancel_grace_seconds to stop, after
+    which its worker thread is abandoned so the job slot is always released.
+    """
+
+    def __init__(
+        self,
+        thing_name,
+        mqtt_connection,
+        job_handler_callback,
+        progress_interval=5,
+        executor=None,
+        seen_executions=None,
+        default_job_timeout=3600,
+        cancel_grace_seconds=30,
+        publish_drain_seconds=5,
+    ):
         self.thing_name = thing_name
         self.job_handler_callback = job_handler_callback
         self.mqtt_connection = mqtt_connection
         self.jobs_client = iotjobs.IotJobsClient(self.mqtt_connection)
-        self.available_jobs = []
-        self.locked_data = LockedData()
-        self.is_sample_done = threading.Event()
-
-    def on_get_pending_job_executions_accepted_closure(self):
-        def on_get_pending_job_executions_accepted(response):
-            # type: (iotjobs.GetPendingJobExecutionsResponse) -> None
-            with self.locked_data.lock:
-                if len(response.queued_jobs) > 0 or len(response.in_progress_jobs) > 0:
-                    print("Pending Jobs:")
-                    for job in response.in_progress_jobs:
-                        self.available_jobs.append(job)
-                        print(f"  In Progress: {job.job_id} @ {job.last_updated_at}")
-                    for job in response.queued_jobs:
-                        self.available_jobs.append(job)
-                        print(f"  {job.job_id} @ {job.last_updated_at}")
-                else:
-                    print("No pending or queued jobs found!")
-                self.locked_data.got_job_response = True
-
-        return on_get_pending_job_executions_accepted
-
-    def on_get_pending_job_executions_rejected_closure(self):
-        def on_get_pending_job_executions_rejected(error):
-            # type: (iotjobs.RejectedError) -> None
-            print(f"Request rejected: {error.code}: {error.message}")
-            self.exit("Get pending jobs request rejected!")
-
-        return on_get_pending_job_executions_rejected
-
-    def on_next_job_execution_changed_closure(self):
-        def on_next_job_execution_changed(event):
-            # type: (iotjobs.NextJobExecutionChangedEvent) -> None
-            try:
-                execution = event.execution
-                if execution:
-                    print(
-                        "Received Next Job Execution Changed event. job_id:{} job_document:{}".format(
-                            execution.job_id, execution.job_document
-                        )
-                    )
-
-                    # Start job now, or remember to start it when current job is done
-                    start_job_now = False
-                    with self.locked_data.lock:
-                        if self.locked_data.is_working_on_job:
-                            self.locked_data.is_next_job_waiting = True
-                        else:
-                            start_job_now = True
-
-                    if start_job_now:
-                        self.try_start_next_job()
-
-                else:
-                    print(
-                        "Received Next Job Execution Changed event: None. Waiting for further jobs..."
-                    )
-
-            except Exception as e:
-                self.exit(e)
-
-        return on_next_job_execution_changed
-
-    def on_start_next_pending_job_execution_accepted_closure(self):
-        def on_start_next_pending_job_execution_accepted(response):
-            # type: (iotjobs.StartNextJobExecutionResponse) -> None
-            try:
-                if response.execution:
-                    execution = response.execution
-                    print(
-                        "Request to start next job was accepted. job_id:{} job_document:{}".format(
-                            execution.job_id, execution.job_document
-                        )
-                    )
-
-                    # To emulate working on a job, spawn a thread that sleeps for a few seconds
-                    job_thread = threading.Thread(
-                        target=lambda: self.job_thread_fn(execution.job_id, execution.job_document),
-                        name="job_thread",
-                    )
-                    job_thread.start()
-                else:
-                    print(
-                        "Request to start next job was accepted, but there are no jobs to be done. Waiting for further jobs..."
-                    )
-                    self.done_working_on_job()
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+        self.progress_interval = progress_interval
+        self.seen_executions = seen_executions or SeenExecutions()
+        self.job_queue = JobQueue()
+        self.starting_job = None
+        self.default_job_timeout = default_job_timeout
+        self.cancel_grace_seconds = cancel_grace_seconds
+        self.publish_drain_seconds = publish_drain_seconds
+        self.pending_publishes = set()
+        self.control = None
+        self.last_progress_time = 0
+        self.state = JobState.IDLE
+        self.is_next_job_waiting = False
+        self.loop = None
+        self.events = None
+        self.done = None
 
-            except Exception as e:
-                self.exit(e)
+    def post_event(self, name, payload=None):
+        # Called from awscrt and executor threads, hands the event to the loop's thread
+        try:
+            self.loop.call_soon_threadsafe(self.events.put_nowait, (name, payload))
+        except RuntimeError:
+            print(f"Dropping {name} event, job handler has stopped")
+
+    def on_event_closure(self, name):
+        def on_event(payload):
+            self.post_event(name, payload)
+
+        return on_event
+
+    def set_state(self, state):
+        # Disconnecting is final, returns False when the change is refused
+        if self.state == JobState.DISCONNECTING and state != JobState.DISCONNECTING:
+            print(f"Job state {self.state.value}, not changing to {state.value}")
+            return False
+        print(f"Job state {self.state.value} -> {state.value}")
+        self.state = state
+        return True
+
+    async def handle_event(self, name, payload):
+        handler = getattr(self, f"on_{name}")
+        await handler(payload)
+
+    async def on_get_pending_accepted(self, response):
+        # type: (iotjobs.GetPendingJobExecutionsResponse) -> None
+        if response.queued_jobs or response.in_progress_jobs:
+            print("Pending Jobs:")
+            for job in response.in_progress_jobs:
+                print(f"  In Progress: {job.job_id} @ {job.last_updated_at}")
+            for job in response.queued_jobs:
+                print(f"  {job.job_id} @ {job.last_updated_at}")
+        else:
+            print("No pending or queued jobs found!")
+        if self.state != JobState.REQUESTING:
+            return
+
+        to_describe = self.job_queue.merge(response.in_progress_jobs, response.queued_jobs)
+        if len(self.job_queue) <= 1:
+            # Nothing to choose between, the service's next job is the only one
+            await self.start_next_job()
+            return
+        for job in to_describe:
+            request = iotjobs.DescribeJobExecutionRequest(
+                thing_name=self.thing_name, job_id=job.job_id, client_token=job.job_id
+            )
+            self.jobs_client.publish_describe_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
+        if not to_describe:
+            await self.start_selected_job()
+
+    async def on_describe_accepted(self, response):
+        # type: (iotjobs.DescribeJobExecutionResponse) -> None
+        if self.state != JobState.REQUESTING or not response.execution:
+            return
+        self.job_queue.describe(response.execution)
+        if self.job_queue.is_ready():
+            await self.start_selected_job()
+
+    async def on_describe_rejected(self, rejected):
+        # type: (iotjobs.RejectedError) -> None
+        # The job was most likely canceled or removed since it was listed
+        print(f"Describe job {rejected.client_token} rejected: {rejected.code}: {rejected.message}")
+        if self.state != JobState.REQUESTING:
+            return
+        self.job_queue.remove(rejected.client_token)
+        if self.job_queue.is_ready():
+            await self.start_selected_job()
+
+    async def on_jobs_changed(self, event):
+        # type: (iotjobs.JobExecutionsChangedEvent) -> None
+        # Lists every pending job execution. One missing while we work on it was canceled or
+        # removed in the cloud.
+        control = self.control
+        if self.state != JobState.WORKING or not control:
+            return
+        pending_ids = {job.job_id for jobs in (event.jobs or {}).values() for job in jobs}
+        if control.job_id not in pending_ids:
+            control.cancel("canceled in the cloud", report_status=False)
+
+    async def on_get_pending_rejected(self, error):
+        # type: (iotjobs.RejectedError) -> None
+        print(f"Request rejected: {error.code}: {error.message}")
+        await self.disconnect("Get pending jobs request rejected!")
+
+    async def on_next_changed(self, event):
+        # type: (iotjobs.NextJobExecutionChangedEvent) -> None
+        execution = event.execution
+        if not execution:
+            print("Received Next Job Execution Changed event: None. Waiting for further jobs...")
+            return
+        print(
+            "Received Next Job Execution Changed event. job_id:{} job_document:{}".format(
+                execution.job_id, execution.job_document
+            )
+        )
+        if self.drop_duplicate(execution):
+            return
+        # Start job now, or remember to start it when current job is done
+        if self.state == JobState.IDLE:
+            await self.request_next_job()
+        else:
+            self.is_next_job_waiting = True
+
+    async def on_start_next_accepted(self, response):
+        # type: (iotjobs.StartNextJobExecutionResponse) -> None
+        if self.state != JobState.REQUESTING:
+            print(f"Ignoring start next response while {self.state.value}")
+            return
+        execution = response.execution
+        if not execution:
+            print(
+                "Request to start next job was accepted, but there are no jobs to be done. Waiting for further jobs..."
+            )
+            await self.done_working_on_job()
+            return
+        print(
+            "Request to start next job was accepted. job_id:{} job_document:{}".format(
+                execution.job_id, execution.job_document
+            )
+        )
+        await self.start_work(execution)
 
-        return on_start_next_pending_job_execution_accepted
+    async def on_start_next_rejected(self, rejected):
+        # type: (iotjobs.RejectedError) -> None
+        await self.disconnect(
+            "Request to start next pending job rejected with code:'{}' message:'{}'".format(
+                rejected.code, rejected.message
+            )
+        )
 
-    def on_start_next_pending_job_execution_rejected_closure(self):
-        def on_start_next_pending_job_execution_rejected(rejected):
-            # type: (iotjobs.RejectedError) -> None
-            self.exit(
-                "Request to start next pending job rejected with code:'{}' message:'{}'".format(
-                    rejected.code, rejected.message
+    async def on_update_accepted(self, response):
+        # type: (iotjobs.UpdateJobExecutionResponse) -> None
+        client_token = response.client_token or ""
+        if client_token == PROGRESS_CLIENT_TOKEN:
+            return
+        if client_token.startswith(SUPERSEDED_CLIENT_TOKEN_PREFIX):
+            print(f"Marked job {client_token[len(SUPERSEDED_CLIENT_TOKEN_PREFIX):]} superseded")
+            return
+        if client_token.startswith(START_CLIENT_TOKEN_PREFIX):
+            job = self.starting_job
+            if self.state != JobState.REQUESTING or not job:
+                return
+            if client_token != START_CLIENT_TOKEN_PREFIX + job.job_id:
+                return
+            self.starting_job = None
+            # The execution state is requested with the update, but if it is missing the
+            # update can only have moved the version on by one
+            if response.execution_state and response.execution_state.version_number:
+                version_number = response.execution_state.version_number
+            else:
+                version_number = job.version_number + 1
+            execution = iotjobs.JobExecutionData(
+                job_id=job.job_id,
+                job_document=job.job_document,
+                execution_number=job.execution_number,
+                version_number=version_number,
+            )
+            await self.start_work(execution)
+            return
+        print("Request to update job was accepted.")
+        if self.state == JobState.REPORTING:
+            await self.done_working_on_job()
+
+    async def on_update_rejected(self, rejected):
+        # type: (iotjobs.RejectedError) -> None
+        client_token = rejected.client_token or ""
+        control = self.control
+        if (
+            client_token == PROGRESS_CLIENT_TOKEN
+            and rejected.code in ("InvalidStateTransition", "TerminalStateReached")
+            and control
+        ):
+            # The job execution can no longer be updated, it was canceled or timed out
+            control.cancel(f"progress update rejected: {rejected.code}", report_status=False)
+        if client_token == PROGRESS_CLIENT_TOKEN or client_token.startswith(
+            SUPERSEDED_CLIENT_TOKEN_PREFIX
+        ):
+            print(
+                "Update {} was rejected. code:'{}' message:'{}'.".format(
+                    client_token, rejected.code, rejected.message
                 )
             )
-
-        return on_start_next_pending_job_execution_rejected
-
-    def on_update_job_execution_accepted_closure(self):
-        def on_update_job_execution_accepted(response):
-            # type: (iotjobs.UpdateJobExecutionResponse) -> None
-            try:
-                print("Request to update job was accepted.")
-                self.done_working_on_job()
-            except Exception as e:
-                self.exit(e)
-
-        return on_update_job_execution_accepted
-
-    def on_update_job_execution_rejected_closure(self):
-        def on_update_job_execution_rejected(rejected):
-            # type: (iotjobs.RejectedError) -> None
-            self.exit(
-                "Request to update job status was rejected. code:'{}' message:'{}'.".format(
+            return
+        if client_token.startswith(START_CLIENT_TOKEN_PREFIX):
+            # The job changed since it was described, e.g. it was canceled. List the pending
+            # jobs again and pick another.
+            print(
+                "Starting job was rejected. code:'{}' message:'{}'.".format(
                     rejected.code, rejected.message
                 )
             )
-
-        return on_update_job_execution_rejected
-
-    def on_publish_start_next_pending_job_execution_closure(self):
-        def on_publish_start_next_pending_job_execution(future):
-            try:
-                future.result()  # raises exception if publish failed
-
-                print("Published request to start the next job.")
-
-            except Exception as e:
-                self.exit(e)
-
-        return on_publish_start_next_pending_job_execution
-
-    def on_publish_update_job_execution_closure(self):
-        def on_publish_update_job_execution(future):
-            # type: (Future) -> None
-            try:
-                future.result()  # raises exception if publish failed
-                print("Published request to update job.")
-
-            except Exception as e:
-                self.exit(e)
-
-        return on_publish_update_job_execution
-
-    # Function for gracefully quitting this sample
-    def exit(self, msg_or_exception):
-        if isinstance(msg_or_exception, Exception):
-            print("Exiting Sample due to exception.")
-            traceback.print_exception(
-                msg_or_exception.__class__, msg_or_exception, sys.exc_info()[2]
+            if self.state == JobState.REQUESTING and self.starting_job:
+                self.job_queue.remove(self.starting_job.job_id)
+                self.starting_job = None
+                self.is_next_job_waiting = True
+                await self.done_working_on_job()
+            return
+        await self.disconnect(
+            "Request to update job status was rejected. code:'{}' message:'{}'.".format(
+                rejected.code, rejected.message
             )
-        else:
-            print("Exiting Sample:", msg_or_exception)
+        )
 
-        with self.locked_data.lock:
-            if not self.locked_data.disconnect_called:
-                print("Disconnecting...")
-                self.locked_data.disconnect_called = True
-                future = self.mqtt_connection.disconnect()
-                future.add_done_callback(self.on_disconnected_closure())
+    async def on_exit(self, msg_or_exception):
+        await self.disconnect(msg_or_exception)
 
-    def try_start_next_job(self):
+    async def request_next_job(self):
         print("Trying to start the next job...")
-        with self.locked_data.lock:
-            if self.locked_data.is_working_on_job:
-                print("Nevermind, already working on a job.")
-                return
-
-            if self.locked_data.disconnect_called:
-                print("Nevermind, sample is disconnecting.")
-                return
-
-            self.locked_data.is_working_on_job = True
-            self.locked_data.is_next_job_waiting = False
+        if self.state == JobState.DISCONNECTING:
+            print("Nevermind, sample is disconnecting.")
+            return
+        if self.state != JobState.IDLE:
+            print("Nevermind, already working on a job.")
+            return
+
+        self.set_state(JobState.REQUESTING)
+        self.is_next_job_waiting = False
+        print("Publishing request to list pending jobs...")
+        request = iotjobs.GetPendingJobExecutionsRequest(thing_name=self.thing_name)
+        try:
+            await self.wait_for_publish(
+                self.jobs_client.publish_get_pending_job_executions(request, mqtt.QoS.AT_LEAST_ONCE)
+            )
+        except Exception as e:
+            await self.disconnect(e)
 
+    async def start_next_job(self):
         print("Publishing request to start next job...")
         request = iotjobs.StartNextPendingJobExecutionRequest(thing_name=self.thing_name)
-        publish_future = self.jobs_client.publish_start_next_pending_job_execution(
-            request, mqtt.QoS.AT_LEAST_ONCE
-        )
-        publish_future.add_done_callback(self.on_publish_start_next_pending_job_execution_closure())
-
-    def done_working_on_job(self):
-        with self.locked_data.lock:
-            self.locked_data.is_working_on_job = False
-            try_again = self.locked_data.is_next_job_waiting
+        try:
+            await self.wait_for_publish(
+                self.jobs_client.publish_start_next_pending_job_execution(
+                    request, mqtt.QoS.AT_LEAST_ONCE
+                )
+            )
+            print("Published request to start the next job.")
+        except Exception as e:
+            await self.disconnect(e)
 
-        if try_again:
-            self.try_start_next_job()
+    async def start_selected_job(self):
+        job, superseded = self.job_queue.select()
+        for superseded_job, superseded_by in superseded:
+            print(f"Job {superseded_job.job_id} is superseded by {superseded_by.job_id}")
+            metrics.increment("jobs_superseded")
+            request = iotjobs.UpdateJobExecutionRequest(
+                thing_name=self.thing_name,
+                job_id=superseded_job.job_id,
+                status=iotjobs.JobStatus.REJECTED,
+                status_details={"result": "superseded", "supersededBy": superseded_by.job_id},
+                client_token=SUPERSEDED_CLIENT_TOKEN_PREFIX + superseded_job.job_id,
+            )
+            self.jobs_client.publish_update_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
+
+        if not job:
+            print("No jobs left to start. Waiting for further jobs...")
+            await self.done_working_on_job()
+            return
+        print(f"Picked job {job.job_id}, priority {job.priority}, of {len(self.job_queue)} pending")
+        if job.in_progress:
+            # Already started before the agent restarted
+            execution = iotjobs.JobExecutionData(
+                job_id=job.job_id,
+                job_document=job.job_document,
+                execution_number=job.execution_number,
+                version_number=job.version_number,
+            )
+            await self.start_work(execution)
+            return
+
+        self.starting_job = job
+        request = iotjobs.UpdateJobExecutionRequest(
+            thing_name=self.thing_name,
+            job_id=job.job_id,
+            status=iotjobs.JobStatus.IN_PROGRESS,
+            expected_version=job.version_number,
+            include_job_execution_state=True,
+            client_token=START_CLIENT_TOKEN_PREFIX + job.job_id,
+        )
+        try:
+            await self.wait_for_publish(
+                self.jobs_client.publish_update_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
+            )
+        except Exception as e:
+            await self.disconnect(e)
+
+    async def start_work(self, execution):
+        if self.drop_duplicate(execution):
+            self.job_queue.remove(execution.job_id)
+            await self.done_working_on_job()
+            return
+        self.seen_executions.mark(execution, "started")
+        if not self.set_state(JobState.WORKING):
+            return
+        asyncio.create_task(self.work_on_job(execution))
+
+    async def done_working_on_job(self):
+        if self.state == JobState.DISCONNECTING:
+            return
+        self.set_state(JobState.IDLE)
+        if self.is_next_job_waiting:
+            await self.request_next_job()
+
+    def drop_duplicate(self, execution):
+        if not self.seen_executions.is_duplicate(execution):
+            return False
+        print(
+            "Dropping duplicate job execution. job_id:{} execution:{} version:{}".format(
+                execution.job_id, execution.execution_number, execution.version_number
+            )
+        )
+        metrics.increment("job_duplicates_dropped")
+        return True
 
-    def job_thread_fn(self, job_id, job_document):
+    async def work_on_job(self, execution):
+        job_id = execution.job_id
+        job_document = execution.job_document
         try:
             print("Starting local work on job...")
-            # time.sleep(self.input_job_time)
-            success_status = self.job_handler_callback(job_id, job_document)
+            self.last_progress_time = time.monotonic()
+            control = JobControl(
+                job_id, job_document, self.default_job_timeout, execution.execution_number
+            )
+            self.control = control
+            future = self.loop.run_in_executor(
+                self.executor,
+                self.job_handler_callback,
+                job_id,
+                job_document,
+                lambda status_details: self.report_progress(job_id, status_details),
+                control,
+            )
+            success_status, status_details = await self.wait_for_job(future, control)
+            self.control = None
             print("Done working on job.")
 
+            if not control.report_status:
+                print(f"Not reporting status of job {job_id}: {control.reason}")
+                self.seen_executions.mark(execution, "completed")
+                self.job_queue.remove(job_id)
+                self.is_next_job_waiting = True
+                await self.done_working_on_job()
+                return
+
             status = iotjobs.JobStatus.FAILED
             if success_status:
                 status = iotjobs.JobStatus.SUCCEEDED
             print(f"Publishing request to update job status to {status}")
             request = iotjobs.UpdateJobExecutionRequest(
-                thing_name=self.thing_name, job_id=job_id, status=status
+                thing_name=self.thing_name,
+                job_id=job_id,
+                status=status,
+                status_details=status_details,
             )
-            publish_future = self.jobs_client.publish_update_job_execution(
-                request, mqtt.QoS.AT_LEAST_ONCE
+            if not self.set_state(JobState.REPORTING):
+                # Shutting down, the job is left in progress and resumed after a restart
+                print(f"Not reporting status of job {job_id}: disconnecting")
+                return
+            await self.wait_for_publish(
+                self.jobs_client.publish_update_job_execution(request, mqtt.QoS.AT_LEAST_ONCE)
             )
-            publish_future.add_done_callback(self.on_publish_update_job_execution_closure())
+            print("Published request to update job.")
+            # Only now is a redelivery of this execution safe to drop across restarts, an
+            # earlier crash leaves the job in progress to be resumed from the job journal.
+            self.seen_executions.mark(execution, "completed")
+            self.job_queue.remove(job_id)
+            if len(self.job_queue):
+                # Don't wait for a NextJobExecutionChanged event to start the rest of the queue
+                self.is_next_job_waiting = True
 
         except Exception as e:
-            exit(e)
-
-    def on_disconnected_closure(self):
-        def on_disconnected(disconnect_future):
-            # type: (Future) -> None
-            print("Disconnected.")
-
-            # Signal that sample is finished
-            self.is_sample_done.set()
-
-        return on_disconnected
-
-    def run(self):
+            await self.disconnect(e)
+
+    async def wait_for_job(self, future, control):
+        """Wait for the job callback to return, canceling it once it is canceled or out of time.
+
+        After being canceled the callback has cancel_grace_seconds to stop, after that the
+        worker thread is left to finish in the background and a new one takes over.
+        """
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=1)
+            if done:
+                return self.job_result(future, control)
+            reason = control.expired()
+            if reason:
+                control.cancel(reason)
+            if control.canceled.is_set():
+                break
+
+        done, _ = await asyncio.wait({future}, timeout=self.cancel_grace_seconds)
+        if done:
+            return self.job_result(future, control)
+        print(f"Job {control.job_id} still running {self.cancel_grace_seconds}s after cancel")
+        metrics.increment("job_workers_abandoned")
+        self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+        return False, {"error": control.reason}
+
+    def job_result(self, future, control):
         try:
-            # List the jobs queued and pending
-            print("Subscribing to GetPendingJobExecutions responses...")
-            get_jobs_request = iotjobs.GetPendingJobExecutionsRequest(thing_name=self.thing_name)
-            jobs_request_future_accepted, _ = (
-                self.jobs_client.subscribe_to_get_pending_job_executions_accepted(
-                    request=get_jobs_request,
-                    qos=mqtt.QoS.AT_LEAST_ONCE,
-                    callback=self.on_get_pending_job_executions_accepted_closure(),
-                )
-            )
-            # Wait for the subscription to succeed
-            jobs_request_future_accepted.result()
-
-            jobs_request_future_rejected, _ = (
-                self.jobs_client.subscribe_to_get_pending_job_executions_rejected(
-                    request=get_jobs_request,
-                    qos=mqtt.QoS.AT_LEAST_ONCE,
-                    callback=self.on_get_pending_job_executions_rejected_closure(),
-                )
-            )
-            # Wait for the subscription to succeed
-            jobs_request_future_rejected.result()
-
-            # Get a list of all the jobs
-            get_jobs_request_future = self.jobs_client.publish_get_pending_job_executions(
-                request=get_jobs_request, qos=mqtt.QoS.AT_LEAST_ONCE
-            )
-            # Wait for the publish to succeed
-            get_jobs_request_future.result()
+            return future.result()
+        except JobCanceled:
+            return False, {"error": control.reason}
         except Exception as e:
-            self.exit(e)
-
+            # e.g. a docker APIError the callback didn't handle, fail the job, not the agent
+            print(f"Job {control.job_id} failed with exception:")
+            traceback.print_exception(e.__class__, e, e.__traceback__)
+            return False, {"error": str(e)}
+
+    def report_progress(self, job_id, status_details):
+        # Called from the job's worker thread. Progress events arrive far faster than is useful
+        # to send to the cloud, so at most one update is published per progress_interval and the
+        # rest are dropped.
+        now = time.monotonic()
+        if now - self.last_progress_time < self.progress_interval:
+            return
+        self.last_progress_time = now
+
+        request = iotjobs.UpdateJobExecutionRequest(
+            thing_name=self.thing_name,
+            job_id=job_id,
+            status=iotjobs.JobStatus.IN_PROGRESS,
+            status_details=status_details,
+            client_token=PROGRESS_CLIENT_TOKEN,
+        )
+        publish_future = self.jobs_client.publish_update_job_execution(
+            request, mqtt.QoS.AT_LEAST_ONCE
+        )
+        publish_future.add_done_callback(self.on_publish_progress_update)
+
+    async def wait_for_publish(self, publish_future):
+        """Wait for a jobs request to be acknowledged.
+
+        The wait is shielded, so when the loop is shut down the awsiot future isn't canceled,
+        which would make awsiot raise InvalidStateError once the PUBACK arrives. Publishes still
+        unacknowledged when disconnecting get publish_drain_seconds to complete.
+        """
+        wrapped = asyncio.wrap_future(publish_future)
+        self.pending_publishes.add(wrapped)
+        wrapped.add_done_callback(self.pending_publishes.discard)
+        return await asyncio.shield(wrapped)
+
+    def on_publish_progress_update(self, future):
+        # type: (Future) -> None
         try:
-            # Subscribe to necessary topics.
-            # Note that is **is** important to wait for "accepted/rejected" subscriptions
-            # to succeed before publishing the corresponding "request".
-            print("Subscribing to Next Changed events...")
-            changed_subscription_request = iotjobs.NextJobExecutionChangedSubscriptionRequest(
-                thing_name=self.thing_name
-            )
-
-            subscribed_future, _ = self.jobs_client.subscribe_to_next_job_execution_changed_events(
-                request=changed_subscription_request,
-                qos=mqtt.QoS.AT_LEAST_ONCE,
-                callback=self.on_next_job_execution_changed_closure(),
-            )
-
-            # Wait for subscription to succeed
-            subscribed_future.result()
+            future.result()
+        except Exception as e:
+            print(f"Publishing progress update failed: {e}")
 
-            print("Subscribing to Start responses...")
-            start_subscription_request = iotjobs.StartNextPendingJobExecutionSubscriptionRequest(
-                thing_name=self.thing_name
-            )
-            subscribed_accepted_future, _ = (
-                self.jobs_client.subscribe_to_start_next_pending_job_execution_accepted(
-                    request=start_subscription_request,
-                    qos=mqtt.QoS.AT_LEAST_ONCE,
-                    callback=self.on_start_next_pending_job_execution_accepted_closure(),
-                )
-            )
+    # Function for gracefully quitting this sample, from any thread
+    def exit(self, msg_or_exception):
+        self.post_event("exit", msg_or_exception)
 
-            subscribed_rejected_future, _ = (
-                self.jobs_client.subscribe_to_start_next_pending_job_execution_rejected(
-                    request=start_subscription_request,
-                    qos=mqtt.QoS.AT_LEAST_ONCE,
-                    callback=self.on_start_next_pending_job_execution_rejected_closure(),
-                )
+    async def disconnect(self, msg_or_exception):
+        if isinstance(msg_or_exception, Exception):
+            print("Exiting Sample due to exception.")
+            traceback.print_exception(
+                msg_or_exception.__class__, msg_or_exception, sys.exc_info()[2]
             )
+        else:
+            print("Exiting Sample:", msg_or_exception)
 
-            # Wait for subscriptions to succeed
-            subscribed_accepted_future.result()
-            subscribed_rejected_future.result()
+        if self.state == JobState.DISCONNECTING:
+            return
+        self.set_state(JobState.DISCONNECTING)
+        if self.pending_publishes:
+            # e.g. the final status of a job, which shouldn't be lost to the disconnect
+            print(f"Waiting for {len(self.pending_publishes)} publishes to be acknowledged...")
+            await asyncio.wait(set(self.pending_publishes), timeout=self.publish_drain_seconds)
+        print("Disconnecting...")
+        try:
+            await asyncio.wrap_future(self.mqtt_connection.disconnect())
+        finally:
+            print("Disconnected.")
+            # Signal that sample is finished, waking the event loop if it is waiting for events
+            self.done.set()
+            self.events.put_nowait(("disconnected", None))
+
+    async def subscribe_all(self):
+        """Issue every jobs subscription at once and wait for them together, instead of waiting
+        for each broker round-trip in turn. Returns the time each subscription took."""
+        get_jobs_request = iotjobs.GetPendingJobExecutionsRequest(thing_name=self.thing_name)
+        changed_subscription_request = iotjobs.NextJobExecutionChangedSubscriptionRequest(
+            thing_name=self.thing_name
+        )
+        start_subscription_request = iotjobs.StartNextPendingJobExecutionSubscriptionRequest(
+            thing_name=self.thing_name
+        )
+        # Note that we subscribe to "+", the MQTT wildcard, to receive
+        # responses about any job-ID.
+        describe_subscription_request = iotjobs.DescribeJobExecutionSubscriptionRequest(
+            thing_name=self.thing_name, job_id="+"
+        )
+        update_subscription_request = iotjobs.UpdateJobExecutionSubscriptionRequest(
+            thing_name=self.thing_name, job_id="+"
+        )
 
-            print("Subscribing to Update responses...")
-            # Note that we subscribe to "+", the MQTT wildcard, to receive
-            # responses about any job-ID.
-            update_subscription_request = iotjobs.UpdateJobExecutionSubscriptionRequest(
-                thing_name=self.thing_name, job_id="+"
+        subscriptions = {
+            "get_pending_accepted": (
+                self.jobs_client.subscribe_to_get_pending_job_executions_accepted,
+                get_jobs_request,
+            ),
+            "get_pending_rejected": (
+                self.jobs_client.subscribe_to_get_pending_job_executions_rejected,
+                get_jobs_request,
+            ),
+            "next_changed": (
+                self.jobs_client.subscribe_to_next_job_execution_changed_events,
+                changed_subscription_request,
+            ),
+            "start_next_accepted": (
+                self.jobs_client.subscribe_to_start_next_pending_job_execution_accepted,
+                start_subscription_request,
+            ),
+            "start_next_rejected": (
+                self.jobs_client.subscribe_to_start_next_pending_job_execution_rejected,
+                start_subscription_request,
+            ),
+            "describe_accepted": (
+                self.jobs_client.subscribe_to_describe_job_execution_accepted,
+                describe_subscription_request,
+            ),
+            "describe_rejected": (
+                self.jobs_client.subscribe_to_describe_job_execution_rejected,
+                describe_subscription_request,
+            ),
+            "jobs_changed": (
+                self.jobs_client.subscribe_to_job_executions_changed_events,
+                iotjobs.JobExecutionsChangedSubscriptionRequest(thing_name=self.thing_name),
+            ),
+            "update_accepted": (
+                self.jobs_client.subscribe_to_update_job_execution_accepted,
+                update_subscription_request,
+            ),
+            "update_rejected": (
+                self.jobs_client.subscribe_to_update_job_execution_rejected,
+                update_subscription_request,
+            ),
+        }
+
+        subscribe_start = time.monotonic()
+        timings = {}
+
+        async def subscribe(name, subscribe_fn, request):
+            subscribed_future, _ = subscribe_fn(
+                request=request, qos=mqtt.QoS.AT_LEAST_ONCE, callback=self.on_event_closure(name)
             )
+            await asyncio.wrap_future(subscribed_future)
+            timings[name] = time.monotonic() - subscribe_start
+
+        # Wait for every subscription to succeed before publishing any requests, so no
+        # "accepted/rejected" response can be missed.
+        await asyncio.gather(
+            *[
+                subscribe(name, subscribe_fn, request)
+                for name, (subscribe_fn, request) in subscriptions.items()
+            ]
+        )
+        return timings
 
-            subscribed_accepted_future, _ = (
-                self.jobs_client.subscribe_to_update_job_execution_accepted(
-                    request=update_subscription_request,
-                    qos=mqtt.QoS.AT_LEAST_ONCE,
-                    callback=self.on_update_job_execution_accepted_closure(),
-                )
-            )
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue()
+        self.done = asyncio.Event()
 
-            subscribed_rejected_future, _ = (
-                self.jobs_client.subscribe_to_update_job_execution_rejected(
-                    request=update_subscription_request,
-                    qos=mqtt.QoS.AT_LEAST_ONCE,
-                    callback=self.on_update_job_execution_rejected_closure(),
-                )
-            )
+        try:
+            run_start = time.monotonic()
+            print("Subscribing to jobs topics...")
+            timings = await self.subscribe_all()
+            subscribed_time = time.monotonic() - run_start
 
-            # Wait for subscriptions to succeed
-            subscribed_accepted_future.result()
-            subscribed_rejected_future.result()
+            # Make initial attempt to start next job, by listing the jobs queued and pending.
+            # The service should reply with an "accepted" response, even if no jobs are pending.
+            await self.request_next_job()
 
-            # Make initial attempt to start next job. The service should reply with
-            # an "accepted" response, even if no jobs are pending. The response
-            # will contain data about the next job, if there is one.
-            # (Will do nothing if we are in CI)
-            self.try_start_next_job()
+            print(f"Subscribed to jobs topics in {subscribed_time * 1000:.1f}ms:")
+            for name, elapsed in sorted(timings.items(), key=lambda item: item[1]):
+                print(f"  {name}: {elapsed * 1000:.1f}ms")
+            print(f"Requested next job {(time.monotonic() - run_start) * 1000:.1f}ms after start")
 
         except Exception as e:
-            self.exit(e)
+            await self.disconnect(e)
+
+        # Handle events until the sample is finished
+        while not self.done.is_set():
+            name, payload = await self.events.get()
+            if self.done.is_set():
+                break
+            try:
+                await self.handle_event(name, payload)
+            except Exception as e:
+                await self.disconnect(e)
 
-        # Wait for the sample to finish
-        self.is_sample_done.wait()
+        self.executor.shutdown(wait=False)
+
+    def run(self):
+        asyncio.run(self.run_async())
@@ -0,0 +1,75 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class JobJournal:
+    """Write-ahead journal of the phases each job has completed on the device.
+
+    Each phase is committed to sqlite in WAL mode with synchronous=FULL before the work that
+    depends on it goes ahead, so after the agent or the device restarts an interrupted job can
+    carry on from its last completed phase instead of starting over.
+
+    Phases are kept per job execution. A job retried in the cloud comes back with the same job id
+    and a higher execution number, and starts over.
+    """
+
+    def __init__(self, path, keep_jobs=100):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.keep_jobs = keep_jobs
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS job_phases (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                execution_number INTEGER,
+                phase TEXT NOT NULL,
+                data TEXT NOT NULL,
+                recorded_at REAL NOT NULL
+            )"""
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(job_phases)")]
+        if "execution_number" not in columns:
+            # Journals written before phases were kept per execution
+            self.db.execute("ALTER TABLE job_phases ADD COLUMN execution_number INTEGER")
+        self.db.execute("CREATE INDEX IF NOT EXISTS job_phases_job_id ON job_phases (job_id)")
+
+    def record(self, job_id, execution_number, phase, data):
+        print(f"Journal: job {job_id} execution {execution_number} reached phase {phase}")
+        with self.lock:
+            self.db.execute(
+                """INSERT INTO job_phases (job_id, execution_number, phase, data, recorded_at)
+                VALUES (?, ?, ?, ?, ?)""",
+                (job_id, execution_number, phase, json.dumps(data), time.time()),
+            )
+
+    def last_phase(self, job_id, execution_number):
+        """Return the last phase recorded for the execution of job_id and its data, or
+        (None, {})."""
+        with self.lock:
+            row = self.db.execute(
+                """SELECT phase, data FROM job_phases WHERE job_id = ? AND execution_number IS ?
+                ORDER BY id DESC LIMIT 1""",
+                (job_id, execution_number),
+            ).fetchone()
+        if not row:
+            return None, {}
+        return row[0], json.loads(row[1])
+
+    def prune(self):
+        # Keep the phases of the most recent keep_jobs jobs
+        with self.lock:
+            self.db.execute(
+                """DELETE FROM job_phases WHERE job_id NOT IN (
+                    SELECT job_id FROM job_phases GROUP BY job_id ORDER BY MAX(id) DESC LIMIT ?
+                )""",
+                (self.keep_jobs,),
+            )
@@ -0,0 +1,111 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Operations which jump the queue unless their job document sets a priority of its own
+DEFAULT_PRIORITIES = {"Rollback-ROS-Firmware": 100}
+# Operations where a job queued later makes any queued earlier redundant
+SUPERSEDABLE_OPERATIONS = {"Deploy-ROS-Firmware"}
+
+
+class PendingJob:
+    def __init__(self, job_id, execution_number, version_number, queued_at, in_progress):
+        self.job_id = job_id
+        self.execution_number = execution_number
+        self.version_number = version_number
+        # Seconds since the epoch, so jobs without a timestamp still sort
+        self.queued_at = queued_at.timestamp() if queued_at else 0
+        self.in_progress = in_progress
+        self.job_document = None
+
+    @property
+    def described(self):
+        return self.job_document is not None
+
+    @property
+    def operation(self):
+        return (self.job_document or {}).get("operation")
+
+    @property
+    def priority(self):
+        job_document = self.job_document or {}
+        try:
+            return int(job_document["priority"])
+        except (KeyError, TypeError, ValueError):
+            return DEFAULT_PRIORITIES.get(self.operation, 0)
+
+    def sort_key(self):
+        # Jobs already in progress were interrupted and are finished first, then the highest
+        # priority, then the oldest.
+        return (not self.in_progress, -self.priority, self.queued_at)
+
+
+class JobQueue:
+    """Local index of the device's pending job executions, keyed on job id.
+
+    The jobs service only hands out jobs in the order they were queued. The queue is merged from
+    GetPendingJobExecutions responses and each job's document is fetched with
+    DescribeJobExecution, so the agent can pick the next job itself.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def merge(self, in_progress_jobs, queued_jobs):
+        """Update the queue from a list of pending jobs. Returns the jobs which need describing."""
+        pending = {}
+        for summaries, in_progress in ((in_progress_jobs, True), (queued_jobs, False)):
+            for summary in summaries or []:
+                job = self.jobs.get(summary.job_id)
+                if not job or job.version_number != summary.version_number:
+                    job = PendingJob(
+                        summary.job_id,
+                        summary.execution_number,
+                        summary.version_number,
+                        summary.queued_at,
+                        in_progress,
+                    )
+                pending[summary.job_id] = job
+        # Jobs no longer pending were completed, canceled or removed in the cloud
+        self.jobs = pending
+        return [job for job in self.jobs.values() if not job.described]
+
+    def describe(self, execution):
+        job = self.jobs.get(execution.job_id)
+        if job:
+            job.job_document = execution.job_document or {}
+            job.version_number = execution.version_number
+
+    def remove(self, job_id):
+        self.jobs.pop(job_id, None)
+
+    def is_ready(self):
+        return all(job.described for job in self.jobs.values())
+
+    def select(self):
+        """Pick the next job to run. Returns the job, or None, and the superseded jobs.
+
+        Of the queued jobs with a supersedable operation only the one queued last is worth
+        installing. The others are removed from the queue and returned as (job, superseded_by)
+        pairs.
+        """
+        superseded = []
+        for operation in SUPERSEDABLE_OPERATIONS:
+            queued = sorted(
+                (
+                    job
+                    for job in self.jobs.values()
+                    if job.operation == operation and not job.in_progress
+                ),
+                key=lambda job: job.queued_at,
+            )
+            superseded.extend((job, queued[-1]) for job in queued[:-1])
+        for job, _ in superseded:
+            self.remove(job.job_id)
+
+        if not self.jobs:
+            return None, superseded
+        job = min(self.jobs.values(), key=PendingJob.sort_key)
+        return job, superseded
@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+from state_store import save_state
+
+
+class Metrics:
+    """Process wide counters and timings, written to metrics.json in the agent state directory."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            timing = self.timings.setdefault(
+                name, {"count": 0, "sum": 0.0, "min": value, "max": value, "last": value}
+            )
+            timing["count"] += 1
+            timing["sum"] += value
+            timing["min"] = min(timing["min"], value)
+            timing["max"] = max(timing["max"], value)
+            timing["last"] = value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "timings": {name: dict(timing) for name, timing in self.timings.items()},
+            }
+
+    def dump(self):
+        try:
+            save_state("metrics.json", self.snapshot())
+        except OSError as e:
+            print(f"Unable to write metrics: {e}")
+
+
+metrics = Metrics()
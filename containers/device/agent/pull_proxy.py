@@ -0,0 +1,220 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import socket
+import socketserver
+import threading
+import time
+from urllib.parse import urlsplit
+
+BUFFER_SIZE = 64 * 1024
+
+
+class RateLimiter:
+    """Token bucket shared by every connection through the proxy. A rate of 0 is unlimited."""
+
+    def __init__(self, rate=0, burst_seconds=0.25):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = 0
+        self.last_time = time.monotonic()
+        self.total_bytes = 0
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = 0
+
+    def consume(self, size):
+        with self.lock:
+            self.total_bytes += size
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(
+                self.tokens + (now - self.last_time) * self.rate, self.rate * self.burst_seconds
+            )
+            self.last_time = now
+            self.tokens -= size
+            # Sleeping while holding the lock makes concurrent downloads queue for the budget
+            if self.tokens < 0:
+                time.sleep(-self.tokens / self.rate)
+
+
+class ProxyHandler(socketserver.BaseRequestHandler):
+    """Forwards one request, or one CONNECT tunnel, to its upstream server.
+
+    Plain HTTP requests are sent upstream with Connection: close, so each connection carries a
+    single request and the upstream is always the one the request was for. GET and HEAD requests
+    for a registry with a mirror are tried against the mirror first, and fall back to the origin
+    registry if the mirror can't be reached or answers with a server error.
+    """
+
+    def handle(self):
+        head, self.leftover = self.read_head(self.request)
+        if not head:
+            return
+        request_line, _, headers = head.partition(b"\r\n")
+        try:
+            method, target, version = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return
+
+        if method == "CONNECT":
+            host, _, port = target.rpartition(":")
+            upstream = self.connect(host, int(port))
+            source = "tunnel"
+            self.response = b""
+            if upstream:
+                self.request.sendall(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        else:
+            url = urlsplit(target)
+            origin = f"{url.hostname}:{url.port or 80}"
+            path = url.path or "/"
+            if url.query:
+                path += "?" + url.query
+            kept_headers = [
+                header
+                for header in headers.split(b"\r\n")
+                if header
+                and not header.lower().startswith((b"connection:", b"proxy-connection:", b"host:"))
+            ]
+
+            upstream = None
+            mirror = self.server.mirrors.get(origin)
+            if mirror and method in ("GET", "HEAD"):
+                upstream = self.forward(mirror, method, path, version, kept_headers, True)
+                source = "mirror"
+                if not upstream:
+                    self.server.record("fallback", 0)
+            if not upstream:
+                upstream = self.forward(origin, method, path, version, kept_headers, False)
+                source = "origin"
+        if not upstream:
+            self.request.sendall(b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n")
+            return
+
+        with upstream:
+            if self.leftover:
+                upstream.sendall(self.leftover)
+            sender = threading.Thread(target=self.pipe, args=(self.request, upstream), daemon=True)
+            sender.start()
+            transferred = self.pipe(upstream, self.request, self.server.limiter, self.response)
+            self.server.record(source, transferred)
+
+    def forward(self, address, method, path, version, headers, is_mirror):
+        """Send the request to address. Returns the upstream socket, or None if it can't be
+        reached or, for a mirror, fails and the request should go to the origin instead.
+
+        A mirror's response head is read here to check its status. Requests to a mirror have no
+        body, while the origin may need the rest of the body before it responds.
+        """
+        host, _, port = address.rpartition(":")
+        upstream = self.connect(host, int(port))
+        if not upstream:
+            return None
+        self.response = b""
+        try:
+            upstream.sendall(
+                b"\r\n".join(
+                    [f"{method} {path} {version}".encode("latin-1"), f"Host: {address}".encode()]
+                    + headers
+                    + [b"Connection: close", b"", self.leftover]
+                )
+            )
+            if is_mirror:
+                head, rest = self.read_head(upstream)
+                status = head.split(b" ", 2)[1] if head and b" " in head else b""
+                if status.startswith(b"5") or not head:
+                    raise OSError(f"status {status.decode() or 'missing'}")
+                self.response = head + b"\r\n\r\n" + rest
+        except OSError as e:
+            print(f"Pull proxy {method} {path} to {address} failed: {e}")
+            upstream.close()
+            return None
+        self.leftover = b""
+        return upstream
+
+    @staticmethod
+    def read_head(sock):
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = sock.recv(BUFFER_SIZE)
+            if not chunk:
+                return None, data
+            data += chunk
+        head, _, rest = data.partition(b"\r\n\r\n")
+        return head, rest
+
+    def connect(self, host, port):
+        try:
+            return socket.create_connection((host, port), timeout=self.server.connect_timeout)
+        except OSError as e:
+            print(f"Pull proxy unable to connect to {host}:{port}: {e}")
+            return None
+
+    @staticmethod
+    def pipe(source, destination, limiter=None, initial=b""):
+        """Copy source to destination until source closes, after sending initial. Returns the
+        number of bytes copied."""
+        transferred = 0
+        source.settimeout(None)
+        try:
+            data = initial
+            while True:
+                if data:
+                    if limiter:
+                        limiter.consume(len(data))
+                    destination.sendall(data)
+                    transferred += len(data)
+                data = source.recv(BUFFER_SIZE)
+                if not data:
+                    break
+        except OSError:
+            pass
+        finally:
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        return transferred
+
+
+class PullProxy(socketserver.ThreadingTCPServer):
+    """HTTP forward proxy through which dockerd pulls images. Registry downloads are limited to
+    a shared bytes per second budget, and registries can be pulled through a mirror such as a
+    pull-through cache, given as {"registry:5000": "registry-cache:5000"}.
+
+    entrypoint.sh points dockerd's HTTP_PROXY and HTTPS_PROXY at it when PULL_RATE_LIMIT or
+    REGISTRY_MIRROR is set.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, rate=0, connect_timeout=10, mirrors=None):
+        super().__init__(address, ProxyHandler)
+        self.limiter = RateLimiter(rate)
+        self.connect_timeout = connect_timeout
+        self.mirrors = mirrors or {}
+        self.stats_lock = threading.Lock()
+        self.counts = {}
+
+    def record(self, source, transferred):
+        with self.stats_lock:
+            self.counts[f"{source}Requests"] = self.counts.get(f"{source}Requests", 0) + 1
+            self.counts[f"{source}Bytes"] = self.counts.get(f"{source}Bytes", 0) + transferred
+
+    def stats(self):
+        """Requests and bytes served by the mirror, by the origin, through tunnels, and the
+        number of requests which fell back from the mirror to the origin."""
+        with self.stats_lock:
+            return dict(self.counts)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        print(
+            f"Pull proxy listening on {self.server_address}, {self.limiter.rate} bytes/s, "
+            f"mirrors {self.mirrors}"
+        )
@@ -0,0 +1,207 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+import traceback
+from awscrt import mqtt
+from awsiot import iotshadow
+from job_control import JobCanceled, JobControl
+
+
+class ShadowReconciler:
+    """Reconciles the running firmware to the desired state of a named shadow.
+
+    An alternative to IoT Jobs. The cloud sets desired.firmwareVersion, and optionally
+    desired.firmwareDigest, on the shadow. The agent gets the delta pushed to it, installs the
+    firmware and writes the result back to reported, a single publish per update. At startup the
+    shadow is fetched once, so the device converges on whatever is desired now however long it
+    was offline, without replaying the updates it missed.
+
+    Each desired state is identified by the time desired.firmwareVersion was set, from the
+    shadow metadata. The delta is published again on every reported update while the device
+    differs from desired, and those repeats are ignored, as is a desired state which failed to
+    install until it is set again. Only the latest desired state matters: one that arrives
+    while an update is in flight cancels it and is installed next.
+
+    reconcile_callback is called as reconcile_callback(update_id, desired, report_progress,
+    control) and returns (success, status_details). update_id is unique to each desired state.
+    """
+
+    def __init__(
+        self,
+        thing_name,
+        mqtt_connection,
+        reconcile_callback,
+        shadow_name="firmware",
+        progress_interval=5,
+        default_timeout=3600,
+    ):
+        self.thing_name = thing_name
+        self.shadow_name = shadow_name
+        self.reconcile_callback = reconcile_callback
+        self.shadow_client = iotshadow.IotShadowClient(mqtt_connection)
+        self.progress_interval = progress_interval
+        self.default_timeout = default_timeout
+        self.last_progress_time = 0
+        self.condition = threading.Condition()
+        # Latest desired state not yet reconciled, and when it was set
+        self.desired = None
+        self.desired_timestamp = 0
+        self.control = None
+
+    def on_get_accepted(self, response):
+        # type: (iotshadow.GetShadowResponse) -> None
+        delta = response.state.delta if response.state else None
+        if delta:
+            desired_metadata = response.metadata.desired if response.metadata else None
+            self.set_desired(delta, desired_metadata or {})
+        else:
+            print(f"Shadow {self.shadow_name} is in sync")
+
+    def on_get_rejected(self, error):
+        # type: (iotshadow.ErrorResponse) -> None
+        # A 404 just means nothing has been desired yet
+        print(f"Get shadow {self.shadow_name} rejected: {error.code}: {error.message}")
+
+    def on_delta(self, delta):
+        # type: (iotshadow.ShadowDeltaUpdatedEvent) -> None
+        if delta.state:
+            self.set_desired(delta.state, delta.metadata or {})
+
+    def on_update_rejected(self, error):
+        # type: (iotshadow.ErrorResponse) -> None
+        print(f"Update shadow {self.shadow_name} rejected: {error.code}: {error.message}")
+
+    def set_desired(self, delta, desired_metadata):
+        if "firmwareVersion" not in delta:
+            return
+        timestamp = desired_metadata.get("firmwareVersion", {}).get("timestamp", 0)
+        with self.condition:
+            if timestamp <= self.desired_timestamp:
+                # Repeated after a reported update, redelivered, or out of order
+                return
+            print(f"Desired firmware {delta['firmwareVersion']} set at {timestamp}")
+            self.desired = delta
+            self.desired_timestamp = timestamp
+            if self.control:
+                self.control.cancel(f"superseded by firmware {delta['firmwareVersion']}")
+            self.condition.notify_all()
+
+    def report(self, reported):
+        request = iotshadow.UpdateNamedShadowRequest(
+            thing_name=self.thing_name,
+            shadow_name=self.shadow_name,
+            state=iotshadow.ShadowState(reported=reported),
+        )
+        future = self.shadow_client.publish_update_named_shadow(request, mqtt.QoS.AT_LEAST_ONCE)
+        future.add_done_callback(self.on_publish_update)
+
+    def on_publish_update(self, future):
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Publishing shadow update failed: {e}")
+
+    def report_progress(self, status_details):
+        # Throttled like job progress updates, see JobHandler.report_progress
+        now = time.monotonic()
+        if now - self.last_progress_time < self.progress_interval:
+            return
+        self.last_progress_time = now
+        self.report({"firmwareStatus": "IN_PROGRESS", "firmwareStatusDetails": status_details})
+
+    def reconcile(self, desired, timestamp):
+        update_id = f"shadow-{self.shadow_name}-{timestamp}"
+        control = JobControl(update_id, desired, self.default_timeout)
+        with self.condition:
+            if timestamp != self.desired_timestamp:
+                return
+            self.control = control
+        self.last_progress_time = time.monotonic()
+        finished = threading.Event()
+        threading.Thread(target=self.watch_deadlines, args=(control, finished), daemon=True).start()
+        try:
+            success, status_details = self.reconcile_callback(
+                update_id, desired, self.report_progress, control
+            )
+        except JobCanceled as e:
+            success, status_details = False, {"error": str(e)}
+        except Exception as e:
+            traceback.print_exc()
+            success, status_details = False, {"error": str(e)}
+        finally:
+            finished.set()
+            with self.condition:
+                self.control = None
+                superseded = timestamp != self.desired_timestamp
+
+        if superseded:
+            # The newer desired state is reported once it has been reconciled
+            return
+        reported = {"firmwareStatus": "SUCCEEDED" if success else "FAILED"}
+        reported["firmwareStatusDetails"] = status_details
+        if success:
+            reported["firmwareVersion"] = desired["firmwareVersion"]
+            reported["firmwareDigest"] = desired.get("firmwareDigest")
+        else:
+            reported["firmwareFailedVersion"] = desired["firmwareVersion"]
+        print(f"Reconciled {update_id}: {reported['firmwareStatus']}")
+        self.report(reported)
+
+    def watch_deadlines(self, control, finished):
+        # The timeouts in the desired state are enforced as for jobs, see JobHandler.wait_for_job
+        while not finished.wait(1):
+            reason = control.expired()
+            if reason:
+                control.cancel(reason)
+
+    def subscribe_all(self):
+        subscriptions = [
+            (
+                self.shadow_client.subscribe_to_named_shadow_delta_updated_events,
+                iotshadow.NamedShadowDeltaUpdatedSubscriptionRequest,
+                self.on_delta,
+            ),
+            (
+                self.shadow_client.subscribe_to_get_named_shadow_accepted,
+                iotshadow.GetNamedShadowSubscriptionRequest,
+                self.on_get_accepted,
+            ),
+            (
+                self.shadow_client.subscribe_to_get_named_shadow_rejected,
+                iotshadow.GetNamedShadowSubscriptionRequest,
+                self.on_get_rejected,
+            ),
+            (
+                self.shadow_client.subscribe_to_update_named_shadow_rejected,
+                iotshadow.UpdateNamedShadowSubscriptionRequest,
+                self.on_update_rejected,
+            ),
+        ]
+        # Issue every subscription at once, then wait for them together
+        futures = [
+            subscribe_fn(
+                request=request_class(thing_name=self.thing_name, shadow_name=self.shadow_name),
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=callback,
+            )[0]
+            for subscribe_fn, request_class, callback in subscriptions
+        ]
+        for future in futures:
+            future.result()
+
+    def run(self):
+        print(f"Subscribing to shadow {self.shadow_name} of {self.thing_name}...")
+        self.subscribe_all()
+        request = iotshadow.GetNamedShadowRequest(
+            thing_name=self.thing_name, shadow_name=self.shadow_name
+        )
+        self.shadow_client.publish_get_named_shadow(request, mqtt.QoS.AT_LEAST_ONCE).result()
+
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.desired is not None)
+                desired, timestamp = self.desired, self.desired_timestamp
+                self.desired = None
+            self.reconcile(desired, timestamp)
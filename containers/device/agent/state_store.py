@@ -0,0 +1,36 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+import tempfile
+
+state_dir = os.environ.get("AGENT_STATE_DIR", "/var/lib/firmware-agent")
+
+
+def load_state(name, default):
+    path = os.path.join(state_dir, name)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        print(f"Unable to read state file {path}: {e}")
+        return default
+
+
+def save_state(name, data):
+    # Write to a temporary file and rename it over the old one so a crash part way through never
+    # leaves a truncated state file behind.
+    os.makedirs(state_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=state_dir, prefix=f".{name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(state_dir, name))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
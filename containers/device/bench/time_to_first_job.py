@@ -0,0 +1,64 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Measures the agent's time-to-first-job: how long JobHandler.run takes from starting up to
+# handing the first job to its callback. The Greengrass core's MQTT broker, and the IoT Jobs
+# service behind it, are replaced by the tests' FakeJobsBroker, which answers every operation
+# after a fixed round-trip time.
+#
+#   python time_to_first_job.py --rtt 0.05 --iterations 20
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+device_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(device_dir, "agent"))
+sys.path.insert(0, os.path.join(device_dir, "tests"))
+
+from fake_jobs import FakeJobsBroker  # noqa: E402
+from job_handler import JobHandler, SeenExecutions  # noqa: E402
+
+
+def measure_time_to_first_job(rtt):
+    thing_name = "benchmark-thing"
+    got_job = threading.Event()
+    start_time = time.monotonic()
+    times = {}
+
+    def job_handler_callback(job_id, job_document, report_progress, control):
+        times["first_job"] = time.monotonic() - start_time
+        got_job.set()
+        return True, {}
+
+    broker = FakeJobsBroker(thing_name, rtt=rtt)
+    broker.add_job("benchmark-job", {"operation": "Benchmark"})
+    # Every iteration hands out the same job, so don't remember it between iterations
+    job_handler = JobHandler(
+        thing_name, broker, job_handler_callback, seen_executions=SeenExecutions(state_name=None)
+    )
+    run_thread = threading.Thread(target=job_handler.run, daemon=True)
+    run_thread.start()
+    if not got_job.wait(timeout=max(100 * rtt, 10)):
+        raise RuntimeError("No job received")
+    job_handler.exit("Benchmark iteration complete")
+    run_thread.join(timeout=10)
+    return times["first_job"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark agent time-to-first-job")
+    parser.add_argument("--rtt", type=float, default=0.02, help="broker round-trip time in seconds")
+    parser.add_argument("--iterations", type=int, default=10, help="number of agent startups")
+    args = parser.parse_args()
+
+    results = [measure_time_to_first_job(args.rtt) for _ in range(args.iterations)]
+    print()
+    print(f"Time to first job over {args.iterations} startups with {args.rtt * 1000:.0f}ms RTT:")
+    print(f"  median {statistics.median(results) * 1000:.1f}ms")
+    print(f"  min    {min(results) * 1000:.1f}ms")
+    print(f"  max    {max(results) * 1000:.1f}ms")
+    print(f"  median {statistics.median(results) / args.rtt:.1f} round-trips")
@@ -6,7 +6,15 @@ set -e
 
 set +m
 echo "Starting Docker..."
-dockerd > /dev/null 2>&1 &
+PULL_PROXY=""
+if [ -n "$PULL_RATE_LIMIT" ] || [ -n "$REGISTRY_MIRROR" ]; then
+    # Registry pulls go through the agent's pull proxy, which rate limits them and tries the
+    # registry mirror first
+    PULL_PROXY="http://127.0.0.1:${PULL_PROXY_PORT:-3128}"
+fi
+# Set for dockerd alone, the agent's own downloads, such as firmware archives, aren't proxied
+HTTP_PROXY="${PULL_PROXY:-$HTTP_PROXY}" HTTPS_PROXY="${PULL_PROXY:-$HTTPS_PROXY}" \
+    dockerd > /dev/null 2>&1 &
 
 echo "Starting Agent..."
 . /venv/bin/activate && python -u /agent/agent.py
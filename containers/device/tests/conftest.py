@@ -0,0 +1,10 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import sys
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(tests_dir, "..", "agent"))
+# The firmware's service package, for its offline queue and publisher
+sys.path.insert(0, os.path.join(tests_dir, "..", "..", "ros-image-v1", "ws", "src", "service"))
@@ -0,0 +1,239 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import threading
+import time
+from concurrent.futures import Future
+from awscrt import mqtt
+
+
+def topic_matches(subscription, topic):
+    subscription_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    if len(subscription_levels) != len(topic_levels):
+        return False
+    return all(s in ("+", t) for s, t in zip(subscription_levels, topic_levels))
+
+
+class FakeJob:
+    def __init__(self, job_id, job_document, queued_at):
+        self.job_id = job_id
+        self.job_document = job_document
+        self.queued_at = queued_at
+        self.status = "QUEUED"
+        self.version_number = 1
+        self.status_details = None
+
+    def summary(self):
+        return {
+            "jobId": self.job_id,
+            "queuedAt": self.queued_at,
+            "lastUpdatedAt": self.queued_at,
+            "executionNumber": 1,
+            "versionNumber": self.version_number,
+        }
+
+    def execution(self, thing_name):
+        return dict(
+            self.summary(),
+            thingName=thing_name,
+            jobDocument=self.job_document,
+            status=self.status,
+        )
+
+    def state(self):
+        return {
+            "status": self.status,
+            "statusDetails": self.status_details,
+            "versionNumber": self.version_number,
+        }
+
+
+class FakeJobsBroker(mqtt.Connection):
+    """Stands in for an mqtt.Connection to a broker with the IoT Jobs service behind it.
+
+    Requests are answered as they are published, on the publishing thread, so a test sees the
+    same sequence of events every run. With hold_acks set, publishes are only acknowledged by
+    release_acks, as if the broker had stopped responding.
+
+    With rtt set, as for benchmarks, subscriptions and publishes are instead acknowledged, and
+    requests handled, rtt seconds later on a timer thread, and responses arrive rtt after that.
+    """
+
+    def __init__(self, thing_name, hold_acks=False, rtt=0):
+        # mqtt.Connection.__init__ is deliberately not called, nothing native is needed.
+        self.thing_name = thing_name
+        self.hold_acks = hold_acks
+        self.rtt = rtt
+        self.lock = threading.RLock()
+        self.subscriptions = {}
+        self.jobs = []
+        self.published = []
+        self.held_acks = []
+        self.jobs_prefix = f"$aws/things/{thing_name}/jobs/"
+
+    def add_job(self, job_id, job_document, queued_at=None):
+        with self.lock:
+            queued_at = queued_at or int(time.time()) - 1000 + len(self.jobs)
+            self.jobs.append(FakeJob(job_id, job_document, queued_at))
+
+    def job(self, job_id):
+        return next((job for job in self.jobs if job.job_id == job_id), None)
+
+    def pending(self):
+        return [job for job in self.jobs if job.status in ("QUEUED", "IN_PROGRESS")]
+
+    def requests(self, operation):
+        """Return the payloads published to the given jobs topic, e.g. "start-next" or "update"."""
+        with self.lock:
+            return [
+                payload for topic, payload in self.published if topic.split("/")[-1] == operation
+            ]
+
+    def later(self, fn):
+        if not self.rtt:
+            fn()
+            return
+        timer = threading.Timer(self.rtt, fn)
+        timer.daemon = True
+        timer.start()
+
+    def subscribe(self, topic, qos, callback=None, **kwargs):
+        future = Future()
+
+        def suback():
+            with self.lock:
+                self.subscriptions[topic] = callback
+            future.set_result({"packet_id": 1, "topic": topic, "qos": qos})
+
+        self.later(suback)
+        return future, 1
+
+    def publish(self, topic, payload, qos, retain=False, **kwargs):
+        future = Future()
+        request = json.loads(payload) if payload else {}
+        with self.lock:
+            self.published.append((topic, request))
+
+        def puback():
+            with self.lock:
+                if self.hold_acks:
+                    self.held_acks.append(future)
+                else:
+                    future.set_result({"packet_id": 1})
+            self.handle_request(topic, request)
+
+        self.later(puback)
+        return future, 1
+
+    def release_acks(self):
+        with self.lock:
+            held, self.held_acks = self.held_acks, []
+        for future in held:
+            future.set_result({"packet_id": 1})
+
+    def disconnect(self):
+        future = Future()
+        future.set_result({})
+        return future
+
+    def handle_request(self, topic, request):
+        now = int(time.time())
+        client_token = request.get("clientToken")
+        operation = topic[len(self.jobs_prefix) :]
+        with self.lock:
+            if operation == "get":
+                pending = self.pending()
+                self.respond(
+                    topic + "/accepted",
+                    {
+                        "inProgressJobs": [j.summary() for j in pending if j.status != "QUEUED"],
+                        "queuedJobs": [j.summary() for j in pending if j.status == "QUEUED"],
+                        "timestamp": now,
+                    },
+                )
+            elif operation == "start-next":
+                pending = sorted(self.pending(), key=lambda j: (j.status == "QUEUED", j.queued_at))
+                response = {"timestamp": now}
+                if pending:
+                    job = pending[0]
+                    if job.status == "QUEUED":
+                        job.status = "IN_PROGRESS"
+                        job.version_number += 1
+                    response["execution"] = job.execution(self.thing_name)
+                self.respond(topic + "/accepted", response)
+            elif operation.endswith("/get"):
+                job = self.job(operation.split("/")[0])
+                if job and job.status in ("QUEUED", "IN_PROGRESS"):
+                    self.respond(
+                        topic + "/accepted",
+                        {"execution": job.execution(self.thing_name), "clientToken": client_token},
+                    )
+                else:
+                    self.reject(topic, "ResourceNotFound", client_token)
+            elif operation.endswith("/update"):
+                self.update(topic, self.job(operation.split("/")[0]), request)
+
+    def update(self, topic, job, request):
+        now = int(time.time())
+        client_token = request.get("clientToken")
+        if not job or job.status not in ("QUEUED", "IN_PROGRESS"):
+            self.reject(topic, "TerminalStateReached", client_token)
+            return
+        expected_version = request.get("expectedVersion")
+        if expected_version is not None and int(expected_version) != job.version_number:
+            self.reject(topic, "VersionMismatch", client_token)
+            return
+        job.status = request["status"]
+        job.status_details = request.get("statusDetails")
+        job.version_number += 1
+        response = {"clientToken": client_token, "timestamp": now}
+        if request.get("includeJobExecutionState"):
+            response["executionState"] = job.state()
+        self.respond(topic + "/accepted", response)
+        if job.status not in ("QUEUED", "IN_PROGRESS"):
+            self.notify_changed()
+
+    def notify_changed(self):
+        pending = self.pending()
+        self.respond(
+            self.jobs_prefix + "notify",
+            {
+                "jobs": {
+                    "QUEUED": [j.summary() for j in pending if j.status == "QUEUED"],
+                    "IN_PROGRESS": [j.summary() for j in pending if j.status != "QUEUED"],
+                },
+                "timestamp": int(time.time()),
+            },
+        )
+        next_jobs = sorted(pending, key=lambda j: (j.status == "QUEUED", j.queued_at))
+        notify_next = {"timestamp": int(time.time())}
+        if next_jobs:
+            notify_next["execution"] = next_jobs[0].execution(self.thing_name)
+        self.respond(self.jobs_prefix + "notify-next", notify_next)
+
+    def reject(self, topic, code, client_token):
+        self.respond(
+            topic + "/rejected",
+            {"code": code, "message": code, "clientToken": client_token, "timestamp": 0},
+        )
+
+    def respond(self, topic, payload):
+        def deliver():
+            with self.lock:
+                callbacks = [
+                    callback
+                    for subscription, callback in self.subscriptions.items()
+                    if topic_matches(subscription, topic)
+                ]
+            for callback in callbacks:
+                callback(
+                    topic=topic,
+                    payload=json.dumps(payload).encode(),
+                    dup=False,
+                    qos=1,
+                    retain=False,
+                )
+
+        self.later(deliver)
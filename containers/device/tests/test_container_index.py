@@ -0,0 +1,90 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from container_index import ContainerIndex
+
+
+class FakeContainer:
+    def __init__(self, container_id, name, component, version, created):
+        self.id = container_id
+        self.name = name
+        self.labels = {"device": "device-0", "component": component, "version": version}
+        self.attrs = {"Created": created, "State": {"Status": "created"}}
+
+
+class FakeContainers:
+    def __init__(self):
+        self.containers = {}
+
+    def list(self, all=False, filters=None):
+        return [self.get(container_id) for container_id in self.containers]
+
+    def get(self, container_id):
+        container = self.containers[container_id]
+        # docker returns new objects for every request
+        return FakeContainer(
+            container.id,
+            container.name,
+            container.labels["component"],
+            container.labels["version"],
+            container.attrs["Created"],
+        )
+
+
+class FakeDockerClient:
+    def __init__(self):
+        self.containers = FakeContainers()
+
+    def create(self, container_id, name, component, version, created):
+        self.containers.containers[container_id] = FakeContainer(
+            container_id, name, component, version, created
+        )
+        return {"Actor": {"ID": container_id}, "Action": "create"}
+
+    def rename(self, container_id, name):
+        self.containers.containers[container_id].name = name
+        return {"Actor": {"ID": container_id}, "Action": "rename"}
+
+    def destroy(self, container_id):
+        del self.containers.containers[container_id]
+        return {"Actor": {"ID": container_id}, "Action": "destroy"}
+
+
+def test_indexes_by_name_and_component():
+    docker_client = FakeDockerClient()
+    docker_client.create("a", "device-0-ros-1", "ros", "1", "2024-01-01T00:00:00Z")
+    docker_client.create("b", "device-0-ros-2", "ros", "2", "2024-01-02T00:00:00Z")
+    index = ContainerIndex(docker_client, "device-0")
+    index.sync()
+
+    assert index.get("device-0-ros-2").id == "b"
+    assert index.find("ros", 1).id == "a"
+    assert index.find("ros", 3) is None
+    assert index.get("device-0-ros-3") is None
+
+
+def test_follows_containers_renamed_out_of_the_way():
+    docker_client = FakeDockerClient()
+    docker_client.create("old", "device-0-ros-2", "ros", "2", "2024-01-01T00:00:00Z")
+    index = ContainerIndex(docker_client, "device-0")
+    index.sync()
+
+    index.on_event(docker_client.rename("old", "device-0-ros-2-old"))
+    assert index.get("device-0-ros-2") is None
+    assert index.get("device-0-ros-2-old").id == "old"
+    assert index.find("ros", 2).id == "old"
+
+    index.on_event(
+        docker_client.create("new", "device-0-ros-2", "ros", "2", "2024-01-02T00:00:00Z")
+    )
+    assert index.get("device-0-ros-2").id == "new"
+    assert index.find("ros", 2).id == "new"
+
+    # Once the new container is gone, the renamed one is the component's container again
+    index.on_event(docker_client.destroy("new"))
+    assert index.get("device-0-ros-2") is None
+    assert index.find("ros", 2).id == "old"
+
+    index.on_event(docker_client.destroy("old"))
+    assert index.find("ros", 2) is None
+    assert index.list() == []
@@ -0,0 +1,162 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+import pytest
+import discover_gg_connection
+from discover_gg_connection import connect_to_cores, race_connections
+
+
+class FakeProbe:
+    """Answers after a delay for each host, or fails. Keeps when each probe was started."""
+
+    def __init__(self, delays, fail=()):
+        self.delays = delays
+        self.fail = fail
+        self.started = {}
+
+    def __call__(self, gg_group, gg_core, connectivity_info):
+        host = connectivity_info.host_address
+        self.started[host] = time.monotonic()
+        time.sleep(self.delays[host])
+        if host in self.fail:
+            raise ConnectionRefusedError(host)
+
+
+class FakeConnection:
+    """Connects after connect_seconds, unless it fails."""
+
+    def __init__(self, host, connect_seconds=0.01, fail=False):
+        self.host = host
+        self.connect_seconds = connect_seconds
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.connect_future = Future()
+        self.connected = False
+
+    def connect(self):
+        timer = threading.Timer(self.connect_seconds, self.on_connect_timer)
+        timer.daemon = True
+        timer.start()
+        return self.connect_future
+
+    def on_connect_timer(self):
+        with self.lock:
+            if self.fail:
+                self.connect_future.set_exception(ConnectionRefusedError(self.host))
+                return
+            self.connected = True
+        self.connect_future.set_result({"session_present": True})
+
+    def disconnect(self):
+        future = Future()
+        with self.lock:
+            if self.connected:
+                self.connected = False
+                future.set_result({})
+            else:
+                # Like awscrt, an attempt still waiting for its CONNACK isn't aborted
+                future.set_exception(RuntimeError("AWS_ERROR_MQTT_NOT_CONNECTED"))
+        return future
+
+
+def make_candidates(hosts):
+    return [
+        (
+            SimpleNamespace(certificate_authorities=["ca"]),
+            SimpleNamespace(thing_arn="arn:aws:iot:us-west-2:123456789012:thing/core"),
+            SimpleNamespace(host_address=host, port=8883),
+        )
+        for host in hosts
+    ]
+
+
+def race(probe, stagger=0.05):
+    candidate = race_connections(make_candidates(probe.delays), probe, stagger=stagger)
+    return candidate[2].host_address
+
+
+def test_first_to_answer_wins():
+    probe = FakeProbe({"slow": 1.0, "fast": 0.05})
+    assert race(probe) == "fast"
+
+
+def test_probes_start_staggered():
+    probe = FakeProbe({"slow": 1.0, "fast": 0.05, "unstarted": 0.05})
+    assert race(probe, stagger=0.2) == "fast"
+    assert "unstarted" not in probe.started
+
+
+def test_failed_probe_starts_the_next_straight_away():
+    probe = FakeProbe({"failing": 0.01, "second": 0.01}, fail={"failing"})
+    start = time.monotonic()
+    assert race(probe, stagger=5) == "second"
+    assert time.monotonic() - start < 1
+
+
+def test_every_probe_failing_raises():
+    with pytest.raises(RuntimeError):
+        race(FakeProbe({"a": 0.01, "b": 0.01}, fail={"a", "b"}))
+
+
+@pytest.fixture
+def cores(monkeypatch):
+    """Stands in for the Greengrass cores, keeping the MQTT connections made to each host.
+    Hosts added to fail refuse MQTT connections."""
+    cores = SimpleNamespace(connections={}, fail=set())
+
+    def mtls_from_path(endpoint, **kwargs):
+        connection = FakeConnection(endpoint, fail=endpoint in cores.fail)
+        cores.connections.setdefault(endpoint, []).append(connection)
+        return connection
+
+    monkeypatch.setattr(
+        discover_gg_connection.mqtt_connection_builder, "mtls_from_path", mtls_from_path
+    )
+    return cores
+
+
+def connect(monkeypatch, probe):
+    monkeypatch.setattr(discover_gg_connection, "probe_core", probe)
+    discover_response = SimpleNamespace(
+        gg_groups=[
+            SimpleNamespace(
+                certificate_authorities=["ca"],
+                cores=[
+                    SimpleNamespace(
+                        thing_arn="arn:aws:iot:us-west-2:123456789012:thing/core",
+                        connectivity=[
+                            SimpleNamespace(host_address=host, port=8883) for host in probe.delays
+                        ],
+                    )
+                ],
+            )
+        ]
+    )
+    return connect_to_cores("thing", "key", "cert", discover_response)
+
+
+def test_only_the_winner_is_sent_a_connect(monkeypatch, cores):
+    probe = FakeProbe({"slow": 0.6, "fast": 0.05})
+    mqtt_connection = connect(monkeypatch, probe)
+    assert mqtt_connection.host == "fast"
+    time.sleep(0.5)
+    # The slow core answered too, but never saw the thing's client id
+    assert list(cores.connections) == ["fast"]
+
+
+def test_winner_refusing_connect_races_the_others_again(monkeypatch, cores):
+    cores.fail.add("fast")
+    probe = FakeProbe({"fast": 0.01, "slow": 0.1})
+    mqtt_connection = connect(monkeypatch, probe)
+    assert mqtt_connection.host == "slow"
+    assert list(cores.connections) == ["fast", "slow"]
+
+
+def test_every_core_refusing_connect_raises(monkeypatch, cores):
+    cores.fail.update({"a", "b"})
+    with pytest.raises(RuntimeError):
+        connect(monkeypatch, FakeProbe({"a": 0.01, "b": 0.01}))
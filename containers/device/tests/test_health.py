@@ -0,0 +1,92 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+from container_index import ContainerIndex
+from health import wait_until_healthy
+
+
+class FakeContainer:
+    def __init__(self, container_id, status):
+        self.id = container_id
+        self.name = f"device-0-{container_id}"
+        self.labels = {"device": "device-0"}
+        self.attrs = {"Config": {}, "State": {"Status": status}}
+
+    @property
+    def status(self):
+        return self.attrs["State"]["Status"]
+
+
+class FakeContainers:
+    def __init__(self):
+        self.containers = {}
+
+    def list(self, all=False, filters=None):
+        return list(self.containers.values())
+
+    def get(self, container_id):
+        return self.containers[container_id]
+
+
+class FakeDockerClient:
+    def __init__(self):
+        self.containers = FakeContainers()
+
+
+def make_index(**statuses):
+    docker_client = FakeDockerClient()
+    for container_id, status in statuses.items():
+        docker_client.containers.containers[container_id] = FakeContainer(container_id, status)
+    index = ContainerIndex(docker_client, "device-0")
+    index.sync()
+    return index
+
+
+def send_events_later(index, *events, delay=0.1):
+    def send():
+        for container_id, action in events:
+            time.sleep(delay)
+            index.on_event({"Actor": {"ID": container_id}, "Action": action})
+
+    threading.Thread(target=send, daemon=True).start()
+
+
+def test_created_container_is_pending_until_it_starts():
+    index = make_index(new="created")
+    send_events_later(index, ("new", "start"))
+    healthy, reason = wait_until_healthy(index, [FakeContainer("new", "created")], 5, 0.2)
+    assert healthy, reason
+
+
+def test_reused_exited_container_is_pending_until_it_starts():
+    index = make_index(reused="exited")
+    send_events_later(index, ("reused", "start"))
+    healthy, reason = wait_until_healthy(index, [FakeContainer("reused", "exited")], 5, 0.2)
+    assert healthy, reason
+
+
+def test_container_missing_from_index_is_pending_until_it_starts():
+    index = make_index()
+    index.docker_client.containers.containers["new"] = FakeContainer("new", "running")
+    send_events_later(index, ("new", "create"))
+    healthy, reason = wait_until_healthy(index, [FakeContainer("new", "created")], 5, 0.2)
+    assert healthy, reason
+
+
+def test_container_exiting_after_it_started_fails_straight_away():
+    index = make_index(new="created")
+    send_events_later(index, ("new", "start"), ("new", "die"))
+    start = time.monotonic()
+    healthy, reason = wait_until_healthy(index, [FakeContainer("new", "created")], 5, 2)
+    assert not healthy
+    assert reason == "device-0-new is exited"
+    assert time.monotonic() - start < 1
+
+
+def test_container_never_starting_times_out():
+    index = make_index(new="created")
+    healthy, reason = wait_until_healthy(index, [FakeContainer("new", "created")], 0.2, 0)
+    assert not healthy
+    assert reason == "not healthy after 0.2s"
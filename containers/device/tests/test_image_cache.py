@@ -0,0 +1,92 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+import state_store
+from image_cache import ImageCache
+
+REGISTRY = "registry:5000"
+
+
+class FakeImage:
+    def __init__(self, image_id, tags, digests=None):
+        self.id = image_id
+        self.tags = tags or []
+        self.attrs = {"RepoTags": tags, "RepoDigests": digests}
+
+
+class FakeImages:
+    def __init__(self, images):
+        self.images = {image.id: image for image in images}
+
+    def list(self):
+        return list(self.images.values())
+
+    def remove(self, image_id, force=False):
+        del self.images[image_id]
+
+    def prune(self, filters=None):
+        return {"SpaceReclaimed": None}
+
+
+class FakeDockerClient:
+    def __init__(self, images):
+        self.images = FakeImages(images)
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(state_store, "state_dir", str(tmp_path))
+
+
+def bundle(version):
+    return [
+        FakeImage(f"{name}-{version}", [f"{REGISTRY}/{name}:{version}"])
+        for name in ("ros", "nav", "camera")
+    ]
+
+
+def use(image_cache, images):
+    # Used one after another, in order
+    for image in images:
+        image_cache.last_used[image.id] = len(image_cache.last_used) + 1
+
+
+def test_keeps_every_image_of_the_latest_versions():
+    image_cache = ImageCache(REGISTRY, keep_versions=2, disk_budget_bytes=0)
+    versions = [bundle(version) for version in ("1", "2", "3")]
+    for images in versions:
+        use(image_cache, images)
+    docker_client = FakeDockerClient([image for images in versions for image in images])
+
+    image_cache.evict(docker_client, [], protected_names=set())
+
+    assert sorted(docker_client.images.images) == sorted(
+        image.id for image in versions[1] + versions[2]
+    )
+
+
+def test_image_shared_by_versions_is_kept_with_either():
+    image_cache = ImageCache(REGISTRY, keep_versions=1, disk_budget_bytes=0)
+    shared = FakeImage("ros-shared", [f"{REGISTRY}/ros:1", f"{REGISTRY}/ros:2"])
+    old = FakeImage("nav-1", [f"{REGISTRY}/nav:1"])
+    new = FakeImage("nav-2", [f"{REGISTRY}/nav:2"])
+    use(image_cache, [old, shared, new])
+    docker_client = FakeDockerClient([shared, old, new])
+
+    image_cache.evict(docker_client, [], protected_names=set())
+
+    assert sorted(docker_client.images.images) == ["nav-2", "ros-shared"]
+
+
+def test_images_without_tags_or_digests():
+    image_cache = ImageCache(REGISTRY, keep_versions=1, disk_budget_bytes=0)
+    untagged = FakeImage("untagged", None)
+    by_digest = FakeImage("by-digest", None, [f"{REGISTRY}/ros@sha256:1234"])
+    use(image_cache, [by_digest])
+    docker_client = FakeDockerClient([untagged, by_digest])
+
+    image_cache.evict(docker_client, [], protected_names=set())
+
+    # Not firmware, so left alone, and the image pulled by digest is a version of its own
+    assert sorted(docker_client.images.images) == ["by-digest", "untagged"]
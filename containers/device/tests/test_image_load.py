@@ -0,0 +1,132 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import hashlib
+import http.server
+import io
+import tarfile
+import threading
+import pytest
+from image_load import CHUNK_SIZE, ChecksumMismatch, load_archive
+
+
+class FakeImage:
+    def __init__(self, tags):
+        self.tags = tags
+
+
+class FakeImages:
+    """Stands in for docker's images collection, keeping what docker load was sent."""
+
+    def __init__(self):
+        self.loaded = []
+
+    def load(self, data):
+        # Like the daemon, an archive cut short by an error while streaming loads nothing
+        archive = b"".join(data)
+        self.loaded.append(archive)
+        return [FakeImage(["registry:5000/ros:v2"])]
+
+
+class FakeDockerClient:
+    def __init__(self):
+        self.images = FakeImages()
+
+
+def make_archive():
+    # Larger than a chunk, so the archive is streamed in several
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar:
+        data = bytes(range(256)) * (CHUNK_SIZE // 128)
+        info = tarfile.TarInfo("layer.tar")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return stream.getvalue()
+
+
+@pytest.fixture
+def depot():
+    """A plain HTTP server standing in for a depot server. Returns a function which serves a
+    file and returns its URL."""
+    files = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = files.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def serve(path, body):
+        files[path] = body
+        return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+    yield serve
+    server.shutdown()
+    server.server_close()
+
+
+def test_loads_archive_from_http(depot):
+    archive = make_archive()
+    url = depot("/firmware.tar", archive)
+    docker_client = FakeDockerClient()
+    progress_updates = []
+
+    images, progress = load_archive(
+        docker_client,
+        url,
+        "sha256:" + hashlib.sha256(archive).hexdigest(),
+        progress_callback=lambda progress: progress_updates.append(progress.downloaded_bytes),
+    )
+
+    assert docker_client.images.loaded == [archive]
+    assert images[0].tags == ["registry:5000/ros:v2"]
+    assert progress.total_bytes == len(archive)
+    assert progress.downloaded_bytes == len(archive)
+    assert len(progress_updates) > 1
+
+
+def test_checksum_mismatch_loads_nothing(depot):
+    archive = make_archive()
+    url = depot("/firmware.tar", archive)
+    docker_client = FakeDockerClient()
+
+    with pytest.raises(ChecksumMismatch):
+        load_archive(docker_client, url, hashlib.sha256(b"something else").hexdigest())
+
+    assert docker_client.images.loaded == []
+
+
+def test_loads_zstd_archive_from_http(depot):
+    zstandard = pytest.importorskip("zstandard")
+    archive = make_archive()
+    compressed = zstandard.ZstdCompressor().compress(archive)
+    url = depot("/firmware.tar.zst", compressed)
+    docker_client = FakeDockerClient()
+
+    load_archive(docker_client, url, hashlib.sha256(compressed).hexdigest())
+
+    assert docker_client.images.loaded == [archive]
+
+
+def test_check_aborts_load(depot):
+    url = depot("/firmware.tar", make_archive())
+    docker_client = FakeDockerClient()
+
+    def check():
+        raise RuntimeError("canceled")
+
+    with pytest.raises(RuntimeError):
+        load_archive(docker_client, url, "", check=check)
+
+    assert docker_client.images.loaded == []
@@ -0,0 +1,200 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import asyncio
+import logging
+import threading
+import time
+from fake_jobs import FakeJobsBroker
+from job_handler import JobHandler, JobState, SeenExecutions
+
+THING_NAME = "test-thing"
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for condition")
+        time.sleep(0.01)
+
+
+class Agent:
+    """Runs a JobHandler against a FakeJobsBroker on a background thread."""
+
+    def __init__(self, broker, callback=None, **kwargs):
+        self.broker = broker
+        self.ran = []
+        self.callback = callback or (lambda job_id, job_document, report_progress, control: None)
+        self.job_handler = JobHandler(
+            THING_NAME,
+            broker,
+            self.job_handler_callback,
+            seen_executions=SeenExecutions(state_name=None),
+            cancel_grace_seconds=1,
+            **kwargs,
+        )
+        self.thread = threading.Thread(target=self.job_handler.run, daemon=True)
+
+    def job_handler_callback(self, job_id, job_document, report_progress, control):
+        self.ran.append(job_id)
+        return self.callback(job_id, job_document, report_progress, control) or (True, {})
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.job_handler.exit("Test complete")
+        self.thread.join(timeout=10)
+        assert not self.thread.is_alive()
+
+    def wait_for_jobs(self):
+        wait_until(lambda: not self.broker.pending())
+
+
+def test_runs_every_queued_job():
+    broker = FakeJobsBroker(THING_NAME)
+    for i in range(4):
+        broker.add_job(f"job-{i}", {"operation": "Test"})
+    with Agent(broker) as agent:
+        agent.wait_for_jobs()
+    assert agent.ran == ["job-0", "job-1", "job-2", "job-3"]
+    assert all(job.status == "SUCCEEDED" for job in broker.jobs)
+
+
+def test_runs_every_queued_job_with_broker_round_trip_time():
+    broker = FakeJobsBroker(THING_NAME, rtt=0.01)
+    for i in range(2):
+        broker.add_job(f"job-{i}", {"operation": "Test"})
+    with Agent(broker) as agent:
+        agent.wait_for_jobs()
+    assert agent.ran == ["job-0", "job-1"]
+
+
+def test_single_pending_job_is_started_with_start_next():
+    broker = FakeJobsBroker(THING_NAME)
+    broker.add_job("job-0", {"operation": "Test"})
+    with Agent(broker) as agent:
+        agent.wait_for_jobs()
+    assert agent.ran == ["job-0"]
+    # Listed, then started without describing it
+    operations = [topic[len(broker.jobs_prefix) :] for topic, _ in broker.published]
+    assert operations == ["get", "start-next", "job-0/update"]
+
+
+def test_backlog_at_startup_is_ranked_before_starting_anything():
+    broker = FakeJobsBroker(THING_NAME)
+    for version in (2, 3, 4):
+        broker.add_job(f"deploy-{version}", {"operation": "Deploy-ROS-Firmware"})
+    broker.add_job("rollback", {"operation": "Rollback-ROS-Firmware"})
+    with Agent(broker) as agent:
+        agent.wait_for_jobs()
+    # The rollback preempts the updates, and of those only the latest is installed
+    assert agent.ran == ["rollback", "deploy-4"]
+    for superseded in ("deploy-2", "deploy-3"):
+        assert broker.job(superseded).status == "REJECTED"
+        assert broker.job(superseded).status_details["supersededBy"] == "deploy-4"
+    # Nothing was started before the backlog was ranked
+    operations = [topic[len(broker.jobs_prefix) :] for topic, _ in broker.published]
+    assert operations.index("rollback/update") < operations.index("start-next")
+
+
+def test_callback_exception_fails_job_not_agent():
+    broker = FakeJobsBroker(THING_NAME)
+    broker.add_job("job-0", {"operation": "Test"})
+    broker.add_job("job-1", {"operation": "Test"})
+
+    def callback(job_id, job_document, report_progress, control):
+        if job_id == "job-0":
+            raise RuntimeError("500 Server Error: Internal Server Error")
+
+    with Agent(broker, callback) as agent:
+        agent.wait_for_jobs()
+        assert agent.job_handler.state != JobState.DISCONNECTING
+    assert agent.ran == ["job-0", "job-1"]
+    assert broker.job("job-0").status == "FAILED"
+    assert "500 Server Error" in broker.job("job-0").status_details["error"]
+    assert broker.job("job-1").status == "SUCCEEDED"
+
+
+async def handle_events(job_handler):
+    """Handle the events the broker has posted so far, one at a time, on the test's loop."""
+    await asyncio.sleep(0)
+    while not job_handler.events.empty():
+        name, payload = job_handler.events.get_nowait()
+        await job_handler.handle_event(name, payload)
+        await asyncio.sleep(0)
+
+
+def test_job_finishing_while_disconnecting_is_not_reported():
+    broker = FakeJobsBroker(THING_NAME)
+    broker.add_job("job-0", {"operation": "Test"})
+    working = threading.Event()
+    finish = threading.Event()
+
+    def callback(job_id, job_document, report_progress, control):
+        working.set()
+        finish.wait(timeout=10)
+        return True, {}
+
+    job_handler = JobHandler(
+        THING_NAME, broker, callback, seen_executions=SeenExecutions(state_name=None)
+    )
+
+    async def scenario():
+        job_handler.loop = asyncio.get_running_loop()
+        job_handler.events = asyncio.Queue()
+        job_handler.done = asyncio.Event()
+        await job_handler.subscribe_all()
+        await job_handler.request_next_job()
+        await handle_events(job_handler)
+        assert job_handler.state == JobState.WORKING
+        await job_handler.loop.run_in_executor(None, working.wait, 10)
+
+        await job_handler.disconnect("Shutting down")
+        finish.set()
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        await asyncio.wait(tasks, timeout=10)
+        assert job_handler.state == JobState.DISCONNECTING
+
+    asyncio.run(scenario())
+    job_handler.executor.shutdown()
+    assert broker.requests("update") == []
+    # Left in progress, to be resumed from the job journal after a restart
+    assert broker.job("job-0").status == "IN_PROGRESS"
+
+
+def test_puback_after_shutdown(caplog):
+    broker = FakeJobsBroker(THING_NAME)
+    broker.add_job("job-0", {"operation": "Test"})
+
+    def callback(job_id, job_document, report_progress, control):
+        # The broker stops acknowledging, so the final status update is still in flight when
+        # the agent shuts down
+        broker.hold_acks = True
+
+    with caplog.at_level(logging.ERROR):
+        with Agent(broker, callback, publish_drain_seconds=0.1) as agent:
+            wait_until(lambda: broker.held_acks)
+        broker.release_acks()
+    assert agent.ran == ["job-0"]
+    assert [record.getMessage() for record in caplog.records] == []
+
+
+def test_disconnect_waits_for_final_status_to_be_acknowledged():
+    broker = FakeJobsBroker(THING_NAME)
+    broker.add_job("job-0", {"operation": "Test"})
+
+    def callback(job_id, job_document, report_progress, control):
+        broker.hold_acks = True
+
+    with Agent(broker, callback) as agent:
+        wait_until(lambda: broker.held_acks)
+        agent.job_handler.exit("Shutting down")
+        time.sleep(0.1)
+        assert agent.thread.is_alive()
+        broker.release_acks()
+        agent.thread.join(timeout=5)
+        assert not agent.thread.is_alive()
+    assert broker.job("job-0").status == "SUCCEEDED"
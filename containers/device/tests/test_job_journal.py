@@ -0,0 +1,42 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import sqlite3
+from job_journal import JobJournal
+
+
+def test_resumes_the_same_execution(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal.db"))
+    journal.record("job-0", 1, "swapping", {"active": ["device-0-ros-1"]})
+
+    reopened = JobJournal(str(tmp_path / "journal.db"))
+    assert reopened.last_phase("job-0", 1) == ("swapping", {"active": ["device-0-ros-1"]})
+
+
+def test_retried_execution_starts_over(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal.db"))
+    journal.record("job-0", 1, "completed", {"success": False, "statusDetails": {}})
+
+    assert journal.last_phase("job-0", 2) == (None, {})
+
+
+def test_opens_journal_without_execution_numbers(tmp_path):
+    path = str(tmp_path / "journal.db")
+    db = sqlite3.connect(path)
+    db.execute("""CREATE TABLE job_phases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            phase TEXT NOT NULL,
+            data TEXT NOT NULL,
+            recorded_at REAL NOT NULL
+        )""")
+    db.execute(
+        "INSERT INTO job_phases (job_id, phase, data, recorded_at) VALUES ('job-0', 'completed', '{}', 0)"
+    )
+    db.commit()
+    db.close()
+
+    journal = JobJournal(path)
+    assert journal.last_phase("job-0", 1) == (None, {})
+    journal.record("job-0", 1, "swapping", {})
+    assert journal.last_phase("job-0", 1) == ("swapping", {})
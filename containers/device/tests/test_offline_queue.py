@@ -0,0 +1,102 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from service.offline_queue import DROP_NEWEST, RECORD, OfflineQueue
+
+# Every message in these tests is on topic "t" with a 10 byte payload
+MESSAGE_SIZE = RECORD.size + 1 + 10
+
+
+def message(i):
+    return b"message-%02d" % i
+
+
+def read_all(queue):
+    messages = []
+    entry = queue.peek()
+    while entry:
+        offset, topic, payload, next_offset = entry
+        messages.append(payload)
+        entry = queue.peek(next_offset)
+    return messages
+
+
+def test_wraps_around_the_end_of_the_file(tmp_path):
+    queue = OfflineQueue(str(tmp_path / "queue"), 4 * MESSAGE_SIZE + 5)
+    for i in range(3):
+        assert queue.put("t", message(i))
+    for _ in range(2):
+        queue.ack(queue.peek()[0])
+    # The second of these is split across the end of the file
+    for i in range(3, 6):
+        assert queue.put("t", message(i))
+
+    assert read_all(queue) == [message(i) for i in range(2, 6)]
+    assert queue.stats()["depth"] == 4
+    assert queue.stats()["droppedOldest"] == 0
+
+
+def test_drops_oldest_message_while_it_is_in_flight(tmp_path):
+    queue = OfflineQueue(str(tmp_path / "queue"), 3 * MESSAGE_SIZE)
+    for i in range(3):
+        queue.put("t", message(i))
+    in_flight, _, payload, next_offset = queue.peek()
+    assert payload == message(0)
+
+    # Makes room by dropping the message being delivered
+    assert queue.put("t", message(3))
+    assert queue.stats()["droppedOldest"] == 1
+
+    # Its late acknowledgement doesn't remove anything else
+    queue.ack(in_flight)
+    assert queue.stats()["delivered"] == 0
+    assert read_all(queue) == [message(i) for i in range(1, 4)]
+    assert queue.peek(next_offset)[2] == message(1)
+
+
+def test_acknowledged_out_of_order(tmp_path):
+    queue = OfflineQueue(str(tmp_path / "queue"), 10 * MESSAGE_SIZE)
+    for i in range(3):
+        queue.put("t", message(i))
+    first = queue.peek()
+    second = queue.peek(first[3])
+
+    queue.ack(second[0])
+    # Kept until the message before it is acknowledged too, but not delivered again
+    assert queue.stats()["depth"] == 3
+    assert queue.peek()[2] == message(0)
+    assert queue.peek(first[3])[2] == message(2)
+
+    queue.ack(first[0])
+    assert queue.stats()["depth"] == 1
+    assert read_all(queue) == [message(2)]
+
+
+def test_reopens_with_the_messages_not_yet_acknowledged(tmp_path):
+    path = str(tmp_path / "queue")
+    queue = OfflineQueue(path, 10 * MESSAGE_SIZE)
+    for i in range(3):
+        queue.put("t", message(i))
+    queue.ack(queue.peek()[0])
+    queue.close()
+
+    queue = OfflineQueue(path, 10 * MESSAGE_SIZE)
+    assert read_all(queue) == [message(1), message(2)]
+    assert queue.peek()[1] == "t"
+    queue.close()
+
+    # A queue opened with another capacity starts out empty
+    queue = OfflineQueue(path, 20 * MESSAGE_SIZE)
+    assert read_all(queue) == []
+
+
+def test_drop_newest_keeps_the_queued_messages(tmp_path):
+    queue = OfflineQueue(str(tmp_path / "queue"), 2 * MESSAGE_SIZE, overflow=DROP_NEWEST)
+    assert queue.put("t", message(0))
+    assert queue.put("t", message(1))
+    assert not queue.put("t", message(2))
+    # Too large for the queue at all
+    assert not queue.put("t", b"x" * 3 * MESSAGE_SIZE)
+
+    assert read_all(queue) == [message(0), message(1)]
+    assert queue.stats()["droppedNewest"] == 2
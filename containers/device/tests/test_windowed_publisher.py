@@ -0,0 +1,141 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from concurrent.futures import Future
+import pytest
+from service.offline_queue import RECORD, OfflineQueue
+from service.windowed_publisher import WindowedPublisher
+
+
+class FakeLogger:
+    def __init__(self):
+        self.messages = []
+
+    def warn(self, message):
+        self.messages.append(message)
+
+    def error(self, message):
+        self.messages.append(message)
+
+
+class FakeConnection:
+    """Keeps each publish's future, to be acknowledged by the test in any order."""
+
+    def __init__(self):
+        self.publishes = []
+
+    def publish(self, topic, payload, qos):
+        future = Future()
+        self.publishes.append((topic, payload, future))
+        return future, len(self.publishes)
+
+    def payloads(self):
+        return [payload for _, payload, _ in self.publishes]
+
+    def ack(self, payload):
+        future = next(future for _, sent, future in self.publishes if sent == payload)
+        future.set_result({"packet_id": 1})
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = OfflineQueue(str(tmp_path / "queue"), 4096)
+    yield queue
+    queue.close()
+
+
+def test_publishes_at_most_a_window_of_messages(queue):
+    publisher = WindowedPublisher(FakeLogger(), queue, window=2)
+    connection = FakeConnection()
+    for i in range(4):
+        queue.put("t", b"%d" % i)
+
+    publisher.drain(connection)
+    assert connection.payloads() == [b"0", b"1"]
+    assert publisher.is_full()
+
+    connection.ack(b"0")
+    assert connection.payloads() == [b"0", b"1", b"2"]
+    assert queue.stats()["depth"] == 3
+
+
+def test_acknowledged_out_of_order(queue):
+    publisher = WindowedPublisher(FakeLogger(), queue, window=2)
+    connection = FakeConnection()
+    for i in range(4):
+        queue.put("t", b"%d" % i)
+    publisher.drain(connection)
+
+    connection.ack(b"1")
+    # The slot is free, and the first message is not published again
+    assert connection.payloads() == [b"0", b"1", b"2"]
+    assert queue.stats()["depth"] == 4
+
+    connection.ack(b"0")
+    assert connection.payloads() == [b"0", b"1", b"2", b"3"]
+    assert queue.stats()["depth"] == 2
+    assert publisher.stats()["published"] == 2
+
+
+def test_failed_publish_is_published_again(queue):
+    logger = FakeLogger()
+    publisher = WindowedPublisher(logger, queue, window=2)
+    connection = FakeConnection()
+    queue.put("t", b"0")
+    publisher.drain(connection)
+
+    connection.publishes[0][2].set_exception(RuntimeError("AWS_ERROR_MQTT_TIMEOUT"))
+    assert publisher.stats()["publishFailures"] == 1
+    publisher.drain(connection)
+    assert connection.payloads() == [b"0", b"0"]
+
+
+def test_republishes_in_flight_messages_on_a_new_connection(queue):
+    publisher = WindowedPublisher(FakeLogger(), queue, window=2)
+    old_connection = FakeConnection()
+    for i in range(3):
+        queue.put("t", b"%d" % i)
+    publisher.drain(old_connection)
+
+    new_connection = FakeConnection()
+    publisher.republish(new_connection)
+    assert new_connection.payloads() == [b"0", b"1"]
+
+
+def test_in_flight_message_dropped_to_make_room(tmp_path):
+    message_size = RECORD.size + 1 + 1
+    queue = OfflineQueue(str(tmp_path / "queue"), 3 * message_size)
+    publisher = WindowedPublisher(FakeLogger(), queue, window=1)
+    connection = FakeConnection()
+    for i in range(3):
+        queue.put("t", b"%d" % i)
+    publisher.drain(connection)
+
+    queue.put("t", b"3")
+    assert queue.stats()["droppedOldest"] == 1
+    # The dropped message's PUBACK removes nothing else, and frees its slot
+    connection.ack(b"0")
+    assert connection.payloads() == [b"0", b"1"]
+    assert queue.stats()["depth"] == 3
+
+
+def test_coalesces_messages_while_the_window_is_full(queue):
+    publisher = WindowedPublisher(FakeLogger(), queue, window=2)
+    connection = FakeConnection()
+    for i in range(2):
+        publisher.coalesce("t", b"%d" % i)
+        publisher.drain(connection)
+    assert publisher.is_full()
+
+    for i in range(2, 6):
+        publisher.coalesce("t", b"%d" % i)
+        publisher.coalesce("u", b"u%d" % i)
+        publisher.drain(connection)
+    assert publisher.stats()["held"] == 2
+    assert publisher.stats()["coalesced"] == 6
+
+    # Only the latest message held for each topic is queued once a slot frees
+    connection.ack(b"0")
+    connection.ack(b"1")
+    assert connection.payloads() == [b"0", b"1", b"5", b"u5"]
+    assert publisher.stats()["held"] == 0
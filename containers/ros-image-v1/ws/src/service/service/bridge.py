@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import json
+import struct
+import threading
+import time
+import rclpy
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup, ReentrantCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
+from rclpy.node import Node
+from rclpy.qos import QoSProfile, ReliabilityPolicy
+from rosidl_runtime_py.utilities import get_message
+from std_msgs.msg import String
+from service.connection_helper import ConnectionHelper
+from service.offline_queue import OfflineQueue
+from service.windowed_publisher import WindowedPublisher
+
+try:
+    import cbor2
+    from rosidl_runtime_py.convert import message_to_ordereddict
+except ImportError:
+    cbor2 = None
+
+# A "cdr" frame is the frame header, the message type, then for each message the message header
+# and the message as serialized by ROS, passed through without deserializing it.
+# magic, message type length, message count
+FRAME_HEADER = struct.Struct("<4sHI")
+FRAME_MAGIC = b"RBF1"
+# receive time in nanoseconds, serialized message length
+MESSAGE_HEADER = struct.Struct("<qI")
+
+
+class TopicBatch:
+    """Messages received on one ROS topic since its last frame, and its throughput counters."""
+
+    def __init__(self, ros_topic, message_type, mqtt_topic):
+        self.ros_topic = ros_topic
+        self.message_type = message_type
+        self.mqtt_topic = mqtt_topic
+        self.lock = threading.Lock()
+        self.messages = []
+        self.size = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.frames = 0
+        self.frame_bytes = 0
+        self.dropped_frames = 0
+        self.last_received = 0
+
+    def stats(self, interval):
+        with self.lock:
+            stats = {
+                "received": self.received,
+                "receivedBytes": self.received_bytes,
+                "rateHz": round((self.received - self.last_received) / interval, 1),
+                "frames": self.frames,
+                "frameBytes": self.frame_bytes,
+                "droppedFrames": self.dropped_frames,
+            }
+            self.last_received = self.received
+        return stats
+
+
+class TopicBridge(Node):
+    """Forwards ROS 2 topics to MQTT, batching each topic's messages into frames.
+
+    topics lists the topics to forward and their types, e.g.
+    "/odom:nav_msgs/msg/Odometry,/battery_state:sensor_msgs/msg/BatteryState". Each topic's
+    frames are published to <mqtt_topic_prefix><ros topic>, by default
+    clients/<client_id>/ros/odom and so on. A frame is published once it reaches
+    batch_max_bytes, or batch_max_seconds after the last one.
+
+    Frames are encoded as "cdr", the serialized messages as received (see FRAME_HEADER), or as
+    "cbor", a CBOR sequence of {"type", "count"} followed by [receive time ns, message] for
+    each message. cdr is the cheaper of the two, as messages are never deserialized.
+    """
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        super().__init__("bridge")
+        self.declare_parameter("path_for_config", "")
+        self.declare_parameter("client_id", "device-thing-0")
+        self.declare_parameter("topics", "")
+        self.declare_parameter("mqtt_topic_prefix", "")
+        self.declare_parameter("encoding", "cdr")
+        self.declare_parameter("batch_max_bytes", 64 * 1024)
+        self.declare_parameter("batch_max_seconds", 0.1)
+        self.declare_parameter("qos_depth", 100)
+        self.declare_parameter("queue_path", "/var/tmp/service/bridge.queue")
+        self.declare_parameter("queue_size_bytes", 16 * 1024 * 1024)
+        self.declare_parameter("queue_overflow", "drop-oldest")
+        self.declare_parameter("publish_window", 64)
+        self.declare_parameter("stats_period", 10.0)
+
+        path_for_config = self.get_parameter("path_for_config").get_parameter_value().string_value
+        self.client_id = self.get_parameter("client_id").get_parameter_value().string_value
+        topics = self.get_parameter("topics").get_parameter_value().string_value
+        mqtt_topic_prefix = (
+            self.get_parameter("mqtt_topic_prefix").get_parameter_value().string_value
+            or f"clients/{self.client_id}/ros"
+        )
+        self.encoding = self.get_parameter("encoding").get_parameter_value().string_value
+        self.batch_max_bytes = (
+            self.get_parameter("batch_max_bytes").get_parameter_value().integer_value
+        )
+        batch_max_seconds = (
+            self.get_parameter("batch_max_seconds").get_parameter_value().double_value
+        )
+        qos_depth = self.get_parameter("qos_depth").get_parameter_value().integer_value
+        stats_period = self.get_parameter("stats_period").get_parameter_value().double_value
+
+        if self.encoding not in ("cdr", "cbor"):
+            raise ValueError(f"Unknown encoding {self.encoding}")
+        if self.encoding == "cbor" and cbor2 is None:
+            raise ValueError("cbor encoding needs the cbor2 package")
+
+        # Subscriptions are handled concurrently, and never wait on connecting, as in MqttPublisher
+        self.ros_group = ReentrantCallbackGroup()
+        self.mqtt_group = MutuallyExclusiveCallbackGroup()
+        self.connection_helper = ConnectionHelper(
+            self.get_logger(), path_for_config, self.client_id, True, connect=False
+        )
+        self.first_callback_seconds = None
+        self.queue = OfflineQueue(
+            self.get_parameter("queue_path").get_parameter_value().string_value,
+            self.get_parameter("queue_size_bytes").get_parameter_value().integer_value,
+            self.get_parameter("queue_overflow").get_parameter_value().string_value,
+        )
+        self.publisher = WindowedPublisher(
+            self.get_logger(),
+            self.queue,
+            self.get_parameter("publish_window").get_parameter_value().integer_value,
+        )
+
+        # Best effort subscriptions match reliable and best effort publishers alike
+        qos = QoSProfile(depth=qos_depth, reliability=ReliabilityPolicy.BEST_EFFORT)
+        self.batches = []
+        for entry in filter(None, (entry.strip() for entry in topics.split(","))):
+            ros_topic, _, message_type = entry.partition(":")
+            batch = TopicBatch(ros_topic, message_type, mqtt_topic_prefix + ros_topic)
+            self.create_subscription(
+                get_message(message_type),
+                ros_topic,
+                lambda message, batch=batch: self.on_message(batch, message),
+                qos,
+                callback_group=self.ros_group,
+                raw=self.encoding == "cdr",
+            )
+            self.batches.append(batch)
+            self.get_logger().info(f"Bridging {ros_topic} ({message_type}) to {batch.mqtt_topic}")
+        if not self.batches:
+            self.get_logger().warn("No topics to bridge, set the topics parameter")
+
+        self.stats_publisher = self.create_publisher(String, "bridge/stats", 10)
+        self.last_stats_time = time.monotonic()
+        self.flush_timer = self.create_timer(
+            batch_max_seconds, self.flush_all, callback_group=self.ros_group
+        )
+        self.stats_timer = self.create_timer(
+            stats_period, self.publish_stats, callback_group=self.ros_group
+        )
+        self.connection_helper.connect_in_background(
+            self, self.mqtt_group, self.publisher, self.start_time
+        )
+
+    def on_message(self, batch, message):
+        stamp = time.time_ns()
+        if self.first_callback_seconds is None:
+            self.first_callback_seconds = time.monotonic() - self.start_time
+            self.get_logger().info(
+                f"First ROS callback {self.first_callback_seconds:.3f}s after startup"
+            )
+        if self.encoding == "cdr":
+            data = MESSAGE_HEADER.pack(stamp, len(message)) + message
+        else:
+            data = cbor2.dumps([stamp, message_to_ordereddict(message)])
+        with batch.lock:
+            batch.messages.append(data)
+            batch.size += len(data)
+            batch.received += 1
+            batch.received_bytes += len(data)
+            full = batch.size >= self.batch_max_bytes
+        if full:
+            self.flush(batch)
+
+    def flush(self, batch):
+        with batch.lock:
+            if not batch.messages:
+                return
+            messages, batch.messages, batch.size = batch.messages, [], 0
+        message_type = batch.message_type.encode("utf-8")
+        if self.encoding == "cdr":
+            header = FRAME_HEADER.pack(FRAME_MAGIC, len(message_type), len(messages)) + message_type
+        else:
+            header = cbor2.dumps({"type": batch.message_type, "count": len(messages)})
+        frame = b"".join([header] + messages)
+        queued = self.queue.put(batch.mqtt_topic, frame)
+        with batch.lock:
+            if queued:
+                batch.frames += 1
+                batch.frame_bytes += len(frame)
+            else:
+                batch.dropped_frames += 1
+        if self.connection_helper.mqtt_conn:
+            self.publisher.drain(self.connection_helper.mqtt_conn)
+
+    def flush_all(self):
+        for batch in self.batches:
+            self.flush(batch)
+
+    def publish_stats(self):
+        now = time.monotonic()
+        interval = max(now - self.last_stats_time, 1e-3)
+        self.last_stats_time = now
+        stats = {"topics": {batch.ros_topic: batch.stats(interval) for batch in self.batches}}
+        stats["queue"] = self.queue.stats()
+        stats["publisher"] = self.publisher.stats()
+        stats["firstCallbackSeconds"] = self.first_callback_seconds
+        stats["connectSeconds"] = self.connection_helper.connect_seconds
+        self.get_logger().debug(f"Bridge {stats}")
+        self.stats_publisher.publish(String(data=json.dumps(stats)))
+
+
+def main(args=None):
+    rclpy.init(args=args)
+
+    bridge = TopicBridge()
+
+    executor = MultiThreadedExecutor()
+    executor.add_node(bridge)
+    executor.spin()
+
+    bridge.flush_all()
+    bridge.queue.close()
+    bridge.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,30 +18,85 @@
 #
 
 import json
+import os
+import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from awscrt import io
 from awsiot import mqtt_connection_builder
 from awsiot.greengrass_discovery import DiscoveryClient
 
+RETRY_WAIT_TIME_SECONDS = 5
+
 
 class ConnectionHelper:
-    def __init__(self, logger, path_for_config, client_id, discover_endpoints=False):
+    def __init__(self, logger, path_for_config, client_id, discover_endpoints=False, connect=True):
         self.path_for_config = path_for_config
         self.discover_endpoints = discover_endpoints
         self.logger = logger
         self.client_id = client_id
+        # Set once connected, and replaced when failing over to another core
+        self.mqtt_conn = None
+        # Called with the new connection when messages awaiting a PUBACK must be published again:
+        # after failing over, or when a resumed connection lost its session
+        self.on_connection_changed = None
+        self.lock = threading.Lock()
+        # Discovered endpoints, fastest first, and the one connected to
+        self.endpoints = []
+        self.endpoint = None
+        self.interrupted = False
+        self.failover_timer = None
+        # Seconds from the node starting to being connected, see connect_in_background
+        self.connect_seconds = None
 
         with open(path_for_config) as f:
-            cert_data = json.load(f)
+            self.cert_data = json.load(f)
+        self.endpoint_cache_path = self.cert_data.get(
+            "endpointCachePath", f"/var/tmp/service/{client_id}-endpoints.json"
+        )
+        self.endpoint_cache_seconds = self.cert_data.get("endpointCacheSeconds", 3600)
+        self.rediscover_after_failures = self.cert_data.get("rediscoverAfterFailures", 2)
+        self.failover_after_seconds = self.cert_data.get("failoverAfterSeconds", 10)
+
+        self.logger.info("Config we are loading is :\n{}".format(self.cert_data))
 
-        self.logger.info("Config we are loading is :\n{}".format(cert_data))
+        # With connect=False the caller connects later, e.g. off the thread constructing it
+        if connect:
+            self.connect()
 
-        if discover_endpoints:
+    def connect(self):
+        if self.discover_endpoints:
             self.logger.info("Discovering endpoints for connection")
-            self.connect_using_discovery(cert_data)
+            self.connect_using_discovery(self.cert_data)
         else:
             self.logger.info("Connecting directly to endpoint")
-            self.connect_to_endpoint(cert_data)
+            self.connect_to_endpoint(self.cert_data)
+
+    def connect_in_background(self, node, callback_group, publisher, start_time):
+        """Connect from a one-shot timer in callback_group, so node spins and runs its other
+        callbacks while discovering and connecting, retrying until connected or shut down.
+
+        publisher, a WindowedPublisher, then publishes what was queued in the meantime, and
+        publishes again whatever awaited a PUBACK whenever the connection changes.
+        """
+        self.on_connection_changed = publisher.republish
+
+        def connect_once():
+            timer.cancel()
+            while node.context.ok() and not self.mqtt_conn:
+                try:
+                    self.connect()
+                except Exception as e:
+                    self.logger.error(f"Connecting failed with exception: {e}, retrying")
+                    time.sleep(RETRY_WAIT_TIME_SECONDS)
+            if not self.mqtt_conn:
+                return
+            self.connect_seconds = time.monotonic() - start_time
+            self.logger.info(f"Connected {self.connect_seconds:.3f}s after startup")
+            publisher.drain(self.mqtt_conn)
+
+        timer = node.create_timer(0, connect_once, callback_group=callback_group)
 
     def connect_to_endpoint(self, cert_data):
         self.mqtt_conn = mqtt_connection_builder.mtls_from_path(
@@ -58,8 +113,33 @@ class ConnectionHelper:
         self.logger.info("Connected!")
 
     def connect_using_discovery(self, cert_data):
-        tries = 0
+        """Connect to the Greengrass core endpoint with the lowest connect time.
 
+        The endpoints are discovered and ranked once, then cached for endpointCacheSeconds, so a
+        restart connects without waiting on discovery. Discovery runs again after
+        rediscoverAfterFailures rounds in which no endpoint would accept a connection, in case
+        the cores have changed.
+        """
+        retry_attempts = cert_data["retryAttempts"]
+        retry_wait_time = cert_data["retryWaitTime"]
+
+        endpoints = self.load_cached_endpoints()
+        failed_rounds = 0
+        for tries in range(retry_attempts):
+            self.logger.info(f"Connection attempt: {tries}")
+            if not endpoints or failed_rounds >= self.rediscover_after_failures:
+                try:
+                    endpoints = self.discover_ranked_endpoints(cert_data)
+                    failed_rounds = 0
+                except Exception as e:
+                    self.logger.error(f"Discovery failed with exception: {e}")
+            if endpoints and self.connect_to_best(endpoints, cert_data):
+                return
+            failed_rounds += 1
+            time.sleep(retry_wait_time)
+        raise Exception("All connection attempts failed!")
+
+    def discover_ranked_endpoints(self, cert_data):
         tls_options = io.TlsContextOptions.create_client_with_mtls_from_path(
             cert_data["certificatePath"],
             cert_data["privateKeyPath"],
@@ -67,55 +147,177 @@ class ConnectionHelper:
         tls_options.override_default_trust_store_from_path(None, cert_data["rootCAPath"])
         tls_context = io.ClientTlsContext(tls_options)
 
-        region = cert_data["region"]
-        retry_attempts = cert_data["retryAttempts"]
-        retry_wait_time = cert_data["retryWaitTime"]
-
         discovery_client = DiscoveryClient(
             io.ClientBootstrap.get_or_create_static_default(),
             io.SocketOptions(),
             tls_context,
-            region,
+            cert_data["region"],
         )
         resp_future = discovery_client.discover(self.client_id)
         discover_response = resp_future.result()
         self.logger.debug(f"Discovery response is: {discover_response}")
 
-        for tries in range(retry_attempts):
-            self.logger.info(f"Connection attempt: {tries}")
-            for gg_group in discover_response.gg_groups:
-                for gg_core in gg_group.cores:
-                    for connectivity_info in gg_core.connectivity:
-                        try:
-                            self.logger.debug(
-                                "Trying core {} as host {}:{}".format(
-                                    gg_core.thing_arn,
-                                    connectivity_info.host_address,
-                                    connectivity_info.port,
-                                )
-                            )
-                            self.mqtt_conn = self.build_greengrass_connection(
-                                gg_group, connectivity_info, cert_data
-                            )
-                            return
-                        except Exception as e:
-                            self.logger.error(f"Connection failed with exception: {e}")
-                            continue
-            time.sleep(retry_wait_time)
-        raise Exception("All connection attempts failed!")
+        endpoints = [
+            {
+                "core": gg_core.thing_arn,
+                "host": connectivity_info.host_address,
+                "port": connectivity_info.port,
+                "ca": gg_group.certificate_authorities[0],
+            }
+            for gg_group in discover_response.gg_groups
+            for gg_core in gg_group.cores
+            for connectivity_info in gg_core.connectivity
+        ]
+        self.rank_endpoints(endpoints)
+        self.save_cached_endpoints(endpoints)
+        return endpoints
+
+    def rank_endpoints(self, endpoints):
+        """Sort endpoints by the round trip time of a TCP connect, probing them all at once.
+        Endpoints which didn't answer go last, in discovery order."""
+        if not endpoints:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(endpoints), 8)) as executor:
+            rtts = list(executor.map(self.probe_endpoint, endpoints))
+        for endpoint, rtt in zip(endpoints, rtts):
+            endpoint["rtt"] = rtt
+            self.logger.info(
+                f"Core {endpoint['core']} at {endpoint['host']}:{endpoint['port']} "
+                + (f"connect time {rtt * 1000:.1f}ms" if rtt is not None else "unreachable")
+            )
+        endpoints.sort(key=lambda endpoint: (endpoint["rtt"] is None, endpoint["rtt"] or 0))
+
+    def probe_endpoint(self, endpoint, timeout=2):
+        start = time.monotonic()
+        try:
+            with socket.create_connection((endpoint["host"], endpoint["port"]), timeout=timeout):
+                return time.monotonic() - start
+        except OSError:
+            return None
+
+    def load_cached_endpoints(self):
+        try:
+            with open(self.endpoint_cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - cache.get("timestamp", 0) > self.endpoint_cache_seconds:
+            return None
+        self.logger.info(f"Using cached endpoint ranking from {self.endpoint_cache_path}")
+        return cache.get("endpoints")
+
+    def save_cached_endpoints(self, endpoints):
+        try:
+            os.makedirs(os.path.dirname(self.endpoint_cache_path), exist_ok=True)
+            temp_path = self.endpoint_cache_path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump({"timestamp": time.time(), "endpoints": endpoints}, f)
+            os.replace(temp_path, self.endpoint_cache_path)
+        except OSError as e:
+            self.logger.warn(f"Unable to cache endpoints: {e}")
 
-    def build_greengrass_connection(self, gg_group, connectivity_info, cert_data):
+    def connect_to_best(self, endpoints, cert_data, exclude=None):
+        """Connect to the first endpoint, other than exclude, which accepts a connection. Returns
+        whether one did."""
+        excluded = (exclude["host"], exclude["port"]) if exclude else None
+        for endpoint in endpoints:
+            if (endpoint["host"], endpoint["port"]) == excluded:
+                continue
+            try:
+                self.logger.debug(
+                    "Trying core {} as host {}:{}".format(
+                        endpoint["core"], endpoint["host"], endpoint["port"]
+                    )
+                )
+                conn = self.build_greengrass_connection(endpoint, cert_data)
+            except Exception as e:
+                self.logger.error(f"Connection failed with exception: {e}")
+                continue
+            with self.lock:
+                self.mqtt_conn = conn
+                self.endpoint = endpoint
+                self.endpoints = endpoints
+                self.interrupted = False
+            return True
+        return False
+
+    def build_greengrass_connection(self, endpoint, cert_data):
         conn = mqtt_connection_builder.mtls_from_path(
-            endpoint=connectivity_info.host_address,
-            port=connectivity_info.port,
+            endpoint=endpoint["host"],
+            port=endpoint["port"],
             cert_filepath=cert_data["certificatePath"],
             pri_key_filepath=cert_data["privateKeyPath"],
-            ca_bytes=gg_group.certificate_authorities[0].encode("utf-8"),
+            ca_bytes=endpoint["ca"].encode("utf-8"),
             client_id=self.client_id,
             clean_session=False,
             keep_alive_secs=30,
+            on_connection_interrupted=self.on_connection_interrupted,
+            on_connection_resumed=self.on_connection_resumed,
         )
         connect_future = conn.connect()
         connect_future.result()
         self.logger.info("Connected!")
         return conn
+
+    def on_connection_interrupted(self, connection, error, **kwargs):
+        self.logger.warn(f"Connection interrupted: {error}")
+        with self.lock:
+            if connection is self.mqtt_conn:
+                self.interrupted = True
+        self.arm_failover(connection)
+
+    def on_connection_resumed(self, connection, return_code, session_present, **kwargs):
+        self.logger.info(f"Connection resumed: {return_code}, session present {session_present}")
+        with self.lock:
+            if connection is not self.mqtt_conn:
+                return
+            self.interrupted = False
+            if self.failover_timer:
+                self.failover_timer.cancel()
+                self.failover_timer = None
+        if not session_present and self.on_connection_changed:
+            self.on_connection_changed(connection)
+
+    def arm_failover(self, connection):
+        # The client reconnects to the same core by itself. If that takes longer than
+        # failoverAfterSeconds, another core is likely to be reachable sooner.
+        with self.lock:
+            if connection is not self.mqtt_conn or not self.interrupted or self.failover_timer:
+                return
+            if not self.discover_endpoints:
+                return
+            self.failover_timer = threading.Timer(
+                self.failover_after_seconds, self.fail_over, args=(connection,)
+            )
+            self.failover_timer.daemon = True
+            self.failover_timer.start()
+
+    def fail_over(self, connection):
+        with self.lock:
+            self.failover_timer = None
+            if connection is not self.mqtt_conn or not self.interrupted:
+                return
+            current = self.endpoint
+            endpoints = list(self.endpoints)
+        self.logger.warn(
+            f"No reconnect to {current['host']}:{current['port']} after "
+            f"{self.failover_after_seconds}s, failing over"
+        )
+
+        # Ranked again, as the interruption may well have changed which core is closest
+        self.rank_endpoints(endpoints)
+        if not self.connect_to_best(endpoints, self.cert_data, exclude=current):
+            try:
+                endpoints = self.discover_ranked_endpoints(self.cert_data)
+                self.connect_to_best(endpoints, self.cert_data, exclude=current)
+            except Exception as e:
+                self.logger.error(f"Discovery failed with exception: {e}")
+
+        if self.mqtt_conn is connection:
+            self.logger.warn("No other core reachable, waiting for the connection to resume")
+            self.arm_failover(connection)
+            return
+        self.logger.info(f"Failed over to {self.endpoint['host']}:{self.endpoint['port']}")
+        connection.disconnect()
+        if self.on_connection_changed:
+            self.on_connection_changed(self.mqtt_conn)
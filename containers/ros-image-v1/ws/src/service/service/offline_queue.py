@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+import mmap
+import os
+import struct
+import threading
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+# magic, capacity, head, tail, count, dropped oldest, dropped newest
+HEADER = struct.Struct("<8sQQQQQQ")
+HEADER_SIZE = 64
+MAGIC = b"MQRING01"
+# payload length, topic length
+RECORD = struct.Struct("<IH")
+
+
+class OfflineQueue:
+    """Bounded store-and-forward queue of MQTT messages in a memory-mapped ring buffer file.
+
+    Messages are appended at the tail and removed from the head once the broker has acknowledged
+    them, so they survive the connection dropping and the process restarting. head and tail are
+    byte counters which only ever grow, their position in the file is modulo the capacity. When
+    a message doesn't fit, the overflow policy either drops the oldest messages to make room
+    or drops the new one.
+    """
+
+    def __init__(self, path, capacity_bytes, overflow=DROP_OLDEST):
+        if overflow not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        self.overflow = overflow
+        self.lock = threading.Lock()
+        self.acked = 0
+        # Offsets of messages acknowledged ahead of the head
+        self.acked_offsets = set()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != HEADER_SIZE + capacity_bytes:
+                os.ftruncate(fd, HEADER_SIZE + capacity_bytes)
+            self.map = mmap.mmap(fd, HEADER_SIZE + capacity_bytes)
+        finally:
+            os.close(fd)
+
+        magic, capacity, head, tail, count, oldest, newest = HEADER.unpack_from(self.map)
+        if magic == MAGIC and capacity == capacity_bytes and 0 <= tail - head <= capacity:
+            self.capacity = capacity
+            self.head, self.tail, self.count = head, tail, count
+            self.dropped_oldest, self.dropped_newest = oldest, newest
+        else:
+            # A new file, or one written with another capacity, starts out empty
+            self.capacity = capacity_bytes
+            self.head = self.tail = self.count = 0
+            self.dropped_oldest = self.dropped_newest = 0
+            self.write_header()
+
+    def write_header(self):
+        # Written after the record data, so a crash part way through a put loses only that put
+        HEADER.pack_into(
+            self.map,
+            0,
+            MAGIC,
+            self.capacity,
+            self.head,
+            self.tail,
+            self.count,
+            self.dropped_oldest,
+            self.dropped_newest,
+        )
+
+    def write(self, offset, data):
+        position = offset % self.capacity
+        first = min(len(data), self.capacity - position)
+        self.map[HEADER_SIZE + position : HEADER_SIZE + position + first] = data[:first]
+        if first < len(data):
+            self.map[HEADER_SIZE : HEADER_SIZE + len(data) - first] = data[first:]
+
+    def read(self, offset, size):
+        position = offset % self.capacity
+        first = min(size, self.capacity - position)
+        data = self.map[HEADER_SIZE + position : HEADER_SIZE + position + first]
+        if first < size:
+            data += self.map[HEADER_SIZE : HEADER_SIZE + size - first]
+        return data
+
+    def record_size(self, offset):
+        payload_size, topic_size = RECORD.unpack(self.read(offset, RECORD.size))
+        return RECORD.size + topic_size + payload_size
+
+    def put(self, topic, payload):
+        """Append a message. Returns False if the overflow policy dropped it."""
+        topic = topic.encode("utf-8")
+        size = RECORD.size + len(topic) + len(payload)
+        with self.lock:
+            if size > self.capacity or (
+                self.overflow == DROP_NEWEST and self.tail - self.head + size > self.capacity
+            ):
+                self.dropped_newest += 1
+                self.write_header()
+                return False
+            while self.tail - self.head + size > self.capacity:
+                self.acked_offsets.discard(self.head)
+                self.head += self.record_size(self.head)
+                self.count -= 1
+                self.dropped_oldest += 1
+            self.write(self.tail, RECORD.pack(len(payload), len(topic)) + topic + payload)
+            self.tail += size
+            self.count += 1
+            self.write_header()
+            return True
+
+    def peek(self, offset=None):
+        """Return (offset, topic, payload, next_offset) of the first undelivered message from
+        offset, or from the oldest message if offset is None or has been dropped, or None if there
+        is no such message. Pass offset to ack once the message has been delivered, and
+        next_offset to peek for the next message."""
+        with self.lock:
+            if offset is None or offset < self.head:
+                offset = self.head
+            while offset in self.acked_offsets:
+                offset += self.record_size(offset)
+            if offset >= self.tail:
+                return None
+            payload_size, topic_size = RECORD.unpack(self.read(offset, RECORD.size))
+            topic = self.read(offset + RECORD.size, topic_size)
+            payload = self.read(offset + RECORD.size + topic_size, payload_size)
+            next_offset = offset + RECORD.size + topic_size + payload_size
+            return offset, topic.decode("utf-8"), payload, next_offset
+
+    def ack(self, offset):
+        """Mark the message at offset delivered. Messages are removed from the head once they and
+        every message before them have been delivered. The message may already have been dropped
+        to make room while it was being delivered."""
+        with self.lock:
+            if offset < self.head or offset in self.acked_offsets:
+                return
+            self.acked_offsets.add(offset)
+            self.acked += 1
+            while self.head in self.acked_offsets:
+                self.acked_offsets.remove(self.head)
+                self.head += self.record_size(self.head)
+                self.count -= 1
+            self.write_header()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": self.count,
+                "depthBytes": self.tail - self.head,
+                "capacityBytes": self.capacity,
+                "delivered": self.acked,
+                "droppedOldest": self.dropped_oldest,
+                "droppedNewest": self.dropped_newest,
+            }
+
+    def close(self):
+        with self.lock:
+            self.map.flush()
+            self.map.close()
@@ -19,43 +19,97 @@
 
 import json
 import datetime
+import time
 import rclpy
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
 from rclpy.node import Node
+from rcl_interfaces.msg import ParameterDescriptor
 from std_msgs.msg import String
-from awscrt import mqtt
 from service.connection_helper import ConnectionHelper
-
-RETRY_WAIT_TIME_SECONDS = 5
+from service.offline_queue import OfflineQueue
+from service.windowed_publisher import WindowedPublisher
 
 
 class MqttPublisher(Node):
     def __init__(self):
+        self.start_time = time.monotonic()
         super().__init__("service")
         self.declare_parameter("path_for_config", "")
         self.declare_parameter("version", "1")
         self.declare_parameter("topic", "clients/device-thing-0/hello/world")
         self.declare_parameter("client_id", "device-thing-0")
-        self.declare_parameter("timer_period", 10)
+        # Seconds, and may be fractional
+        self.declare_parameter("timer_period", 10.0, ParameterDescriptor(dynamic_typing=True))
+        # Messages are queued on disk until the broker acknowledges them, so they survive the
+        # connection to the Greengrass core dropping
+        self.declare_parameter("queue_path", "/var/tmp/service/telemetry.queue")
+        self.declare_parameter("queue_size_bytes", 1024 * 1024)
+        self.declare_parameter("queue_overflow", "drop-oldest")
+        # Messages awaiting their PUBACK at most. When the window is full at a tick, "queue"
+        # queues the new message behind it, "coalesce" holds it back in place of the message
+        # held at an earlier tick and "skip" skips the tick.
+        self.declare_parameter("publish_window", 16)
+        self.declare_parameter("window_full_policy", "queue")
 
         discover_endpoints = True
 
         path_for_config = self.get_parameter("path_for_config").get_parameter_value().string_value
         self.version = self.get_parameter("version").get_parameter_value().string_value
         self.topic = self.get_parameter("topic").get_parameter_value().string_value
-        self.timer_period = self.get_parameter("timer_period").get_parameter_value().integer_value
+        self.timer_period = float(self.get_parameter("timer_period").value)
         self.client_id = self.get_parameter("client_id").get_parameter_value().string_value
 
         self.get_logger().info(
             f"Initializing firmware version {self.version}. Publishing to {self.topic} as client id {self.client_id} every {self.timer_period} seconds"
         )
 
+        # ROS callbacks never wait on the network: discovery and connecting run in their own
+        # callback group, on another executor thread, while the node is already spinning
+        self.ros_group = MutuallyExclusiveCallbackGroup()
+        self.mqtt_group = MutuallyExclusiveCallbackGroup()
         self.connection_helper = ConnectionHelper(
-            self.get_logger(), path_for_config, self.client_id, discover_endpoints
+            self.get_logger(), path_for_config, self.client_id, discover_endpoints, connect=False
         )
+        self.first_callback_seconds = None
 
-        self.timer = self.create_timer(self.timer_period, self.timer_callback)
+        self.queue = OfflineQueue(
+            self.get_parameter("queue_path").get_parameter_value().string_value,
+            self.get_parameter("queue_size_bytes").get_parameter_value().integer_value,
+            self.get_parameter("queue_overflow").get_parameter_value().string_value,
+        )
+        self.publisher = WindowedPublisher(
+            self.get_logger(),
+            self.queue,
+            self.get_parameter("publish_window").get_parameter_value().integer_value,
+        )
+        self.window_full_policy = (
+            self.get_parameter("window_full_policy").get_parameter_value().string_value
+        )
+        if self.window_full_policy not in ("queue", "coalesce", "skip"):
+            raise ValueError(f"Unknown window full policy {self.window_full_policy}")
+        self.skipped_ticks = 0
+        self.stats_publisher = self.create_publisher(String, "telemetry_queue/stats", 10)
+        self.last_stats = (time.monotonic(), 0)
+
+        self.timer = self.create_timer(
+            self.timer_period, self.timer_callback, callback_group=self.ros_group
+        )
+        self.connection_helper.connect_in_background(
+            self, self.mqtt_group, self.publisher, self.start_time
+        )
 
     def timer_callback(self):
+        if self.first_callback_seconds is None:
+            self.first_callback_seconds = time.monotonic() - self.start_time
+            self.get_logger().info(
+                f"First ROS callback {self.first_callback_seconds:.3f}s after startup"
+            )
+        if self.window_full_policy == "skip" and self.publisher.is_full():
+            self.skipped_ticks += 1
+            self.get_logger().warn("Publish window full, skipping tick")
+            self.publish_queue_stats()
+            return
         message_json = json.dumps(
             {
                 "version": self.version,
@@ -65,9 +119,28 @@ class MqttPublisher(Node):
         self.get_logger().info(
             "Received data on ROS2 {}\nPublishing to AWS IoT".format(message_json)
         )
-        self.connection_helper.mqtt_conn.publish(
-            topic=self.topic, payload=message_json, qos=mqtt.QoS.AT_LEAST_ONCE
-        )
+        if self.window_full_policy == "coalesce":
+            queued = self.publisher.coalesce(self.topic, message_json.encode("utf-8"))
+        else:
+            queued = self.queue.put(self.topic, message_json.encode("utf-8"))
+        if not queued:
+            self.get_logger().warn("Telemetry queue full, dropped message")
+        if self.connection_helper.mqtt_conn:
+            self.publisher.drain(self.connection_helper.mqtt_conn)
+        self.publish_queue_stats()
+
+    def publish_queue_stats(self):
+        stats = self.queue.stats()
+        stats.update(self.publisher.stats())
+        stats["skippedTicks"] = self.skipped_ticks
+        stats["firstCallbackSeconds"] = self.first_callback_seconds
+        stats["connectSeconds"] = self.connection_helper.connect_seconds
+        now = time.monotonic()
+        last_time, last_delivered = self.last_stats
+        stats["drainRate"] = round((stats["delivered"] - last_delivered) / (now - last_time), 3)
+        self.last_stats = (now, stats["delivered"])
+        self.get_logger().debug(f"Telemetry queue {stats}")
+        self.stats_publisher.publish(String(data=json.dumps(stats)))
 
 
 def main(args=None):
@@ -75,9 +148,12 @@ def main(args=None):
 
     minimal_subscriber = MqttPublisher()
 
-    rclpy.spin(minimal_subscriber)
+    executor = MultiThreadedExecutor()
+    executor.add_node(minimal_subscriber)
+    executor.spin()
 
     # Destroy the node
+    minimal_subscriber.queue.close()
     minimal_subscriber.destroy_node()
     rclpy.shutdown()
 
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+import functools
+import threading
+import time
+from collections import deque
+from awscrt import mqtt
+
+
+class WindowedPublisher:
+    """Publishes the messages of an OfflineQueue at QoS 1 with at most window of them awaiting
+    their PUBACK.
+
+    Each acknowledgement frees a slot for the next queued message, so a slow broker holds the
+    backlog in the bounded queue rather than in the MQTT client. Publish round-trip times, from
+    publish to PUBACK, are kept for the last latency_samples messages.
+
+    Messages passed to coalesce instead of queued are held back while the window is full, only
+    the latest of each topic, and queued once a slot frees.
+    """
+
+    def __init__(self, logger, queue, window=16, latency_samples=1024):
+        self.logger = logger
+        self.queue = queue
+        self.window = window
+        self.lock = threading.Lock()
+        # Queue offset of each message awaiting its PUBACK, to the time it was published
+        self.in_flight = {}
+        # Queue offset of the next message to publish, None for the oldest
+        self.next_offset = None
+        self.latencies = deque(maxlen=latency_samples)
+        self.published = 0
+        self.failures = 0
+        # Topic to the latest payload held back by coalesce
+        self.held = {}
+        self.coalesced = 0
+
+    def is_full(self):
+        with self.lock:
+            return len(self.in_flight) >= self.window
+
+    def coalesce(self, topic, payload):
+        """Queue a message, or while the window is full hold it back in place of any message
+        already held for its topic. Returns False if the queue's overflow policy dropped it."""
+        with self.lock:
+            if len(self.in_flight) >= self.window:
+                if topic in self.held:
+                    self.coalesced += 1
+                self.held[topic] = payload
+                return True
+        return self.queue.put(topic, payload)
+
+    def release_held(self):
+        with self.lock:
+            if not self.held or len(self.in_flight) >= self.window:
+                return
+            held, self.held = self.held, {}
+        for topic, payload in held.items():
+            if not self.queue.put(topic, payload):
+                self.logger.warn(f"Queue full, dropped message held for {topic}")
+
+    def drain(self, mqtt_conn):
+        """Publish queued messages until the window is full or the queue is empty."""
+        self.release_held()
+        while True:
+            with self.lock:
+                if len(self.in_flight) >= self.window:
+                    return
+                message = self.queue.peek(self.next_offset)
+                while message and message[0] in self.in_flight:
+                    message = self.queue.peek(message[3])
+                if message is None:
+                    return
+                offset, topic, payload, self.next_offset = message
+                self.in_flight[offset] = time.monotonic()
+            try:
+                publish_future, _ = mqtt_conn.publish(
+                    topic=topic, payload=payload, qos=mqtt.QoS.AT_LEAST_ONCE
+                )
+            except Exception as e:
+                self.on_publish_failed(offset, e)
+                return
+            publish_future.add_done_callback(
+                functools.partial(self.on_publish_complete, mqtt_conn, offset)
+            )
+
+    def on_publish_complete(self, mqtt_conn, offset, publish_future):
+        try:
+            publish_future.result()
+        except Exception as e:
+            self.on_publish_failed(offset, e)
+            return
+        with self.lock:
+            published_time = self.in_flight.pop(offset, None)
+            if published_time is not None:
+                self.latencies.append(time.monotonic() - published_time)
+            self.published += 1
+        self.queue.ack(offset)
+        self.drain(mqtt_conn)
+
+    def on_publish_failed(self, offset, e):
+        # Published again by the next drain, from the oldest message not yet acknowledged
+        self.logger.error(f"Publish failed with exception: {e}")
+        with self.lock:
+            self.in_flight.pop(offset, None)
+            self.failures += 1
+            if self.next_offset is None or offset < self.next_offset:
+                self.next_offset = offset
+
+    def republish(self, mqtt_conn):
+        """Publish the messages awaiting their PUBACK again on mqtt_conn, e.g. after failing over
+        to another core."""
+        self.reset()
+        self.drain(mqtt_conn)
+
+    def reset(self):
+        """Forget the messages awaiting their PUBACK, so the next drain publishes them again, e.g.
+        on a new connection. Acknowledgements still arriving for them are harmless."""
+        with self.lock:
+            self.in_flight.clear()
+            self.next_offset = None
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {
+                "inFlight": len(self.in_flight),
+                "window": self.window,
+                "published": self.published,
+                "publishFailures": self.failures,
+                "held": len(self.held),
+                "coalesced": self.coalesced,
+            }
+        if latencies:
+            for percentile in (50, 90, 99):
+                index = min(len(latencies) - 1, len(latencies) * percentile // 100)
+                stats[f"latencyP{percentile}Ms"] = round(latencies[index] * 1000, 1)
+            stats["latencyMaxMs"] = round(latencies[-1] * 1000, 1)
+        return stats
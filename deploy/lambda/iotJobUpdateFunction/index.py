@@ -4,6 +4,7 @@
 import boto3
 from pydantic import BaseModel, PositiveInt
 from pprint import pprint
+from typing import Dict, Optional
 import json
 
 iot_data_client = boto3.client("iot-data")
@@ -18,14 +19,20 @@ class JobExecution(BaseModel):
     jobId: str
     thingArn: str
     status: str
+    statusDetails: Optional[Dict[str, str]] = None
 
 
-def get_job_version(jobId):
+def get_job_version(jobId, statusDetails):
     # Use describe_job_execution to get the job document
     response = iot_client.get_job_document(jobId=jobId)
     # Pretty print response
     operation = json.loads(response["document"]).get("operation")
-    if operation != "Deploy-ROS-Firmware":
+    if operation == "Rollback-ROS-Firmware":
+        # The device reports the version it rolled back to
+        version = (statusDetails or {}).get("firmwareVersion")
+        print(f"Rolled back to firmware version: {version}")
+        return version
+    if operation not in ("Deploy-ROS-Firmware", "Install-ROS-Firmware-Archive"):
         print(f"Operation: {operation} not recognized")
         return None
     version = json.loads(response["document"]).get("version")
@@ -61,7 +68,7 @@ def handler(event, context):
     print(f"JobId: {parsedEvent.jobId}")
     print(f"Status: {parsedEvent.status}")
     print(f"ThingArn: {parsedEvent.thingArn}")
-    version = get_job_version(parsedEvent.jobId)
+    version = get_job_version(parsedEvent.jobId, parsedEvent.statusDetails)
     if version:
         thingName = parsedEvent.thingArn.split("/")[-1]
         update_thing_shadow(thingName, version)
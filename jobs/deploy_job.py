@@ -4,10 +4,57 @@
 import boto3
 import argparse
 import json
+import urllib.request
 import uuid
 
+MANIFEST_MEDIA_TYPES = ", ".join(
+    [
+        "application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json",
+    ]
+)
 
-def create_deployment_job(version, thing_name, job_id, account_id, region):
+
+def resolve_image_digest(registry, version, image="firmware"):
+    # Ask the registry which manifest the tag currently points at, so the job pins that exact image
+    url = f"http://{registry}/v2/{image}/manifests/{version}"
+    request = urllib.request.Request(url, method="HEAD", headers={"Accept": MANIFEST_MEDIA_TYPES})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.headers.get("Docker-Content-Digest")
+    except Exception as e:
+        print(f"Unable to resolve digest for {image}:{version} from {registry}: {e}")
+        return None
+
+
+def load_bundle(bundle_path, version, registry):
+    # A bundle manifest lists the images making up the firmware, e.g.
+    # {"images": [{"name": "drivers"}, {"name": "navigation", "dependsOn": ["drivers"]}]}
+    with open(bundle_path) as f:
+        bundle = json.load(f)
+    for image in bundle["images"]:
+        if "digest" not in image:
+            digest = resolve_image_digest(
+                registry, image.get("version", version), image.get("image", image["name"])
+            )
+            if digest:
+                image["digest"] = digest
+    return bundle
+
+
+def create_deployment_job(
+    version,
+    thing_name,
+    job_id,
+    account_id,
+    region,
+    digest=None,
+    bundle=None,
+    priority=None,
+    archive=None,
+):
     print(f"Creating iot job to deploy version {version}")
     if not job_id:
         # create a unique job id
@@ -21,28 +68,73 @@ def create_deployment_job(version, thing_name, job_id, account_id, region):
     print("region", region)
     client = boto3.client("iot", region_name=region)
     target = f"arn:aws:iot:{region}:{account_id}:thing/{thing_name}"
-    job_document = f'''{{
+    print("digest", digest)
+    job_document = {
         "operation": "Deploy-ROS-Firmware",
-        "jobDocument": {{
-            "thingName": "{thing_name}",
-            "attributeUpdate": {{
-                "attributes": {{
-                    "firmwareVersion": "{version}"
-                }}
-            }}
-        }},
-        "version": "{version}"
-    }}'''
+        "jobDocument": {
+            "thingName": thing_name,
+            "attributeUpdate": {"attributes": {"firmwareVersion": version}},
+        },
+        "version": version,
+    }
+    if digest:
+        job_document["digest"] = digest
+    if bundle:
+        job_document["bundle"] = bundle
+    if priority is not None:
+        job_document["priority"] = priority
+    if archive:
+        # Installed from a docker save archive on the device or a local depot, without the registry
+        job_document["operation"] = "Install-ROS-Firmware-Archive"
+        job_document["archive"] = archive
     response = client.create_job(
         jobId=str(job_id),
         targets=[target],
         description=f"Deployment to version {version}",
         targetSelection="SNAPSHOT",
-        document=job_document,
+        document=json.dumps(job_document),
     )
     print(response)
     return response
 
+
+def create_rollback_job(thing_name, job_id, account_id, region, priority=None):
+    print("Creating iot job to roll back to the standby firmware")
+    if not job_id:
+        job_id = uuid.uuid4()
+    if not account_id:
+        account_id = boto3.client("sts", region_name=region).get_caller_identity().get("Account")
+    client = boto3.client("iot", region_name=region)
+    target = f"arn:aws:iot:{region}:{account_id}:thing/{thing_name}"
+    job_document = {"operation": "Rollback-ROS-Firmware"}
+    if priority is not None:
+        job_document["priority"] = priority
+    response = client.create_job(
+        jobId=str(job_id),
+        targets=[target],
+        description="Rollback to standby firmware",
+        targetSelection="SNAPSHOT",
+        document=json.dumps(job_document),
+    )
+    print(response)
+    return response
+
+
+def set_desired_firmware(thing_name, version, region, digest=None):
+    # For agents running with UPDATE_MODE=shadow, which reconcile to the firmware named shadow
+    client = boto3.client("iot-data", region_name=region)
+    desired = {"firmwareVersion": version}
+    if digest:
+        desired["firmwareDigest"] = digest
+    response = client.update_thing_shadow(
+        thingName=thing_name,
+        shadowName="firmware",
+        payload=json.dumps({"state": {"desired": desired}}),
+    )
+    print(f"Set desired firmware of {thing_name} to {desired}")
+    return response
+
+
 def update_thing_attributes(thing_name, version, region):
     client = boto3.client("iot", region_name=region)
     # Get current version
@@ -67,18 +159,61 @@ def update_thing_attributes(thing_name, version, region):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Create an iot job")
-    parser.add_argument("version", help="version to deploy")
+    parser.add_argument("version", nargs="?", help="version to deploy")
+    parser.add_argument(
+        "--rollback", action="store_true", help="roll back to the device's standby firmware"
+    )
     parser.add_argument("--thing_name", help="thing name", default="device-thing-1-agent")
     parser.add_argument("--job_id", help="job id")
     parser.add_argument("--account_id", help="AWS account id")
     parser.add_argument("--region", help="AWS region", default="us-east-1")
+    parser.add_argument("--digest", help="image digest to pin, resolved from the registry if omitted")
+    parser.add_argument("--registry", help="registry to resolve digests from", default="localhost:5555")
+    parser.add_argument("--bundle", help="path to a bundle manifest listing several firmware images")
+    parser.add_argument(
+        "--archive", help="path or URL, as seen from the device, of a docker save archive to install"
+    )
+    parser.add_argument("--archive-sha256", help="sha256 of the archive file")
+    parser.add_argument(
+        "--shadow",
+        action="store_true",
+        help="set the desired version on the firmware shadow instead of creating a job",
+    )
+    parser.add_argument(
+        "--priority",
+        type=int,
+        help="device queue priority, higher runs first (default 0, or 100 for rollbacks)",
+    )
     args = parser.parse_args()
     version = args.version
     job_id = args.job_id
     account_id = args.account_id
     thing_name = args.thing_name
     region = args.region
-    response = create_deployment_job(version, thing_name, job_id, account_id, region)
+    if args.rollback:
+        create_rollback_job(thing_name, job_id, account_id, region, args.priority)
+        exit(0)
+    if not version:
+        parser.error("version is required unless --rollback is given")
+    if args.shadow:
+        digest = args.digest or resolve_image_digest(args.registry, version)
+        set_desired_firmware(thing_name, version, region, digest)
+        exit(0)
+    archive = None
+    if args.archive:
+        if not args.archive_sha256:
+            parser.error("--archive-sha256 is required with --archive")
+        archive = {"url": args.archive, "sha256": args.archive_sha256}
+    if args.bundle:
+        digest = None
+        bundle = load_bundle(args.bundle, version, args.registry)
+    else:
+        # Archives are for devices which can't reach the registry, so don't pin a digest
+        digest = None if archive else args.digest or resolve_image_digest(args.registry, version)
+        bundle = None
+    response = create_deployment_job(
+        version, thing_name, job_id, account_id, region, digest, bundle, args.priority, archive
+    )
 
     # Check if the job creation was successful
     if response['ResponseMetadata']['HTTPStatusCode'] == 200: